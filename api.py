@@ -3,6 +3,7 @@
 """ Module which contains all public user simulator operations. All functions contained in this module are thread-safe
 unless otherwise noted.
 """
+import concurrent.futures
 import re
 
 import config as config_module
@@ -10,18 +11,22 @@ import externalvars
 import usersim
 from usersim import States
 import tasks
+from tasks import broker
 
 
-def new_task(config, start_paused=False, reset=False):
+def new_task(config, start_paused=False, reset=False, user=None):
     """ Inserts a new task into the user simulator.
 
     Arguments:
         task_config (dict): A dictionary with the following key:value pairs.
             'type':str
             'config':dict
+            'timeout':number - Optional. Seconds after which the task is cancelled and stopped if it is still running.
         start_paused (bool): True if the new task should be paused initially, False otherwise.
         reset (bool): True if the simulator should be reset, False otherwise. This option should only be used
             for writing tests.
+        user (usersim.VirtualUser): The virtual user, returned by new_user, that the task acts for. If None, a task
+            created from within another task inherits that task's virtual user.
 
     Raises:
         KeyError: See validate_config docstring.
@@ -34,43 +39,68 @@ def new_task(config, start_paused=False, reset=False):
     validated_config = validate_config(config)
     task = tasks.task_dict[config['type']]
 
-    return sim.new_task(task, validated_config, start_paused)
+    return sim.new_task(task, validated_config, start_paused, user, config.get('timeout'))
+
+def new_user(name, seed=None, credentials=None):
+    """ Create a virtual user. Many virtual users can share the simulator, each with its own tasks. Their tasks are
+    tagged with the user's name in status and feedback messages, and draw random numbers from the user's own generator.
+
+    Arguments:
+        name (str): The name to tag the user's tasks with.
+        seed (int): Seed for the user's random number generator. If None, it is seeded randomly.
+        credentials (dict): Maps arbitrary keys to the names of external variables holding the user's credentials. The
+            values are looked up once with external_lookup.
+
+    Returns:
+        usersim.VirtualUser: The new user, to be passed to new_task. Its credentials attribute maps the keys of
+            credentials to the looked up values.
+    """
+    credentials = credentials or {}
+    values = {key: external_lookup(var_name) for key, var_name in credentials.items()}
+
+    return usersim.VirtualUser(name, seed, values)
 
 def pause_task(task_id):
-    """ Pause a single task.
+    """ Pause a single task. The change is applied at the start of the next simulation cycle.
 
     Arguments:
         task_id (int > 0): The task ID returned by an earlier call to new_task.
 
     Returns:
-        bool: True if the operation succeeded, False otherwise.
+        concurrent.futures.Future: Resolves to True if the operation succeeded, False otherwise.
     """
     sim = usersim.UserSim()
     return sim.pause_task(task_id)
 
 def pause_all():
-    """ Pause all currently scheduled tasks.
+    """ Pause all currently scheduled tasks. The change is applied at the start of the next simulation cycle.
+
+    Returns:
+        concurrent.futures.Future: Resolves to None once the change has been applied.
     """
     sim = usersim.UserSim()
-    sim.pause_all()
+    return sim.pause_all()
 
 def unpause_task(task_id):
-    """ Unpause a single task.
+    """ Unpause a single task. The change is applied at the start of the next simulation cycle.
 
     Arguments:
         task_id (int > 0): The task ID returned by an earlier call to new_task.
 
     Returns:
-        bool: True if the operation succeeded, False otherwise.
+        concurrent.futures.Future: Resolves to True if the operation succeeded, False otherwise.
     """
     sim = usersim.UserSim()
     return sim.unpause_task(task_id)
 
 def unpause_all():
-    """ Unpause all currently paused tasks.
+    """ Unpause all currently paused tasks. The change is applied at the start of the next simulation cycle.
+
+    Returns:
+        concurrent.futures.Future: Resolves to None once the change has been applied.
     """
     sim = usersim.UserSim()
-    sim.unpause_all()
+    return sim.unpause_all()
 
 def status_task(task_id):
     """ Get the status of a single task.
@@ -84,6 +114,7 @@ def status_task(task_id):
             'type':str
             'state':str
             'status':str
+            'user':str
     """
     sim = usersim.UserSim()
     return sim.status_task(task_id)
@@ -97,27 +128,105 @@ def status_all():
             'type':str
             'state':str
             'status':str
+            'user':str
     """
     sim = usersim.UserSim()
     return sim.status_all()
 
 def stop_task(task_id):
-    """ Stop a single task.
+    """ Stop a single task. The change is applied at the start of the next simulation cycle.
 
     Arguments:
         task_id (int > 0): The task ID returned by an earlier call to new_task.
 
     Returns:
-        bool: True if the operation succeeded, False otherwise.
+        concurrent.futures.Future: Resolves to True if the operation succeeded, False otherwise.
     """
     sim = usersim.UserSim()
     return sim.stop_task(task_id)
 
 def stop_all():
-    """ Stop all tasks that are currently scheduled or paused.
+    """ Stop all tasks that are currently scheduled or paused. The change is applied at the start of the next simulation
+    cycle.
+
+    Returns:
+        concurrent.futures.Future: Resolves to None once the change has been applied.
+    """
+    sim = usersim.UserSim()
+    return sim.stop_all()
+
+def subscribe_task(task_id, callback):
+    """ Get notified when a task stops, instead of polling its status.
+
+    Arguments:
+        task_id (int > 0): The task ID returned by an earlier call to new_task.
+        callback (callable): Called with the task's final status dict (see status_task) as its only argument once the
+            task has stopped. It is normally called from the thread running the simulation cycles, but is called right
+            away if the task has already stopped. It must return quickly, but it may use the API.
+
+    Returns:
+        bool: True if the callback was registered or called, False if the task ID is unknown.
     """
     sim = usersim.UserSim()
-    sim.stop_all()
+    return sim.subscribe_task(task_id, callback)
+
+def future_task(task_id):
+    """ Get a future that resolves once a task stops. See subscribe_task.
+
+    Arguments:
+        task_id (int > 0): The task ID returned by an earlier call to new_task.
+
+    Returns:
+        concurrent.futures.Future: Its result is the task's final status dict (see status_task). None if the task ID is
+            unknown.
+    """
+    future = concurrent.futures.Future()
+    if not subscribe_task(task_id, future.set_result):
+        return None
+    return future
+
+def prime_task(config):
+    """ Warm up what a task needs before it first runs, e.g. by resolving hosts and opening pooled network sessions or
+    by starting a shared browser, so that its first run doesn't pay for it. Tasks nested in the task's configuration
+    are primed as well, except for those whose configurations still contain placeholders, such as the nested tasks of
+    user. Priming happens in the background, and any errors are ignored since the task reports them when it runs. Call
+    this when a configuration is loaded, before or right after passing it to new_task.
+
+    Arguments:
+        config (dict): A task configuration, as passed to new_task.
+
+    Raises:
+        KeyError: See validate_config docstring.
+        ValueError: See validate_config docstring.
+    """
+    primes = [(tasks.task_dict[config['type']], validate_config(config))]
+
+    # Look for nested task configurations, walking through the configurations of the tasks found so far, except those
+    # of tasks that fill in their nested tasks' configurations when they run.
+    index = 0
+    while index < len(primes):
+        task_class, task_config = primes[index]
+        values = [] if task_class.substitutes else [task_config]
+        index += 1
+        while values:
+            value = values.pop()
+            if isinstance(value, dict) and set(value) == {'type', 'config'} and value['type'] in tasks.task_dict:
+                try:
+                    primes.append((tasks.task_dict[value['type']], validate_config(value)))
+                except (KeyError, ValueError):
+                    # E.g. a template whose values are only filled in when the parent task runs.
+                    pass
+            elif isinstance(value, dict):
+                values.extend(value.values())
+            elif isinstance(value, list):
+                values.extend(value)
+
+    # A configuration with placeholders left in it would e.g. log in with a literal $password.
+    primes = [(task_class, task_config) for task_class, task_config in primes
+              if not config_module.has_placeholder(task_config)]
+
+    sim = usersim.UserSim()
+    sim.prime_task(primes)
 
 def validate_config(config):
     """ Validate a config dictionary without instantiating a Task subclass.
@@ -126,10 +235,11 @@ def validate_config(config):
         config (dict): A dictionary with the following key:value pairs.
             'type':str
             'config':dict
+            'timeout':number - Optional. See new_task.
 
     Raises:
         KeyError: If a required key is missing from config or config['config'] or if the task type does not exist.
-        ValueError: If the given value of an option under config['config'] is invalid.
+        ValueError: If the given value of an option under config['config'] or of config['timeout'] is invalid.
 
     Returns:
         dict: The dictionary associated with config's 'config' key, after processing it with the given task's validate
@@ -139,6 +249,10 @@ def validate_config(config):
     task = tasks.task_dict[config['type']]
     task_config = config['config']
 
+    timeout = config.get('timeout')
+    if timeout is not None and (isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or timeout <= 0):
+        raise ValueError('timeout: {} Must be a positive number'.format(timeout))
+
     return task.validate(task_config)
 
 def check_config(config, parameters, defaults):
@@ -211,6 +325,15 @@ def get_tasks(filter_result=True):
 
     return available_tasks
 
+def pool_metrics():
+    """ Get counters describing how the session pools shared by network tasks are used. Only covers the pools of the
+    current process, so with worker processes it only includes sessions of tasks run by the main process.
+
+    Returns:
+        dict: Maps pool names (e.g. 'ssh') to dicts of counters. See tasks.broker.Pool.metrics.
+    """
+    return broker.metrics()
+
 def add_feedback(task_id, error):
     """ Create an additional feedback message. This will mostly be used from within threads supporting a main task, for
     example, managing interaction with an external program.
@@ -11,6 +11,8 @@ except ImportError as e:
     boost = e
 from communication import local
 from communication import rpc
+from communication import tcp
+import supervisor
 
 
 def init_boost(args, feedback_queue):
@@ -26,11 +28,25 @@ def init_local(args, feedback_queue):
 def init_rpc(args, feedback_queue):
     rpc.RPCCommunication(feedback_queue, args.ip_address, args.port, args.name)
 
+def init_tcp(args, feedback_queue):
+    tcp.TCPCommunication(feedback_queue, args.ip_address, args.port)
+
 def test_mode(*args):
     return True
 
 def parse_and_initialize(feedback_queue):
     parser = argparse.ArgumentParser(description = 'User Simulator which can generate various types of traffic.')
+    parser.add_argument('--workers',
+            action='store',
+            default=1,
+            help='Number of worker processes to run tasks in. More than 1 lets CPU-heavy tasks use several cores.',
+            type=int)
+    parser.add_argument('--shard',
+            action='store',
+            choices=['type', 'hash'],
+            default='type',
+            help='How tasks are spread over worker processes: by task type, or by a hash of the whole task '
+                 'configuration.')
 
     subparsers = parser.add_subparsers()
     boost_parser = subparsers.add_parser('xga')
@@ -63,8 +79,27 @@ def parse_and_initialize(feedback_queue):
             default=None,
             help='An arbitrary identifier string for the RPC server to use.')
 
+    tcp_parser = subparsers.add_parser('tcp')
+    tcp_parser.set_defaults(function=init_tcp)
+    tcp_parser.add_argument('ip_address',
+            nargs='?',
+            action='store',
+            default='127.0.0.1',
+            help='The address to listen on for controllers. Use 0.0.0.0 to accept controllers from other hosts.')
+    tcp_parser.add_argument('port',
+            nargs='?',
+            action='store',
+            default=18813,
+            help='Port to listen on.',
+            type=int)
+
     test_parser = subparsers.add_parser('test')
     test_parser.set_defaults(function=test_mode)
 
     args = parser.parse_args()
+
+    if args.workers > 1:
+        # Must happen before any communication method starts adding tasks.
+        supervisor.Supervisor.start(args.workers, args.shard)
+
     return args.function(args, feedback_queue)
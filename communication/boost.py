@@ -43,6 +43,8 @@ def log_error(status, exception):
     feedback.append('Type: {}'.format(status['type']))
     feedback.append('ID: {}'.format(status['id']))
     feedback.append('State: {}'.format(status['state']))
+    if status['user']:
+        feedback.append('User: {}'.format(status['user']))
     if status['status']:
         feedback.append('Status: {}'.format(status['status']))
     feedback.append('Exception: {}'.format(exception))
@@ -133,6 +135,7 @@ class BoostCommunication(object):
                         continue
 
                     try:
+                        api.prime_task(task)
                         api.new_task(task)
                     except KeyError as e:
                         self._feedback_queue.put((common.api_exception_status, 'task ' + task['type'] + ' missing '
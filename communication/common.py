@@ -2,8 +2,60 @@
 
 """ Code that is shared by more than one communication method.
 """
+import concurrent.futures
+
 import api
 
 
 # Used for sending error feedback messages in legacy communication methods.
-api_exception_status = {'id': 0, 'type': 'apiexception', 'state': api.States.UNKNOWN, 'status': ''}
+api_exception_status = {'id': 0, 'type': 'apiexception', 'state': api.States.UNKNOWN, 'status': '', 'user': ''}
+
+# API functions whose arguments and results can be sent by value, e.g. as JSON.
+serializable_functions = ['new_task', 'pause_task', 'pause_all', 'unpause_task', 'unpause_all', 'status_task',
+                          'status_all', 'stop_task', 'stop_all', 'prime_task', 'validate_config', 'get_tasks',
+                          'pool_metrics', 'add_feedback']
+
+def new_task(config, start_paused=False, reset=False, user=None):
+    """ Like api.new_task, but primes the task first (see api.prime_task). For tasks received from controllers.
+    """
+    api.prime_task(config)
+    return api.new_task(config, start_paused, reset, user)
+
+def call(function_name, args=(), kwargs=None):
+    """ Call one of serializable_functions on behalf of a controller.
+
+    Args:
+        function_name (str): The name of the function.
+        args (list): Positional arguments.
+        kwargs (dict): Keyword arguments.
+
+    Raises:
+        ValueError: If function_name is not one of serializable_functions.
+        Exception: Whatever the function raises.
+
+    Returns:
+        any: What the function returns. Commands such as pause_task return a concurrent.futures.Future, see
+            acknowledge.
+    """
+    if function_name not in serializable_functions:
+        raise ValueError('{} is not an available function.'.format(function_name))
+
+    function = new_task if function_name == 'new_task' else getattr(api, function_name)
+    return function(*args, **(kwargs or {}))
+
+def acknowledge(value):
+    """ Turn what an API function returned into something that can be sent by value right away. Commands such as
+    pause_task are only applied at the start of the next simulation cycle, so they are acknowledged with True rather
+    than waited for. That means the command was queued, not that it succeeded: e.g. pause_task is acknowledged with
+    True even for an unknown task ID. Callers that want their results must wait for the future themselves, without
+    blocking a thread that serves requests.
+
+    Args:
+        value (any): What an API function returned.
+
+    Returns:
+        any: True if value is a future, since the command was queued, or value itself otherwise.
+    """
+    if isinstance(value, concurrent.futures.Future):
+        return True
+    return value
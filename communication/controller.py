@@ -0,0 +1,491 @@
+# Copyright 2017 Carnegie Mellon University. See LICENSE.md file for terms.
+
+""" A reference implementation of the server that usersims in rpc mode connect to. It keeps track of every registered
+usersim, sends commands to many of them at once, and collects their feedback. Run this module to benchmark how long
+commands take to reach a fleet of local usersims, e.g.:
+    python -m communication.controller --simulators 500 --rounds 20
+"""
+import argparse
+import concurrent.futures
+import itertools
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+
+import rpyc
+from rpyc.utils.helpers import classpartial
+from rpyc.utils.server import ThreadedServer
+
+from communication import rpc
+import config
+
+
+# Estimated cost of one task of each type relative to the others, used to spread scenarios over a fleet. Types that are
+# not listed cost DEFAULT_COST. Nested tasks add their own costs.
+TASK_COSTS = {'firefox': 8, 'iebrowser': 8, 'outlook': 4, 'outlooksend': 4, 'word': 4, 'ssh': 2, 'telnet': 2,
+              'samba': 2, 'ftp': 2, 'smtp': 2}
+DEFAULT_COST = 1
+# Seconds a usersim that disconnected has to reconnect under the same name before its scenario tasks are given to other
+# usersims. It most likely still runs them, and reconnects after a delay, see rpc.RECONNECT_MIN.
+RECONNECT_GRACE = 60
+# Seconds to wait for a usersim to apply a command, when waiting for it. See Controller.call.
+WAIT_TIMEOUT = 60
+
+class Controller(object):
+    """ Accepts registrations from usersims and sends them commands concurrently, with at most a fixed number of
+    commands in flight at a time. Guaranteed thread-safe.
+    """
+    def __init__(self, parallel=64, grace=RECONNECT_GRACE):
+        """
+        Args:
+            parallel (int): The most commands to have in flight at once.
+            grace (float): Seconds to give a usersim that disconnected to reconnect before its scenario tasks are
+                spread over the others.
+        """
+        # Maps simulator names to their connections.
+        self._simulators = {}
+        # Names given to usersims that haven't registered under a name of their own. Scenario tasks are never placed on
+        # them, since a usersim's connection is only known under a lasting name once it registers.
+        self._unnamed = set()
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(parallel)
+        self._server = None
+        self.feedback = FeedbackStore()
+        # The port actually listened on.
+        self.port = None
+
+        # For the scenario spread over the fleet: how much load each usersim can take, the (task, cost) tuples given to
+        # each usersim, and the tuples still waiting for a usersim.
+        self._capacities = {}
+        self._assigned = {}
+        self._unassigned = []
+        # Maps the names of disconnected usersims that still have tasks assigned to them to a token of their
+        # disconnection, until they reconnect or their grace period is over.
+        self._missing = {}
+        self._grace = grace
+
+    def start(self, address='0.0.0.0', port=18812):
+        """ Start listening for usersims in the background.
+
+        Args:
+            address (str): Address to listen on.
+            port (int): Port to listen on. 0 to pick any free port.
+        """
+        self._server = ThreadedServer(classpartial(_ControllerService, self), hostname=address, port=port)
+        thread = threading.Thread(target=self._server.start)
+        thread.daemon = True
+        thread.start()
+
+        while not self._server.active:
+            time.sleep(.01)
+        self.port = self._server.port
+
+    def close(self):
+        """ Stop listening and drop all usersims.
+        """
+        self._server.close()
+        with self._lock:
+            connections = list(self._simulators.values())
+            self._simulators = {}
+        for connection in connections:
+            connection.close()
+
+    def names(self):
+        """
+        Returns:
+            list of str: The names of all registered usersims, sorted.
+        """
+        with self._lock:
+            return sorted(self._simulators)
+
+    def wait_for(self, count, timeout=60):
+        """ Wait until at least count usersims are registered.
+
+        Raises:
+            TimeoutError: If fewer have registered once timeout seconds have passed.
+        """
+        end = time.time() + timeout
+        while len(self.names()) < count:
+            if time.time() > end:
+                raise TimeoutError('Only {} of {} usersims registered.'.format(len(self.names()), count))
+            time.sleep(.05)
+
+    def call(self, function_name, *args, names=None, wait=False, **kwargs):
+        """ Call an API function on many usersims at once. Arguments and results are passed by value, see
+        rpc.UserSimService.exposed_call.
+
+        Args:
+            function_name (str): One of common.serializable_functions.
+            *args: Positional arguments for the function. Must be JSON serializable.
+            names (list of str): The usersims to call. All registered usersims if None.
+            wait (bool): Whether to wait for commands such as pause_task to be applied and return their results,
+                rather than True as soon as the usersims have queued them. Waiting takes until their next cycle.
+            **kwargs: Keyword arguments for the function. Must be JSON serializable.
+
+        Returns:
+            dict: Maps each usersim's name to the function's result, or to the exception raised on that usersim.
+        """
+        blob = json.dumps({'args': args, 'kwargs': kwargs}, default=str)
+
+        with self._lock:
+            if names is None:
+                targets = dict(self._simulators)
+            else:
+                targets = {name: self._simulators[name] for name in names if name in self._simulators}
+
+        futures = {name: self._executor.submit(self._call_one, connection, function_name, blob, wait)
+                   for name, connection in targets.items()}
+
+        results = {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                results[name] = e
+        return results
+
+    def new_task(self, config, names=None):
+        return self.call('new_task', config, names=names)
+
+    def pause_all(self, names=None, wait=False):
+        return self.call('pause_all', names=names, wait=wait)
+
+    def unpause_all(self, names=None, wait=False):
+        return self.call('unpause_all', names=names, wait=wait)
+
+    def stop_all(self, names=None, wait=False):
+        return self.call('stop_all', names=names, wait=wait)
+
+    def status_all(self, names=None):
+        return self.call('status_all', names=names)
+
+    def load_scenario(self, scenario, capacities=None):
+        """ Spread one scenario over the whole fleet and send each usersim its share. Tasks are spread by estimated
+        cost, so that every usersim's share is about the same relative to its capacity, counting tasks of scenarios
+        loaded before. If a usersim disconnects and doesn't reconnect under the same name within the grace period, its
+        tasks are spread over the remaining ones. Only usersims that registered under a name are given tasks. If there
+        are none, the tasks wait for the first one.
+
+        Args:
+            scenario (list of dicts or str): Task configurations, or a string of them (see config.string_to_python).
+                Besides 'type' and 'config', a task may have a 'cost' key to override its estimated cost (see
+                estimate_cost).
+            capacities (dict): Maps usersim names to how much load each can take relative to the others. Usersims
+                that are not included have a capacity of 1.
+
+        Returns:
+            dict: Maps the names of the usersims that were sent tasks to lists of the results of new_task for each of
+                their tasks. See call.
+        """
+        if isinstance(scenario, str):
+            scenario = config.string_to_python(scenario)
+
+        with self._lock:
+            self._capacities = dict(capacities or {})
+            self._unassigned.extend((task, task.get('cost', estimate_cost(task))) for task in scenario)
+        return self._place()
+
+    def assignments(self):
+        """
+        Returns:
+            dict: Maps usersim names to lists of the tasks of the scenario they were sent.
+        """
+        with self._lock:
+            return {name: [task for task, cost in entries] for name, entries in self._assigned.items()}
+
+    def _place(self):
+        """ Send the tasks waiting for a usersim to the usersims with the least load relative to their capacity.
+
+        Returns:
+            dict: See load_scenario.
+        """
+        with self._lock:
+            names = [name for name in self._simulators if name not in self._unnamed]
+            if not names or not self._unassigned:
+                return {}
+
+            loads = {name: sum(cost for task, cost in self._assigned.get(name, [])) for name in names}
+            capacities = {name: self._capacities.get(name, 1) for name in names}
+            entries = self._unassigned
+            self._unassigned = []
+
+            shares = partition([cost for task, cost in entries], capacities, loads)
+            sends = {}
+            for name, indexes in shares.items():
+                if indexes:
+                    share = [entries[index] for index in indexes]
+                    self._assigned.setdefault(name, []).extend(share)
+                    sends[name] = (self._simulators[name], [task for task, cost in share])
+
+        futures = {name: self._executor.submit(self._send_tasks, connection, tasks)
+                   for name, (connection, tasks) in sends.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+    def _send_tasks(self, connection, tasks):
+        results = []
+        for task in tasks:
+            # The cost is only for the controller.
+            task = {key: value for key, value in task.items() if key != 'cost'}
+            blob = json.dumps({'args': [task]}, default=str)
+            try:
+                results.append(self._call_one(connection, 'new_task', blob))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    @staticmethod
+    def _call_one(connection, function_name, blob, wait=False):
+        if not wait:
+            return json.loads(connection.root.call(function_name, blob))
+
+        # The usersim replies through the callback once the command has been applied, so that it doesn't hold up the
+        # thread serving this connection until then.
+        replied = concurrent.futures.Future()
+        connection.root.call(function_name, blob, replied.set_result)
+        reply = json.loads(replied.result(WAIT_TIMEOUT))
+        if 'error' in reply:
+            raise RuntimeError('{type}: {message}'.format(**reply['error']))
+        return reply['result']
+
+    def _register(self, name, connection, named=True):
+        """
+        Args:
+            name (str): The usersim's name.
+            connection (rpyc.Connection): The usersim's connection.
+            named (bool): Whether the usersim registered the name itself. If not, no tasks are placed on it.
+        """
+        with self._lock:
+            previous = self._simulators.get(name)
+            self._simulators[name] = connection
+            if not named:
+                self._unnamed.add(name)
+            # A usersim that reconnects in time keeps the tasks it is still running.
+            self._missing.pop(name, None)
+            waiting = named and bool(self._unassigned)
+
+        # A usersim that reconnected before its old connection timed out replaces it.
+        if previous is not None and previous is not connection:
+            previous.close()
+
+        if waiting:
+            self._place_later()
+
+    def _unregister(self, name, connection):
+        with self._lock:
+            if self._simulators.get(name) is not connection:
+                return
+            del self._simulators[name]
+            self._unnamed.discard(name)
+            if not self._assigned.get(name):
+                return
+            token = object()
+            self._missing[name] = token
+
+        timer = threading.Timer(self._grace, self._reclaim, (name, token))
+        timer.daemon = True
+        timer.start()
+
+    def _reclaim(self, name, token):
+        """ Spread the tasks of a usersim that disconnected over the others, unless it has reconnected since.
+
+        Args:
+            name (str): The usersim's name.
+            token (object): The token of the disconnection, see _unregister.
+        """
+        with self._lock:
+            if self._missing.get(name) is not token:
+                return
+            del self._missing[name]
+            self._unassigned.extend(self._assigned.pop(name, []))
+
+        self._place()
+
+    def _place_later(self):
+        """ Run _place in its own thread, since it is called from threads serving usersims.
+        """
+        thread = threading.Thread(target=self._place)
+        thread.daemon = True
+        thread.start()
+
+class _ControllerService(rpyc.Service):
+    """ Handles one usersim's connection.
+    """
+    _numbers = itertools.count(1)
+
+    def __init__(self, controller):
+        super().__init__()
+        self._controller = controller
+        self._connection = None
+        self._name = None
+
+    def on_connect(self, connection):
+        self._connection = connection
+        # Usersims without a name don't register, so they are known by a number until they do.
+        self._name = 'unnamed-{}'.format(next(self._numbers))
+        self._controller._register(self._name, connection, False)
+
+    def on_disconnect(self, connection):
+        self._controller._unregister(self._name, connection)
+
+    def exposed_register(self, name, system):
+        self._controller._unregister(self._name, self._connection)
+        self._name = name
+        self._controller._register(name, self._connection)
+
+    def exposed_bulk_feedback(self, feedback):
+        self._controller.feedback.add(self._name, rpc.local_copy(feedback))
+
+class FeedbackStore(object):
+    """ Feedback from all usersims, indexed by usersim, by task type and by task. Guaranteed thread-safe.
+    """
+    def __init__(self):
+        # Every entry is a (simulator name, status dict, error str) tuple.
+        self._entries = []
+        # Each index maps a key to the positions of its entries in self._entries.
+        self._by_simulator = {}
+        self._by_type = {}
+        self._by_task = {}
+        self._lock = threading.Lock()
+
+    def add(self, simulator, feedback):
+        """
+        Args:
+            simulator (str): The name of the usersim that sent the feedback.
+            feedback (list): (status, error) pairs, as from usersim._UserSim.cycle.
+        """
+        with self._lock:
+            for status, error in feedback:
+                position = len(self._entries)
+                self._entries.append((simulator, status, error))
+                self._by_simulator.setdefault(simulator, []).append(position)
+                self._by_type.setdefault(status['type'], []).append(position)
+                self._by_task.setdefault((simulator, status['id']), []).append(position)
+
+    def count(self):
+        with self._lock:
+            return len(self._entries)
+
+    def errors(self):
+        """
+        Returns:
+            list of tuples: Every entry with an error, as (simulator, status, error).
+        """
+        with self._lock:
+            return [entry for entry in self._entries if entry[2]]
+
+    def by_simulator(self, simulator):
+        return self._get(self._by_simulator, simulator)
+
+    def by_type(self, task_type):
+        return self._get(self._by_type, task_type)
+
+    def by_task(self, simulator, task_id):
+        return self._get(self._by_task, (simulator, task_id))
+
+    def _get(self, index, key):
+        with self._lock:
+            return [self._entries[position] for position in index.get(key, [])]
+
+def estimate_cost(task):
+    """ Estimate how much load a task puts on a usersim, relative to other tasks. See TASK_COSTS.
+
+    Args:
+        task (dict): A task configuration with the keys 'type' and 'config'.
+
+    Returns:
+        number: The cost of the task, including the tasks nested in its configuration.
+    """
+    def nested_cost(value):
+        if isinstance(value, dict) and 'type' in value and isinstance(value.get('config'), dict):
+            return estimate_cost(value)
+        elif isinstance(value, dict):
+            return sum(nested_cost(item) for item in value.values())
+        elif isinstance(value, list):
+            return sum(nested_cost(item) for item in value)
+        return 0
+
+    return TASK_COSTS.get(task['type'], DEFAULT_COST) + nested_cost(task['config'])
+
+def partition(costs, capacities, loads=None):
+    """ Spread items over bins of different capacities so that the bins end up about equally full relative to their
+    capacities. Uses the longest processing time rule: from the costliest item down, each item goes to the bin that is
+    least full after adding it.
+
+    Args:
+        costs (list of numbers): The cost of each item.
+        capacities (dict): Maps bin names to their capacities, which must be positive.
+        loads (dict): Maps bin names to the cost already in them. Bins that are not included are empty.
+
+    Returns:
+        dict: Maps each bin name to a list of the indexes of the items given to it.
+    """
+    loads = {name: (loads or {}).get(name, 0) for name in capacities}
+    shares = {name: [] for name in capacities}
+
+    for index in sorted(range(len(costs)), key=lambda index: costs[index], reverse=True):
+        cost = costs[index]
+        name = min(capacities, key=lambda name: (loads[name] + cost) / capacities[name])
+        loads[name] += cost
+        shares[name].append(index)
+
+    return shares
+
+def benchmark(controller, rounds):
+    """ Time sending status_all to every registered usersim and getting all replies back.
+
+    Returns:
+        list of float: Seconds taken by each round.
+    """
+    times = []
+    for i in range(rounds):
+        start = time.perf_counter()
+        results = controller.status_all()
+        times.append(time.perf_counter() - start)
+
+        failures = [result for result in results.values() if isinstance(result, Exception)]
+        if failures:
+            print('{} usersims failed, e.g.: {}'.format(len(failures), failures[0]))
+    return times
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark sending commands to a fleet of local usersims.')
+    parser.add_argument('--port', default=18812, type=int, help='Port to listen on.')
+    parser.add_argument('--simulators', default=100, type=int, help='Number of usersims to start.')
+    parser.add_argument('--processes', action='store_true',
+                        help='Run each usersim in its own process, instead of connecting them all from this one.')
+    parser.add_argument('--parallel', default=64, type=int, help='Most commands in flight at once.')
+    parser.add_argument('--rounds', default=20, type=int, help='Number of times to send status_all to every usersim.')
+    args = parser.parse_args()
+
+    controller = Controller(args.parallel)
+    controller.start('127.0.0.1', args.port)
+    processes = []
+
+    try:
+        for i in range(args.simulators):
+            name = 'sim-{}'.format(i)
+            if args.processes:
+                main_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'main.py')
+                processes.append(subprocess.Popen([sys.executable, main_path, 'rpc', '127.0.0.1',
+                                                   str(controller.port), name], stdout=subprocess.DEVNULL))
+            else:
+                rpc.RPCCommunication(queue.Queue(), '127.0.0.1', controller.port, name)
+
+        start = time.perf_counter()
+        controller.wait_for(args.simulators, timeout=max(60, args.simulators))
+        print('{} usersims registered in {:.2f} s.'.format(args.simulators, time.perf_counter() - start))
+
+        times = sorted(benchmark(controller, args.rounds))
+        print('status_all to all usersims: min {:.1f} ms, median {:.1f} ms, max {:.1f} ms.'.format(
+            times[0] * 1000, times[len(times) // 2] * 1000, times[-1] * 1000))
+    finally:
+        controller.close()
+        for process in processes:
+            process.kill()
+
+if __name__ == '__main__':
+    main()
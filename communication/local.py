@@ -27,6 +27,8 @@ class LocalCommunication(object):
                 continue
 
             try:
+                # Warm up in the background so that the task's first run doesn't wait for connections and the like.
+                api.prime_task(task)
                 api.new_task(task)
             except KeyError as e:
                 self._feedback_queue.put((common.api_exception_status, 'task ' + task['type'] + ' missing required key '
@@ -53,6 +55,8 @@ class LocalCommunication(object):
             print('Type: ' + task_status['type'])
             print('ID: ' + str(task_status['id']))
             print('State: ' + task_status['state'])
+            if task_status['user']:
+                print('User: ' + task_status['user'])
             if task_status['status']:
                 print('Status: ' + task_status['status'])
             if exception:
@@ -2,8 +2,16 @@
 
 """ This file handles RPC communication between this usersim instance and a server. This offers more fine-grained
 control over the usersim than any of the other communication options.
+
+Commands such as pause_task, unpause_task and stop_task, and their _all counterparts, are applied at the start of the
+next simulation cycle. Their exposed functions return True as soon as the command is queued, instead of whether it
+succeeded, e.g. whether the task ID was known. The _all functions used to return None. To get the actual results, pass
+a callback to exposed_call. See common.acknowledge.
 """
+import concurrent.futures
+import functools
 import inspect
+import json
 import platform
 import random
 import threading
@@ -13,6 +21,7 @@ import traceback
 import rpyc
 
 import api
+from communication import common
 
 class UserSimService(rpyc.Service):
     def __init__(self, *args, **kwargs):
@@ -22,11 +31,110 @@ class UserSimService(rpyc.Service):
         api_functions = inspect.getmembers(api, inspect.isfunction)
 
         for function_name, function in api_functions:
-            setattr(self.__class__, 'exposed_' + function_name, staticmethod(function))
+            # Keep the wrappers defined below.
+            if function_name not in ['new_task']:
+                setattr(self.__class__, 'exposed_' + function_name, staticmethod(_by_value(function)))
+
+    @staticmethod
+    def exposed_new_task(config, start_paused=False, reset=False, user=None):
+        """ See api.new_task. The task is primed first, so that its first run doesn't wait for connections and the
+        like.
+        """
+        return common.new_task(local_copy(config), start_paused, reset, user)
+
+    @staticmethod
+    def exposed_call(function_name, blob, callback=None):
+        """ Call an API function with its arguments and result passed by value, so that the call costs a single round
+        trip however large they are. Any other exposed function receives its arguments as references to the
+        controller's objects, which costs a round trip for every access.
+
+        Args:
+            function_name (str): One of common.serializable_functions.
+            blob (str): A JSON object with the optional keys 'args', a list of positional arguments, and 'kwargs', a
+                dict of keyword arguments.
+            callback (callable): If given, called without waiting for it to return with the function's reply once its
+                result is known, as a JSON object of either the form {"result": any} or {"error": {"type": str,
+                "message": str}}. This is how to wait for commands such as pause_task, since waiting within this call
+                would hold up every other request of the controller.
+
+        Raises:
+            ValueError: If function_name is not available or blob is not valid JSON.
+            Exception: Whatever the function raises.
+
+        Returns:
+            str: The function's result as JSON. Commands such as pause_task are acknowledged with true right away, see
+                common.acknowledge.
+        """
+        request = json.loads(blob)
+        result = common.call(function_name, request.get('args', []), request.get('kwargs', {}))
+        if callback is not None:
+            _reply_later(result, rpyc.async_(callback))
+        return json.dumps(common.acknowledge(result), separators=(',', ':'), default=str)
+
+def local_copy(value):
+    """ Copy lists and dicts that may be references to a controller's objects into local ones, so that later accesses
+    don't each cost a round trip. Other values are passed by value by rpyc already.
+
+    Args:
+        value (any): The value to copy.
+
+    Returns:
+        any: A local copy of lists and dicts, nested ones included. Other values are returned unchanged.
+    """
+    if isinstance(value, dict):
+        # Only special methods such as __iter__ and __getitem__ are allowed on references by default.
+        return {local_copy(key): local_copy(value[key]) for key in value}
+    elif isinstance(value, (list, tuple)):
+        return [local_copy(item) for item in value]
+    return value
+
+def _by_value(function):
+    """ Wrap an API function so that it works on local copies of its arguments, and acknowledges commands such as
+    pause_task instead of returning a future of their result. See local_copy and common.acknowledge.
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        args = [local_copy(arg) for arg in args]
+        kwargs = {key: local_copy(arg) for key, arg in kwargs.items()}
+        return common.acknowledge(function(*args, **kwargs))
+    return wrapper
+
+def _reply_later(value, callback):
+    """ Send a controller the result of an API function once it is known. Commands such as pause_task are resolved by
+    the simulation cycle, so the reply is sent from its thread.
+
+    Args:
+        value (any): What the function returned.
+        callback (callable): Called with the reply as JSON. See UserSimService.exposed_call.
+    """
+    if isinstance(value, concurrent.futures.Future):
+        future = value
+    else:
+        future = concurrent.futures.Future()
+        future.set_result(value)
+
+    def reply(future):
+        try:
+            message = {'result': future.result()}
+        except Exception as e:
+            message = {'error': {'type': type(e).__name__, 'message': str(e)}}
+        try:
+            callback(json.dumps(message, separators=(',', ':'), default=str))
+        except EOFError:
+            # The controller has disconnected, so there is no one to reply to.
+            pass
+
+    future.add_done_callback(reply)
+
+# Seconds to wait before reconnecting. The wait is a random fraction of a delay that starts at RECONNECT_MIN and doubles
+# after every failed attempt, up to RECONNECT_MAX.
+RECONNECT_MIN = 1
+RECONNECT_MAX = 300
 
 class RPCCommunication(object):
     def __init__(self, feedback_queue, server_addr, server_port, name):
         self._feedback_queue = feedback_queue
+        self._connection = None
         self._server_addr = server_addr
         self._server_port = server_port
         self._name = name
@@ -40,27 +148,32 @@ class RPCCommunication(object):
         feedback_thread.start()
 
     def serve_all(self):
-        while True:
-            # If we're having trouble talking to the server, give it a bit of time before trying again.
-            time.sleep(10)
+        """ Connect to the server and handle its requests as soon as they arrive. If connecting fails or the connection
+        is lost, reconnects after a delay that doubles with every failed attempt, randomized so that many usersims that
+        lost the same server don't all reconnect at the same moment.
+        """
+        delay = RECONNECT_MIN
 
+        while True:
             try:
                 self._connection = rpyc.connect(self._server_addr, self._server_port, service=UserSimService)
                 if self._name:
                     self._connection.root.register(self._name, platform.system())
             except Exception:
                 print('Exception raised on attempt to connect and register with the server.\n', traceback.format_exc())
-                continue
+            else:
+                delay = RECONNECT_MIN
+                try:
+                    # Blocks until the connection is closed.
+                    self._connection.serve_all()
+                except Exception:
+                    print('Exception raised while serving the RPC socket. Trying to reconnect.\n',
+                          traceback.format_exc())
+                finally:
+                    self._connection.close()
 
-            try:
-                while True:
-                    served = self._connection.serve(0)
-                    if not served:
-                        time.sleep(0.1)
-            except Exception:
-                print('Exception raised while polling the RPC socket. Trying to reconnect.\n', traceback.format_exc())
-            finally:
-                self._connection.close()
+            time.sleep(random.uniform(0, delay))
+            delay = min(delay * 2, RECONNECT_MAX)
 
     def _handle_communication(self):
         """ Forward feedback messages to the server.
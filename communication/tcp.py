@@ -0,0 +1,290 @@
+# Copyright 2017 Carnegie Mellon University. See LICENSE.md file for terms.
+
+""" Serves the API to controllers over plain TCP, which costs far less per call than RPC. The usersim listens, and any
+number of controllers may be connected at once, all of them handled on a single asyncio event loop.
+
+Every message is a frame: a 4-byte big-endian length, followed by that many bytes of compact JSON encoding an object.
+Controllers send requests of the following form, where args, kwargs and wait are optional:
+    {"id": int, "method": str, "args": list, "kwargs": dict, "wait": bool}
+method must be subscribe_task or one of common.serializable_functions, which are called like the api functions of the
+same name, except that new tasks are primed first. Commands such as pause_task are applied at the start of the next
+simulation cycle, so their result is true, meaning queued, unless wait is true, in which case the reply is only sent
+once they have been applied. The requests that follow are carried out in the meantime, but their replies still come
+after it. A controller may send any number of requests without waiting for replies. The requests of one connection are
+carried out in the order they were sent, and each gets one reply, in the same order:
+    {"id": int, "result": any}
+    {"id": int, "error": {"type": str, "message": str}}
+The usersim also pushes messages without an ID:
+    {"feedback": [[status, error], ...]} Feedback messages (see api.status_task and api.add_feedback), sent to every
+        connected controller. Feedback is kept until a controller is connected.
+    {"stopped": status} The final status of a task this controller subscribed to by calling subscribe_task with only a
+        task ID. It may arrive before the reply to subscribe_task if the task had already stopped.
+"""
+import asyncio
+import concurrent.futures
+import json
+import struct
+import threading
+
+import api
+from communication import common
+
+
+# Length prefix of every frame.
+HEADER = struct.Struct('!I')
+# Frames larger than this many bytes are refused, and the connection is closed.
+MAX_FRAME = 1 << 24
+# Most requests of one connection that wait at each stage: received but not yet carried out, and carried out but not
+# yet replied to. Past that, the connection isn't read from until they catch up, which slows down a fast controller
+# instead of queueing up its requests without limit.
+MAX_PENDING = 1024
+# Seconds between pushes of feedback messages.
+FEEDBACK_INTERVAL = 1
+
+def encode(message):
+    """ Frame a message.
+
+    Args:
+        message (dict): Anything JSON can encode. Other values, such as sets, are sent as strings.
+
+    Returns:
+        bytes: The frame.
+    """
+    data = json.dumps(message, separators=(',', ':'), default=str).encode()
+    return HEADER.pack(len(data)) + data
+
+async def read_frame(reader):
+    """ Read one message.
+
+    Args:
+        reader (asyncio.StreamReader): The stream to read from.
+
+    Raises:
+        ValueError: If the frame is too large or is not valid JSON.
+        asyncio.IncompleteReadError: If the connection was closed partway through a frame.
+
+    Returns:
+        dict: The message, or None if the connection was closed between frames.
+    """
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise
+        return None
+
+    length, = HEADER.unpack(header)
+    if length > MAX_FRAME:
+        raise ValueError('Refusing a frame of {} bytes.'.format(length))
+    return json.loads((await reader.readexactly(length)).decode())
+
+class TCPCommunication(object):
+    def __init__(self, feedback_queue, address, port):
+        """
+        Args:
+            feedback_queue (queue.Queue): Feedback messages to push to controllers.
+            address (str): Address to listen on.
+            port (int): Port to listen on. 0 to pick any free port.
+
+        Raises:
+            OSError: If listening failed, e.g. because the port is in use.
+        """
+        self._feedback_queue = feedback_queue
+        self._connections = set()
+        self._loop = asyncio.new_event_loop()
+        self._server = None
+        self._error = None
+        self._ready = threading.Event()
+        # The port actually listened on.
+        self.port = None
+
+        thread = threading.Thread(target=self._run, args=(address, port))
+        thread.daemon = True
+        thread.start()
+
+        self._ready.wait()
+        if self._error:
+            raise self._error
+
+    def close(self):
+        """ Stop listening, drop all connections, and stop the event loop.
+        """
+        def close():
+            self._server.close()
+            for connection in list(self._connections):
+                connection.close()
+            self._loop.stop()
+
+        self._loop.call_soon_threadsafe(close)
+
+    def _run(self, address, port):
+        """ Listen and run the event loop. Runs in its own thread.
+        """
+        asyncio.set_event_loop(self._loop)
+
+        try:
+            self._server = self._loop.run_until_complete(asyncio.start_server(self._handle_connection, address, port))
+        except OSError as e:
+            self._error = e
+            self._ready.set()
+            return
+
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._ready.set()
+
+        self._loop.create_task(self._push_feedback())
+        self._loop.run_forever()
+
+        # close() stopped the loop, so finish off whatever is still running on it.
+        pending = asyncio.all_tasks(self._loop)
+        for task in pending:
+            task.cancel()
+        self._loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        self._loop.close()
+
+    async def _handle_connection(self, reader, writer):
+        """ Read requests from a controller and queue them for _serve_requests, until the controller disconnects.
+        """
+        connection = _Connection(self._loop, writer)
+        self._connections.add(connection)
+        requests = asyncio.Queue(MAX_PENDING)
+        self._loop.create_task(self._serve_requests(connection, requests))
+
+        try:
+            while True:
+                request = await read_frame(reader)
+                if request is None:
+                    break
+                await requests.put(request)
+        except (OSError, ValueError, asyncio.IncompleteReadError):
+            # Disconnected or sent garbage, so there is no telling where the next frame starts.
+            pass
+        finally:
+            self._connections.discard(connection)
+            # Requests that were already received are still carried out.
+            await requests.put(None)
+
+    async def _serve_requests(self, connection, requests):
+        """ Carry out a controller's requests one at a time, in order, and queue their replies for _send_replies. API
+        calls may block, so they are made from the loop's executor, which leaves the loop free to serve other
+        controllers.
+        """
+        replies = asyncio.Queue(MAX_PENDING)
+        self._loop.create_task(self._send_replies(connection, replies))
+
+        while True:
+            request = await requests.get()
+            if request is None:
+                break
+
+            reply = await self._loop.run_in_executor(None, self._call, connection, request)
+            if isinstance(reply.get('result'), concurrent.futures.Future):
+                # Wait on the loop rather than in the executor, so that no thread is held up until the next cycle, and
+                # in a task of its own, so that the requests that follow are still carried out in the meantime.
+                reply = self._loop.create_task(self._wait(reply))
+            await replies.put(reply)
+
+        await replies.put(None)
+
+    async def _send_replies(self, connection, replies):
+        """ Send replies in the order of their requests, each as soon as it and those before it are ready.
+        """
+        while True:
+            reply = await replies.get()
+            if reply is None:
+                break
+
+            if isinstance(reply, asyncio.Task):
+                reply = await reply
+            connection.send(reply)
+            try:
+                await connection.drain()
+            except OSError:
+                # Keep taking replies, so that _serve_requests isn't held up, but don't send them anymore.
+                connection.close()
+
+        connection.close()
+
+    def _call(self, connection, request):
+        """ Carry out one request.
+
+        Returns:
+            dict: The reply. Its result is still a concurrent.futures.Future if the request waits for a command.
+        """
+        request_id = request.get('id') if isinstance(request, dict) else None
+
+        try:
+            if not isinstance(request, dict):
+                raise ValueError('Requests must be objects, got: {}'.format(request))
+            method = request['method']
+            args = request.get('args', [])
+            kwargs = request.get('kwargs', {})
+
+            if method == 'subscribe_task':
+                result = api.subscribe_task(*args, callback=connection.push_stopped, **kwargs)
+            else:
+                result = common.call(method, args, kwargs)
+                if not request.get('wait'):
+                    result = common.acknowledge(result)
+        except Exception as e:
+            return {'id': request_id, 'error': {'type': type(e).__name__, 'message': str(e)}}
+
+        return {'id': request_id, 'result': result}
+
+    @staticmethod
+    async def _wait(reply):
+        """ Wait for the command whose future is the result of a reply.
+
+        Returns:
+            dict: The reply with the command's result.
+        """
+        try:
+            result = await asyncio.wrap_future(reply['result'])
+        except Exception as e:
+            return {'id': reply['id'], 'error': {'type': type(e).__name__, 'message': str(e)}}
+
+        return {'id': reply['id'], 'result': result}
+
+    async def _push_feedback(self):
+        """ Periodically send feedback messages to every connected controller.
+        """
+        while True:
+            await asyncio.sleep(FEEDBACK_INTERVAL)
+            if not self._connections:
+                # Keep feedback until someone is listening.
+                continue
+
+            feedback = []
+            while not self._feedback_queue.empty():
+                feedback.append(self._feedback_queue.get())
+
+            if feedback:
+                for connection in list(self._connections):
+                    connection.send({'feedback': feedback})
+
+class _Connection(object):
+    """ Sends messages to one controller. Except for push_stopped, must only be used from the event loop's thread.
+    """
+    def __init__(self, loop, writer):
+        self._loop = loop
+        self._writer = writer
+        self._closed = False
+
+    def send(self, message):
+        if not self._closed:
+            self._writer.write(encode(message))
+
+    async def drain(self):
+        if not self._closed:
+            await self._writer.drain()
+
+    def push_stopped(self, status):
+        """ Send the final status of a subscribed task. Guaranteed thread-safe.
+        """
+        if not self._closed:
+            self._loop.call_soon_threadsafe(self.send, {'stopped': status})
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._writer.close()
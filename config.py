@@ -1,6 +1,7 @@
 # Copyright 2017 Carnegie Mellon University. See LICENSE.md file for terms.
 
 import json
+import string
 import traceback
 import xml.etree as xmltree
 
@@ -284,3 +285,23 @@ def validate(config, required_, optional_, defaults):
         type_check(config[key], optional[key])
 
     return config
+
+def has_placeholder(config):
+    """ Checks whether a configuration still contains $ placeholders, such as the $user and $password that the user task
+    fills in when it runs.
+
+    Args:
+        config (int, bool, float, str, list, or dict): Any value is valid.
+
+    Returns:
+        bool: True if any string in config, however deeply nested, contains a $placeholder or ${placeholder}.
+    """
+    if isinstance(config, str):
+        # Same syntax as string.Template, so that e.g. the $ anchors of regular expressions don't count.
+        matches = string.Template.pattern.finditer(config)
+        return any(match.group('named') or match.group('braced') for match in matches)
+    elif isinstance(config, dict):
+        return any(has_placeholder(value) for value in config.values())
+    elif isinstance(config, list):
+        return any(has_placeholder(item) for item in config)
+    return False
@@ -0,0 +1,3 @@
+# Copyright 2017 Carnegie Mellon University. See LICENSE.md file for terms.
+
+datas = [('aliceinwonderland.txt', '.')]
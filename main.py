@@ -1,6 +1,7 @@
 # Copyright 2017 Carnegie Mellon University. See LICENSE.md file for terms.
 
 import itertools
+import multiprocessing
 import sys
 import time
 import queue
@@ -37,4 +38,6 @@ def main():
             sys.stdout.write('\b')
 
 if __name__ == '__main__':
+    # Needed by worker processes in frozen builds on Windows.
+    multiprocessing.freeze_support()
     main()
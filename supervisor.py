@@ -0,0 +1,414 @@
+# Copyright 2017 Carnegie Mellon University. See LICENSE.md file for terms.
+
+""" Runs tasks in several worker processes, each with its own simulator, so that task logic is not limited to a single
+CPU core. A Supervisor takes the place of the shared simulator object in the main process, so the api module and every
+communication method work the same way as with a single simulator.
+
+Task IDs given out by the Supervisor are global: worker i of n owns the IDs i + 1, i + 1 + n, i + 1 + 2n and so on,
+which means any task ID, including those of tasks created within a worker by meta-tasks, maps back to exactly one
+worker.
+
+All tasks of a virtual user run in the same worker, which is sent the user once and keeps it, so that they share the
+user's state and random number generator as they would within a single simulator.
+"""
+import concurrent.futures
+import functools
+import itertools
+import json
+import multiprocessing
+from multiprocessing import reduction
+import queue
+import threading
+import time
+import traceback
+import weakref
+import zlib
+
+import usersim
+from usersim import States
+
+
+# Seconds between cycles of a worker's simulator, matching the pace of the main loop.
+CYCLE_INTERVAL = 1
+
+class Supervisor(object):
+    """ Forwards simulator operations to worker processes. Guaranteed thread-safe.
+    """
+    def __init__(self, workers, shard='type'):
+        """
+        Arguments:
+            workers (int): Number of worker processes to start.
+            shard (str): 'type' to send all tasks of the same type to the same worker, or 'hash' to spread tasks over
+                the workers by a hash of their whole configuration. Either way, all tasks of a virtual user go to the
+                same worker, and users are spread over the workers in turn.
+        """
+        self._shard = shard
+        # Maps the virtual users sent to workers to the IDs the workers know them by. Each user is sent to one worker.
+        self._user_ids = weakref.WeakKeyDictionary()
+        self._next_user_ids = itertools.count(1)
+        self._feedback_queue = multiprocessing.Queue()
+        # Workers report the final status of tasks with subscribers here.
+        self._stopped_queue = multiprocessing.Queue()
+        # Workers report the results of commands, such as pause_task, here once they have applied them.
+        self._results_queue = multiprocessing.Queue()
+        self._workers = []
+
+        # Maps global task IDs to lists of callbacks waiting for that task to stop.
+        self._callbacks = {}
+        self._callbacks_lock = threading.Lock()
+
+        # Maps command IDs to the future of the command's result and the number of workers yet to report it.
+        self._commands = {}
+        self._command_ids = itertools.count(1)
+
+        for index in range(workers):
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_run_worker,
+                                              args=(index, workers, worker_connection, self._feedback_queue,
+                                                    self._stopped_queue, self._results_queue))
+            process.daemon = True
+            process.start()
+            self._workers.append(_Worker(index, process, connection))
+
+    @classmethod
+    def start(cls, workers, shard='type'):
+        """ Start a Supervisor and make it the shared simulator used by the api module.
+
+        Arguments:
+            workers (int): See __init__.
+            shard (str): See __init__.
+
+        Returns:
+            Supervisor: The new shared simulator.
+        """
+        supervisor = cls(workers, shard)
+        usersim.UserSim.replace(supervisor)
+        return supervisor
+
+    def shutdown(self):
+        """ Terminate all worker processes.
+        """
+        for worker in self._workers:
+            worker.process.terminate()
+            worker.process.join()
+
+    def cycle(self):
+        """ Collect feedback from the workers, which cycle on their own, call the callbacks of tasks that stopped, and
+        resolve the futures of commands that the workers have applied.
+
+        Returns:
+            list of tuples: See usersim._UserSim.cycle.
+        """
+        feedback = []
+        while True:
+            try:
+                feedback.append(self._feedback_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        while True:
+            try:
+                status = self._stopped_queue.get_nowait()
+            except queue.Empty:
+                break
+            with self._callbacks_lock:
+                callbacks = self._callbacks.pop(status['id'], [])
+            for callback in callbacks:
+                try:
+                    callback(dict(status))
+                except Exception:
+                    feedback.append((status, 'Exception in a stop callback:\n\n' + traceback.format_exc()))
+
+        while True:
+            try:
+                command_id, result, error = self._results_queue.get_nowait()
+            except queue.Empty:
+                break
+            with self._callbacks_lock:
+                future, remaining = self._commands[command_id]
+                if remaining > 1:
+                    self._commands[command_id] = (future, remaining - 1)
+                    continue
+                del self._commands[command_id]
+            if error:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+        for worker in self._workers:
+            if not worker.process.is_alive() and not worker.reported:
+                worker.reported = True
+                status = {'id': 0,
+                          'type': 'supervisor',
+                          'state': States.UNKNOWN,
+                          'status': '',
+                          'user': ''}
+                feedback.append((status, 'Worker {} exited with code {}.'.format(worker.index,
+                                                                                  worker.process.exitcode)))
+
+        return feedback
+
+    def new_task(self, task_class, task_config, start_paused=False, user=None, timeout=None):
+        """ Send a task to the worker chosen by the sharding policy, or to its virtual user's worker. See
+        usersim._UserSim.new_task.
+        """
+        task_type = _type_name(task_class)
+        if user is None:
+            worker = self._choose(task_type, task_config)
+            return worker.call('new_task', task_type, task_config, start_paused, None, timeout)
+
+        with self._callbacks_lock:
+            user_id = self._user_ids.get(user)
+            if user_id is None:
+                user_id = self._user_ids[user] = next(self._next_user_ids)
+        worker = self._workers[(user_id - 1) % len(self._workers)]
+
+        with worker.lock:
+            # Only the first task of the user sends the user itself. Checked under the worker's lock, so that no task
+            # refers to the user before it has been sent.
+            user_ref = (user_id, None if user_id in worker.users else user)
+            worker.connection.send(('new_task', (task_type, task_config, start_paused, user_ref, timeout)))
+            worker.users.add(user_id)
+            return worker.receive()
+
+    def prime_task(self, primes):
+        """ Prime tasks within the worker the first task will be sent to, which also runs the tasks it creates. See
+        usersim._UserSim.prime_task.
+        """
+        primes = [(_type_name(task_class), task_config) for task_class, task_config in primes]
+        worker = self._choose(*primes[0])
+
+        worker.call('prime_task', primes)
+
+    def pause_all(self):
+        return self._command('pause_all')
+
+    def pause_task(self, task_id):
+        return self._command('pause_task', task_id)
+
+    def status_all(self):
+        status_list = []
+        for result in self._broadcast('status_all'):
+            status_list.extend(result)
+        return sorted(status_list, key=lambda status: status['id'])
+
+    def status_task(self, task_id):
+        return self._owner(task_id).call('status_task', task_id)
+
+    def stop_all(self):
+        return self._command('stop_all')
+
+    def stop_task(self, task_id):
+        return self._command('stop_task', task_id)
+
+    def unpause_all(self):
+        return self._command('unpause_all')
+
+    def unpause_task(self, task_id):
+        return self._command('unpause_task', task_id)
+
+    def subscribe_task(self, task_id, callback):
+        """ Subscribe to a task's worker, which reports back when the task stops. The callback is called from cycle.
+        See usersim._UserSim.subscribe_task.
+        """
+        if task_id < 1:
+            return False
+
+        with self._callbacks_lock:
+            if task_id in self._callbacks:
+                self._callbacks[task_id].append(callback)
+                return True
+            self._callbacks[task_id] = [callback]
+
+        # Only the first subscriber needs to subscribe within the worker.
+        if not self._owner(task_id).call('subscribe_task', task_id):
+            with self._callbacks_lock:
+                del self._callbacks[task_id]
+            return False
+        return True
+
+    def add_feedback(self, task_id, error):
+        if task_id < 1:
+            return
+        self._owner(task_id).call('add_feedback', task_id, error)
+
+    def _choose(self, task_type, task_config):
+        """ The worker the sharding policy sends the given task to.
+        """
+        if self._shard == 'hash':
+            key = json.dumps([task_type, task_config], sort_keys=True, default=str)
+        else:
+            key = task_type
+        return self._workers[zlib.crc32(key.encode()) % len(self._workers)]
+
+    def _command(self, method, *args):
+        """ Queue a command within the workers it concerns: all of them for methods ending in _all, or else the owner of
+        the task ID in args. The workers report its result once they have applied it, and the future resolves at the
+        first cycle after all of them have. See usersim._UserSim.pause_task and the like.
+
+        Returns:
+            concurrent.futures.Future: Resolves to the command's result within the last worker to report it.
+        """
+        broadcast = method.endswith('_all')
+        future = concurrent.futures.Future()
+        with self._callbacks_lock:
+            command_id = next(self._command_ids)
+            self._commands[command_id] = (future, len(self._workers) if broadcast else 1)
+
+        if broadcast:
+            self._broadcast('command', command_id, method, args)
+        else:
+            self._owner(args[0]).call('command', command_id, method, args)
+        return future
+
+    def _owner(self, task_id):
+        """ The worker that owns the given global task ID.
+        """
+        assert task_id > 0
+        return self._workers[(task_id - 1) % len(self._workers)]
+
+    def _broadcast(self, method, *args):
+        """ Call a method on all workers at once.
+
+        Returns:
+            list: The results from each worker, in worker order.
+        """
+        for worker in self._workers:
+            worker.lock.acquire()
+        try:
+            # Send everything first so that the workers handle the request in parallel.
+            for worker in self._workers:
+                worker.connection.send((method, args))
+            return [worker.receive() for worker in self._workers]
+        finally:
+            for worker in self._workers:
+                worker.lock.release()
+
+class _Worker(object):
+    """ The Supervisor's handle on one worker process.
+    """
+    def __init__(self, index, process, connection):
+        self.index = index
+        self.process = process
+        self.connection = connection
+        # One request may be in flight per worker at a time.
+        self.lock = threading.Lock()
+        self.reported = False
+        # IDs of the virtual users sent to the worker. See Supervisor.new_task.
+        self.users = set()
+
+    def call(self, method, *args):
+        """ Call a simulator method within the worker and wait for its result.
+
+        Raises:
+            Exception: Whatever the method raised within the worker.
+        """
+        with self.lock:
+            self.connection.send((method, args))
+            return self.receive()
+
+    def receive(self):
+        result, error = self.connection.recv()
+        if error:
+            raise error
+        return result
+
+def _type_name(task_class):
+    """ The name tasks.task_dict knows a task class by.
+    """
+    return task_class.__module__.split('.')[-1]
+
+def _run_worker(index, workers, connection, feedback_queue, stopped_queue, results_queue):
+    """ Entry point of a worker process. Cycles a simulator of its own, while a thread serves requests from the
+    Supervisor.
+
+    Arguments:
+        index (int): This worker's index.
+        workers (int): The total number of workers.
+        connection (multiprocessing.Connection): Receives requests from the Supervisor and sends back results.
+        feedback_queue (multiprocessing.Queue): Shared by all workers to send feedback to the Supervisor.
+        stopped_queue (multiprocessing.Queue): Shared by all workers to send the final status of subscribed tasks.
+        results_queue (multiprocessing.Queue): Shared by all workers to send the results of commands.
+    """
+    import tasks
+
+    sim = usersim.UserSim(True)
+    # Maps user IDs to the virtual users the Supervisor has sent. See Supervisor.new_task.
+    users = {}
+
+    def to_global(task_id):
+        return (task_id - 1) * workers + index + 1
+
+    def to_local(task_id):
+        return (task_id - 1) // workers + 1
+
+    def globalize(status):
+        status = dict(status)
+        status['id'] = to_global(status['id']) if status['id'] > 0 else status['id']
+        return status
+
+    def report(command_id, future):
+        error = future.exception()
+        message = (command_id, None if error else future.result(), error)
+        try:
+            # Queues pickle in a background thread, which drops what it can't pickle without telling anyone. The
+            # Supervisor would then wait for the result forever, so check here first.
+            reduction.ForkingPickler.dumps(message)
+        except Exception:
+            message = (command_id, None, RuntimeError(traceback.format_exc()))
+        results_queue.put(message)
+
+    def handle(method, args):
+        if method == 'command':
+            command_id, method, args = args
+            future = handle(method, args)
+            future.add_done_callback(functools.partial(report, command_id))
+        elif method == 'new_task':
+            task_type, task_config, start_paused, user, timeout = args
+            if user is not None:
+                user_id, user = user
+                user = users.setdefault(user_id, user)
+            return to_global(sim.new_task(tasks.task_dict[task_type], task_config, start_paused, user, timeout))
+        elif method == 'prime_task':
+            return sim.prime_task([(tasks.task_dict[task_type], task_config) for task_type, task_config in args[0]])
+        elif method == 'status_all':
+            return [globalize(status) for status in sim.status_all()]
+        elif method == 'status_task':
+            return globalize(sim.status_task(to_local(args[0])))
+        elif method == 'subscribe_task':
+            return sim.subscribe_task(to_local(args[0]), lambda status: stopped_queue.put(globalize(status)))
+        elif method.endswith('_all'):
+            return getattr(sim, method)()
+        else:
+            task_id, *rest = args
+            return getattr(sim, method)(to_local(task_id), *rest)
+
+    def reply(result, error):
+        try:
+            connection.send((result, error))
+        except Exception:
+            # Nothing is sent if the result or error can't be pickled, so send that error instead. Otherwise the
+            # Supervisor would wait for a reply forever.
+            connection.send((None, RuntimeError(traceback.format_exc())))
+
+    def serve():
+        while True:
+            method, args = connection.recv()
+            try:
+                result = handle(method, args)
+            except Exception as e:
+                reply(None, e)
+            else:
+                reply(result, None)
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+
+    while True:
+        try:
+            for status, error in sim.cycle():
+                feedback_queue.put((globalize(status), error))
+        except Exception:
+            print('Exception raised while cycling worker {}.\n'.format(index), traceback.format_exc())
+        time.sleep(CYCLE_INTERVAL)
@@ -11,7 +11,7 @@ loaded = []
 task_dict = {}
 
 py_files = os.listdir(os.path.dirname(__file__))
-special_modules = ['__init__.py', 'task.py']
+special_modules = ['__init__.py', 'task.py', 'broker.py', 'payload.py']
 
 def get_matching_class(module_name, loaded_module):
     for class_name, class_obj in inspect.getmembers(loaded_module, inspect.isclass):
@@ -12,34 +12,31 @@ class All(sequence.Sequence):
         self._tasks = config['tasks']
         self._task_ids = set()
         self._stopped_task_ids = set()
-        self._done = False
         self._started = False
 
     def __call__(self):
         if not self._started:
-            for task in self._tasks:
-                task_id = api.new_task(task)
-                self._task_ids.add(task_id)
+            self._start_tasks()
             self._started = True
 
+    def _start_tasks(self):
+        """ Start all nested tasks.
+        """
+        for task in self._tasks:
+            self._track(api.new_task(task))
 
-        self._stopped_task_ids = set()
-        for task_id in self._task_ids:
-            # Check that all nested tasks have stopped.
-            if api.status_task(task_id)['state'] == api.States.STOPPED:
-                # Would do self._task_ids.remove here, but we can't modify the data structure while iterating over it.
-                self._stopped_task_ids.add(task_id)
-            else:
-                break
-        else:
-            # Since they are uncommon, the else part of a for-else executes when the for loop completes without a break.
-            self._done = True
-
-        # No point repeating work that's already been completed.
-        self._task_ids = self._task_ids - self._stopped_task_ids
+    def _track(self, task_id):
+        """ Wait for a nested task to stop before letting this one stop.
+        """
+        self._task_ids.add(task_id)
+        api.subscribe_task(task_id, self._task_stopped)
+
+    def _task_stopped(self, status):
+        self._task_ids.discard(status['id'])
+        self._stopped_task_ids.add(status['id'])
 
     def stop(self):
-        return self._done
+        return self._started and not self._task_ids
 
     def status(self):
         return 'Tasks with IDs {} have finished.'.format(self._stopped_task_ids)
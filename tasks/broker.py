@@ -0,0 +1,346 @@
+# Copyright 2017 Carnegie Mellon University. See LICENSE.md file for terms.
+
+""" Shares expensive sessions, such as logged in network connections, between tasks. Each kind of session has a Pool,
+whose sessions are kept per key (e.g. server, port and user). A task leases a session, uses it, and returns it so that
+later tasks with the same key can reuse it.
+"""
+import contextlib
+import functools
+import hashlib
+import os
+import socket
+import threading
+import time
+import weakref
+
+
+# Seconds between sweeps of the reaper thread, which closes sessions idle past their pool's timeout even if nothing uses
+# the pool any more.
+REAP_INTERVAL = 30
+
+# Maps pool names to all pools created with register.
+_pools = {}
+_pools_lock = threading.Lock()
+
+# Pools with idle sessions that the reaper thread sweeps, and the ID of the process it was started in. A forked process
+# has no reaper until it starts one of its own.
+_reaped = weakref.WeakSet()
+_reaper_pid = None
+_reaper_lock = threading.Lock()
+
+class Pool(object):
+    """ Idle sessions kept per key, with a limit on the number of sessions per key, health checks before reusing
+    sessions that have been idle for a while, and closing of sessions that have been idle for too long. Guaranteed
+    thread-safe.
+    """
+    def __init__(self, name, close, check=None, max_per_key=0, check_after=15, idle_timeout=120, lease_timeout=60,
+                 abort=None):
+        """
+        Args:
+            name (str): Name of the pool, used in metrics.
+            close (callable): Takes a session and closes it. Must not raise.
+            check (callable): Takes a session and returns whether it is still usable. May raise instead of returning
+                False. None to skip health checks.
+            max_per_key (int): Maximum number of sessions per key, leased or idle. 0 for no limit.
+            check_after (number): Seconds a session may be idle before it is checked before reuse.
+            idle_timeout (number): Seconds a session may be idle before it is closed.
+            lease_timeout (number): Seconds to wait for a session if a key is at its limit.
+            abort (callable): Takes a session that another thread may be blocked on and closes it at once, without
+                waiting for the server, e.g. with shutdown_socket. Used when a session's task is cancelled. Must not
+                raise. Defaults to close.
+        """
+        self.name = name
+        self._close = close
+        self._abort = abort or close
+        self._check = check
+        self._max_per_key = max_per_key
+        self._check_after = check_after
+        self._idle_timeout = idle_timeout
+        self._lease_timeout = lease_timeout
+
+        # Maps keys to lists of (session, time returned) tuples, most recently returned last.
+        self._idle = {}
+        # Maps keys to the number of sessions that exist for it, leased or idle.
+        self._counts = {}
+        self._condition = threading.Condition()
+        self._metrics = {'created': 0, 'reused': 0, 'discarded': 0, 'evicted': 0, 'failed_checks': 0}
+        self._reaper_pid = None
+
+    def lease(self, key, connect):
+        """ Take an idle session for key, or make a new one. Waits if the key is at its limit.
+
+        Args:
+            key (hashable): Identifies interchangeable sessions.
+            connect (callable): Takes no arguments and returns a new session for key.
+
+        Raises:
+            TimeoutError: If no session became available within the lease timeout.
+            Exception: Whatever connect raises.
+
+        Returns:
+            any: The session. Must be given back with release.
+        """
+        deadline = time.time() + self._lease_timeout
+
+        while True:
+            session = None
+            with self._condition:
+                expired = self._evict()
+                while not self._idle.get(key) and self._max_per_key and \
+                        self._counts.get(key, 0) >= self._max_per_key:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise TimeoutError('No {} session for {} became available.'.format(self.name, key))
+                    self._condition.wait(remaining)
+                if self._idle.get(key):
+                    session, returned = self._idle[key].pop()
+                else:
+                    # Reserve a place for the new session before connecting, so the limit holds while connecting.
+                    self._counts[key] = self._counts.get(key, 0) + 1
+
+            # Closing and checking can talk to the server, so they are done without holding the lock.
+            for expired_key, expired_session in expired:
+                self._close(expired_session)
+
+            if session is None:
+                try:
+                    session = connect()
+                except Exception:
+                    self._forget(key)
+                    raise
+                self._count('created')
+                return session
+
+            if not self._check or time.time() - returned < self._check_after or self._healthy(session):
+                self._count('reused')
+                return session
+
+            self._count('failed_checks')
+            self._close(session)
+            self._forget(key)
+
+    def release(self, key, session, reuse=True):
+        """ Give back a leased session.
+
+        Args:
+            key (hashable): The key the session was leased with.
+            session (any): The session.
+            reuse (bool): Whether the session is still usable. If not, it is closed.
+        """
+        if reuse:
+            with self._condition:
+                self._idle.setdefault(key, []).append((session, time.time()))
+                self._condition.notify()
+            if self._reaper_pid != os.getpid():
+                self._reaper_pid = os.getpid()
+                _reap_later(self)
+        else:
+            self._count('discarded')
+            self._close(session)
+            self._forget(key)
+        self.reap()
+
+    def prime(self, key, connect):
+        """ Make a session for key ahead of time and leave it idle, so that the first lease doesn't wait for connect.
+        Does nothing if key already has an idle session or is at its limit.
+
+        Args:
+            key (hashable): See lease.
+            connect (callable): See lease.
+
+        Raises:
+            Exception: Whatever connect raises.
+        """
+        with self._condition:
+            if self._idle.get(key) or self._max_per_key and self._counts.get(key, 0) >= self._max_per_key:
+                return
+        self.release(key, self.lease(key, connect))
+
+    @contextlib.contextmanager
+    def session(self, key, connect, reusable_errors=(), cancel_token=None):
+        """ Lease a session for the duration of a with block. The session is returned to the pool if the block
+        completes or raises one of reusable_errors, and closed otherwise.
+
+        Args:
+            key (hashable): See lease.
+            connect (callable): See lease.
+            reusable_errors (tuple of exception classes): Errors that leave the session usable, e.g. a missing file.
+            cancel_token (usersim.CancelToken): If given, the session is closed as soon as the token is cancelled, so
+                that the block fails right away instead of finishing its work, and it is not returned to the pool.
+
+        Raises:
+            usersim.Cancelled: If cancel_token has already been cancelled.
+        """
+        if cancel_token is None:
+            closing = contextlib.nullcontext
+        else:
+            cancel_token.check()
+            closing = functools.partial(cancel_token.closing, lambda: self._abort(session))
+
+        session = self.lease(key, connect)
+        try:
+            with closing():
+                yield session
+        except reusable_errors:
+            self.release(key, session, not (cancel_token and cancel_token.cancelled))
+            raise
+        except BaseException:
+            self.release(key, session, False)
+            raise
+        self.release(key, session, not (cancel_token and cancel_token.cancelled))
+
+    def clear(self):
+        """ Close all idle sessions.
+        """
+        with self._condition:
+            idle = self._idle
+            self._idle = {}
+            for key, entries in idle.items():
+                self._counts[key] -= len(entries)
+            self._condition.notify_all()
+
+        for entries in idle.values():
+            for session, returned in entries:
+                self._close(session)
+
+    def reap(self):
+        """ Close sessions that have been idle for longer than the idle timeout. Happens whenever a session is leased or
+        released and when the metrics are read, and every REAP_INTERVAL seconds in a background thread.
+        """
+        with self._condition:
+            expired = self._evict()
+
+        for key, session in expired:
+            self._close(session)
+
+    def metrics(self):
+        """ Counters describing the pool's use. Closes expired sessions first, so that they don't count as idle.
+
+        Returns:
+            dict: With the following key:value pairs:
+                'created':int Sessions made.
+                'reused':int Leases served by an idle session.
+                'discarded':int Sessions closed because they were returned as unusable.
+                'evicted':int Sessions closed because they were idle for too long.
+                'failed_checks':int Sessions closed because they failed a health check.
+                'leased':int Sessions currently leased.
+                'idle':int Sessions currently idle.
+        """
+        self.reap()
+        with self._condition:
+            metrics = dict(self._metrics)
+            idle = sum(len(entries) for entries in self._idle.values())
+            metrics['idle'] = idle
+            metrics['leased'] = sum(self._counts.values()) - idle
+        return metrics
+
+    def _healthy(self, session):
+        try:
+            return bool(self._check(session))
+        except Exception:
+            return False
+
+    def _evict(self):
+        """ Remove sessions that have been idle for too long. Must be called while holding the lock.
+
+        Returns:
+            list of tuples: (key, session) for each removed session, to be closed once the lock is released.
+        """
+        now = time.time()
+        expired = []
+
+        for key, entries in self._idle.items():
+            while entries and now - entries[0][1] > self._idle_timeout:
+                session, returned = entries.pop(0)
+                expired.append((key, session))
+                self._counts[key] -= 1
+
+        if expired:
+            self._metrics['evicted'] += len(expired)
+            self._condition.notify_all()
+        return expired
+
+    def _forget(self, key):
+        """ Free the place of a session that no longer exists.
+        """
+        with self._condition:
+            self._counts[key] -= 1
+            self._condition.notify()
+
+    def _count(self, metric):
+        with self._condition:
+            self._metrics[metric] += 1
+
+def shutdown_socket(sock):
+    """ Shut down a socket in both directions, so that reads and writes blocked on it in other threads fail right away,
+    which closing it alone doesn't do. Errors, e.g. because it's already closed, are ignored.
+
+    Args:
+        sock (socket.socket): The socket, or None.
+    """
+    if sock is None:
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+def digest(secret):
+    """ Stand-in for a secret, such as a password, in keys. Sessions logged in with different passwords must not be
+    shared, but keys show up in error messages and stay in memory, so they shouldn't hold the password itself.
+
+    Args:
+        secret (str): The secret.
+
+    Returns:
+        str: The SHA-256 digest of secret, in hexadecimal.
+    """
+    return hashlib.sha256(secret.encode()).hexdigest()
+
+def register(pool):
+    """ Make a pool's metrics available through metrics.
+
+    Args:
+        pool (Pool): The pool.
+
+    Returns:
+        Pool: The same pool.
+    """
+    with _pools_lock:
+        _pools[pool.name] = pool
+    return pool
+
+def metrics():
+    """ The metrics of every registered pool.
+
+    Returns:
+        dict: Maps pool names to the dicts returned by Pool.metrics.
+    """
+    with _pools_lock:
+        pools = list(_pools.values())
+    return {pool.name: pool.metrics() for pool in pools}
+
+def _reap_later(pool):
+    """ Have the reaper thread of this process sweep pool, starting the thread if there is none yet.
+    """
+    global _reaper_pid
+
+    with _reaper_lock:
+        _reaped.add(pool)
+        if _reaper_pid == os.getpid():
+            return
+        _reaper_pid = os.getpid()
+
+    thread = threading.Thread(target=_reap, name='SessionReaper')
+    thread.daemon = True
+    thread.start()
+
+def _reap():
+    """ Target of the reaper thread.
+    """
+    while True:
+        time.sleep(REAP_INTERVAL)
+        with _reaper_lock:
+            pools = list(_reaped)
+        for pool in pools:
+            pool.reap()
@@ -1,6 +1,5 @@
 # Copyright 2017 Carnegie Mellon University. See LICENSE.md file for terms.
 
-import random
 import re
 
 import api
@@ -36,7 +35,7 @@ class Browser(task.Task):
             for site in self._sites:
                 self._driver.get(site, self._task_id, self._delay)
         else:
-            self._driver.get(random.choice(self._sites), self._task_id, self._delay)
+            self._driver.get(self.random.choice(self._sites), self._task_id, self._delay)
 
     def cleanup(self):
         pass
@@ -0,0 +1,145 @@
+# Copyright 2017 Carnegie Mellon University. See LICENSE.md file for terms.
+
+import functools
+
+import api
+from tasks import task
+
+
+class DAG(task.Task):
+    """ Runs nested tasks as a dependency graph. Each node's task is started as soon as every node it depends on has
+    stopped, so independent branches run in parallel. Completion is reported through api.subscribe_task rather than by
+    polling the status of each node. This task is stopped once all nodes have stopped.
+    """
+    def __init__(self, config):
+        self._nodes = config['nodes']
+        dependencies = config['dependencies']
+
+        # The nodes each node is still waiting on, and the nodes waiting on each node.
+        self._waiting_on = {name: set(dependencies.get(name, [])) for name in self._nodes}
+        self._dependents = {name: [] for name in self._nodes}
+        for name, required in dependencies.items():
+            for dependency in required:
+                self._dependents[dependency].append(name)
+
+        self._running = {}
+        self._finished = []
+        self._started = False
+
+    def __call__(self):
+        if not self._started:
+            self._started = True
+            for name, waiting_on in self._waiting_on.items():
+                if not waiting_on:
+                    self._start_node(name)
+
+    def _start_node(self, name):
+        """ Start the task of the given node and get notified when it stops.
+        """
+        task_id = api.new_task(self._nodes[name])
+        self._running[name] = task_id
+        api.subscribe_task(task_id, functools.partial(self._node_stopped, name))
+
+    def _node_stopped(self, name, status):
+        """ Start every node that was only waiting on the given node.
+        """
+        del self._running[name]
+        self._finished.append(name)
+
+        # Don't start new branches once this task has been stopped. The token is cancelled as soon as it is, while its
+        # cleanup may only run later.
+        if self.cancel_token.cancelled:
+            return
+
+        for dependent in self._dependents[name]:
+            self._waiting_on[dependent].discard(name)
+            if not self._waiting_on[dependent]:
+                self._start_node(dependent)
+
+    def stop(self):
+        return len(self._finished) == len(self._nodes)
+
+    def status(self):
+        return 'Finished nodes: {}. Running nodes: {}.'.format(', '.join(self._finished),
+                                                               ', '.join(sorted(self._running)))
+
+    def cleanup(self):
+        pass
+
+    @classmethod
+    def parameters(cls):
+        """ Returns a dictionary with the required and optional parameters of the class, with human-readable
+        descriptions for each.
+
+        Returns:
+            dict of dicts: A dictionary whose keys are 'required' and 'optional', and whose values are dictionaries
+                containing the required and optional parameters of the class as keys and human-readable (str)
+                descriptions and requirements for each key as values.
+        """
+        required = {'nodes': '{str: task}| Maps the name of each node to the task it runs.'}
+        optional = {'dependencies': '{str: [str]}| Maps the name of a node to the names of the nodes that must stop '
+                                    'before it starts. Nodes that are not listed start right away. Default is no '
+                                    'dependencies, which runs all nodes in parallel.'}
+
+        return {'required': required, 'optional': optional}
+
+    @classmethod
+    def validate(cls, config):
+        """ Validates the given configuration dictionary.
+
+        Args:
+            config (dict): The dictionary to validate. See parameters() for required format.
+
+        Raises:
+            KeyError: If a required configuration option is missing. The error message is the missing key.
+            ValueError: If a configuration option's value is not valid. The error message is in the following format:
+                key: value requirement
+
+        Returns:
+            dict: The dict given as the config argument with missing optional parameters added with default values.
+        """
+        config = api.check_config(config, cls.parameters(), {'dependencies': {}})
+
+        nodes = config['nodes']
+        dependencies = config['dependencies']
+
+        if not nodes:
+            raise ValueError('nodes: {} Must contain at least one node.'.format(nodes))
+
+        for name, required in dependencies.items():
+            if name not in nodes:
+                raise ValueError('dependencies: {} Not a node.'.format(name))
+            for dependency in required:
+                if dependency not in nodes:
+                    raise ValueError('dependencies: {} Not a node.'.format(dependency))
+
+        stuck = find_cycle(nodes, dependencies)
+        if stuck:
+            raise ValueError('dependencies: {} Must not contain cycles, but these nodes can never '
+                             'start: {}'.format(dependencies, ', '.join(sorted(stuck))))
+
+        return config
+
+def find_cycle(nodes, dependencies):
+    """ Find the nodes that can never start because they depend on each other, using Kahn's algorithm.
+
+    Args:
+        nodes (iterable of str): The names of all nodes.
+        dependencies (dict): Maps a node name to the list of node names it depends on.
+
+    Returns:
+        set of str: The nodes that are part of or depend on a cycle. Empty if the graph is acyclic.
+    """
+    waiting_on = {name: set(dependencies.get(name, [])) for name in nodes}
+    ready = [name for name, required in waiting_on.items() if not required]
+
+    while ready:
+        done = ready.pop()
+        del waiting_on[done]
+        for name, required in waiting_on.items():
+            if done in required:
+                required.remove(done)
+                if not required:
+                    ready.append(name)
+
+    return set(waiting_on)
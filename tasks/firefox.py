@@ -26,18 +26,22 @@ class SharedDriver(object):
     """
     _driver = None
     _action_queue = None
+    # Firefox tasks may be primed from other threads while the first one is being constructed.
+    _lock = threading.Lock()
 
     def __new__(cls):
         """ Creates a new instance only if _action_queue does not already exist. Starts the threaded action_executor
         which perpetually listens for new actions to execute.
         """
-        if not cls._action_queue:
-            cls._action_queue = queue.Queue()
-            cls._make_driver()
+        with cls._lock:
+            if not cls._action_queue:
+                # Make the driver first, so that if starting the browser fails, the next instance tries again.
+                cls._make_driver()
+                cls._action_queue = queue.Queue()
 
-            t = threading.Thread(target=cls._action_executor)
-            t.daemon = True
-            t.start()
+                t = threading.Thread(target=cls._action_executor)
+                t.daemon = True
+                t.start()
 
         return cls
 
@@ -139,6 +143,14 @@ class SharedDriver(object):
 class Firefox(browser.Browser):
     """ Connects to specified websites using Firefox. Subsequent website visits will use the same window and tab.
     """
+    parallel_init = True
+
     def __init__(self, config):
         super().__init__(config)
         self._driver = SharedDriver()
+
+    @classmethod
+    def prime(cls, config):
+        """ Start the shared browser ahead of time, since starting it takes several seconds.
+        """
+        SharedDriver()
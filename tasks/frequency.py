@@ -1,5 +1,8 @@
 # Copyright 2017 Carnegie Mellon University. See LICENSE.md file for terms.
 
+import bisect
+import datetime
+import math
 import random
 import time
 
@@ -7,30 +10,145 @@ import api
 from tasks import task
 
 
+DAY = 86400
+WEEK = 7 * DAY
+# Most triggers a Frequency task catches up on in one run. Arrivals missed beyond that, e.g. while the host was
+# suspended, are dropped instead of being launched in a burst.
+MAX_CATCH_UP = 10
+
+class RateCurve(object):
+    """ A periodic trigger rate, either stepped or linearly interpolated between points. The expected number of triggers
+    accumulated over the period is precomputed once, so finding the next arrival of the (possibly non-homogeneous)
+    Poisson process only costs a binary search instead of any per-cycle work.
+    """
+    def __init__(self, points, period=DAY, interpolate=False):
+        """
+        Args:
+            points (list of tuples): (offset, rate) pairs, where offset is the number of seconds into the period at
+                which the rate (triggers per second) applies. At least one rate must be positive.
+            period (int): Length of the period in seconds, either DAY or WEEK.
+            interpolate (bool): If False, each rate holds until the next offset, wrapping around the end of the period.
+                If True, the rate changes linearly from each point to the next one instead.
+        """
+        points = sorted(points)
+        first_offset, first_rate = points[0]
+        last_offset, last_rate = points[-1]
+
+        if interpolate:
+            # The rate at the period boundary lies on the line between the last point and the first point of the
+            # next period.
+            gap = first_offset + period - last_offset
+            edge_rate = last_rate + (first_rate - last_rate) * (period - last_offset) / gap
+        else:
+            # The rate before the first offset is the one carried over from the end of the previous period.
+            edge_rate = last_rate
+
+        if first_offset > 0:
+            points.insert(0, (0, edge_rate))
+
+        self._period = period
+        self._starts = [offset for offset, rate in points]
+        self._rates = [rate for offset, rate in points]
+
+        ends = self._starts[1:] + [period]
+        if interpolate:
+            end_rates = self._rates[1:] + [edge_rate]
+            self._slopes = [(end_rate - rate) / (end - start)
+                            for start, end, rate, end_rate in zip(self._starts, ends, self._rates, end_rates)]
+        else:
+            end_rates = self._rates
+            self._slopes = [0] * len(self._rates)
+
+        self._cumulative = [0.0]
+        for start, end, rate, end_rate in zip(self._starts, ends, self._rates, end_rates):
+            self._cumulative.append(self._cumulative[-1] + (rate + end_rate) / 2 * (end - start))
+        self._total = self._cumulative[-1]
+
+    def next_arrival(self, after, generator=random):
+        """ Draw the time of the next arrival by inverting the cumulative rate.
+
+        Args:
+            after (float): A timestamp, as returned by time.time(), to draw the next arrival after.
+            generator (random.Random): Random number generator to draw from. Defaults to the random module's own.
+
+        Returns:
+            float: The timestamp of the next arrival.
+        """
+        offset = self._offset(after)
+        start = after - offset
+
+        area = self._area(offset) + generator.expovariate(1.0)
+        periods, area = divmod(area, self._total)
+
+        return start + periods * self._period + self._invert(area)
+
+    def _offset(self, timestamp):
+        """ Seconds elapsed since the beginning of the period containing timestamp, in local time.
+        """
+        local = time.localtime(timestamp)
+        offset = local.tm_hour * 3600 + local.tm_min * 60 + local.tm_sec + timestamp % 1
+        if self._period == WEEK:
+            # tm_wday counts from Monday.
+            offset += local.tm_wday * DAY
+        return offset
+
+    def _area(self, offset):
+        """ Expected number of arrivals between the beginning of the period and offset.
+        """
+        i = bisect.bisect_right(self._starts, offset) - 1
+        elapsed = offset - self._starts[i]
+        return self._cumulative[i] + self._rates[i] * elapsed + self._slopes[i] * elapsed ** 2 / 2
+
+    def _invert(self, area):
+        """ The offset into the period at which the expected number of arrivals reaches area.
+        """
+        # bisect_right skips over segments without any arrivals, since they do not add to the cumulative total.
+        i = min(bisect.bisect_right(self._cumulative, area) - 1, len(self._rates) - 1)
+        remaining = area - self._cumulative[i]
+        if remaining <= 0:
+            return self._starts[i]
+
+        # Solves rate * x + slope * x^2 / 2 = remaining for x, in a form that stays stable when the slope is zero.
+        rate = self._rates[i]
+        root = math.sqrt(max(rate ** 2 + 2 * self._slopes[i] * remaining, 0))
+        return self._starts[i] + 2 * remaining / (rate + root)
+
 class Frequency(task.Task):
-    """ Schedules the nested task an average of frequency times per hour. There is no hard upper limit, but some tasks
-    at a high frequency will run the CPU at 100% (generally, ones that interact with external programs).
+    """ Schedules the nested task an average of frequency times per hour. Trigger times are drawn from a Poisson
+    process, so several triggers may happen within the same cycle when the frequency is high. There is no hard upper
+    limit, but some tasks at a high frequency will run the CPU at 100% (generally, ones that interact with external
+    programs).
     """
     def __init__(self, config):
         freq = config['frequency']
         reps = config['repetitions']
         task = config['task']
+        profile = config['profile'] or {'0000': 1}
 
-        self._time_per_trigger = 3600 / freq
+        points = [(seconds_of_day(key), freq * multiplier / 3600) for key, multiplier in profile.items()]
+
+        self._curve = RateCurve(points)
         self._reps = reps
         self._triggered = 0
         self._task = task
-        self._last_check = time.time()
+        # Drawn on the first run, once the scheduler has given the task its user's random number generator.
+        self._next_trigger = None
 
     def __call__(self):
         now = time.time()
-        slept = now - self._last_check
-        self._last_check = now
-
-        trigger_probability = slept / self._time_per_trigger
-        if random.random() < trigger_probability:
+        if self._next_trigger is None:
+            self._next_trigger = self._curve.next_arrival(now, self.random)
+
+        # Idle cycles only cost this comparison. Catch up on the arrivals that fell within the last cycle.
+        caught_up = 0
+        while self._next_trigger <= now and not self.stop():
+            if caught_up == MAX_CATCH_UP:
+                self._next_trigger = self._curve.next_arrival(now, self.random)
+                break
+            caught_up += 1
             self._triggered += 1
             api.new_task(self._task)
+            self._next_trigger = self._curve.next_arrival(self._next_trigger, self.random)
 
     def cleanup(self):
         pass
@@ -56,7 +174,10 @@ class Frequency(task.Task):
         params = {'required': {'task': 'task| the configuration of another task',
                                'frequency': 'number| positive decimal number - avg number of triggers per hour',
                                'repetitions': 'int| non-negative integer - 0 for unlimited'},
-                  'optional': {}}
+                  'optional': {'profile': '{any: number}| maps a time of day in HHMM format to a non-negative '
+                                          'multiplier of frequency, which applies from that time until the next time '
+                                          'in the profile, wrapping around midnight. Used for diurnal curves or short '
+                                          'bursts. Default is a constant rate.'}}
 
         return params
 
@@ -76,7 +197,7 @@ class Frequency(task.Task):
             dict: The given configuration dict with arguments converted to their required formats with missing
                 optional arguments added with default arguments.
         """
-        config = api.check_config(config, cls.parameters(), {})
+        config = api.check_config(config, cls.parameters(), {'profile': {}})
 
         freq = config['frequency']
         if freq <= 0:
@@ -86,4 +207,37 @@ class Frequency(task.Task):
         if reps < 0:
             raise ValueError('repetitions: {} Must not be negative.'.format(str(reps)))
 
+        profile = config['profile']
+        offsets = set()
+        for key, multiplier in profile.items():
+            try:
+                offset = seconds_of_day(key)
+            except ValueError:
+                raise ValueError('profile: {} Must be in HHMM format'.format(key))
+            if offset in offsets:
+                raise ValueError('profile: {} Lists the same time more than once.'.format(key))
+            offsets.add(offset)
+            if multiplier < 0:
+                raise ValueError('profile: {} Must not be negative.'.format(multiplier))
+        if profile and not any(profile.values()):
+            raise ValueError('profile: {} Must contain at least one positive multiplier.'.format(profile))
+
         return config
+
+def seconds_of_day(key):
+    """ Convert an HHMM time code to the number of seconds since midnight.
+
+    Args:
+        key (str or int): A 24-hour time code in HHMM format. YAML may load it as an int, so leading zeroes are
+            restored.
+
+    Raises:
+        ValueError: If key is not in HHMM format.
+
+    Returns:
+        int: Seconds since midnight.
+    """
+    if isinstance(key, bool):
+        raise ValueError(key)
+    time_of_day = datetime.datetime.strptime(str(key).zfill(4), '%H%M').time()
+    return time_of_day.hour * 3600 + time_of_day.minute * 60
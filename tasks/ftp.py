@@ -4,25 +4,61 @@
 # June 16, 2017
 # Adapted from code written by Rotem Guttman and Joe Vessella
 
+import concurrent.futures
 import ftplib
-import time
+import functools
+import os
+import threading
 
 import api
+from tasks import broker
 from tasks import task
 
 
+def close(ftp):
+    try:
+        ftp.quit()
+    except ftplib.all_errors:
+        ftp.close()
+
+def abort(ftp):
+    broker.shutdown_socket(ftp.sock)
+    ftp.close()
+
+# Logged in sessions kept open between downloads, keyed by (server, user, password digest). Sessions idle for a while
+# are checked with NOOP before being reused.
+pool = broker.register(broker.Pool('ftp', close, lambda ftp: ftp.voidcmd('NOOP'), abort=abort))
+
 class FTP(task.Task):
-    """ Connects to and authenticates with an FTP server, then attempts to download a file.
+    """ Connects to and authenticates with an FTP server, then attempts to download one or more files. Logged in
+    sessions are reused between runs.
     """
+    parallel_init = True
+
     def __init__(self, config):
         """ Validates config and stores it as an attribute.
         """
         self._config = config
+        self._downloaded = 0
+        self._lock = threading.Lock()
 
     def __call__(self):
-        """ Connects to the ftp server as specified in config and attempts to download file from server.
+        """ Connects to the ftp server as specified in config and attempts to download files from server.
         """
-        self.retrieve_file(self._config['site'], self._config['file'], self._config['user'], self._config['password'])
+        filenames = [self._config['file']] + self._config['files']
+
+        if self._config['parallel'] == 1 or len(filenames) == 1:
+            for filename in filenames:
+                self.retrieve_file(self._config['site'], filename, self._config['user'], self._config['password'])
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(self._config['parallel']) as executor:
+            futures = [executor.submit(self.retrieve_file, self._config['site'], filename, self._config['user'],
+                                       self._config['password'])
+                       for filename in filenames]
+            # Raise the first exception, if any.
+            for future in futures:
+                future.result()
 
     def cleanup(self):
         """ Doesn't need to do anything
@@ -43,7 +79,14 @@ class FTP(task.Task):
         Returns:
             str: An arbitrary string giving more detailed, task-specific status for the given task.
         """
-        return ''
+        return 'Downloaded {} bytes.'.format(self._downloaded)
+
+    @classmethod
+    def prime(cls, config):
+        """ Log in ahead of time so that the first run finds a session in the pool.
+        """
+        key = (config['site'], config['user'], broker.digest(config['password']))
+        pool.prime(key, functools.partial(ftplib.FTP, config['site'], config['user'], config['password']))
 
     @classmethod
     def parameters(cls):
@@ -60,7 +103,13 @@ class FTP(task.Task):
                     'file': 'str| Name of file to download'},
                   'optional': {
                     'user': 'str| user to log in with. Defaults to "anonymous"',
-                    'password': 'str| password to log in with. defaults to empty string.'}}
+                    'password': 'str| password to log in with. defaults to empty string.',
+                    'files': '[str]| Names of more files to download on each run. Defaults to none.',
+                    'parallel': 'int| Number of files to download at once, each over its own session. Defaults to 1.',
+                    'download_dir': 'str| Directory to save downloaded files in. Defaults to the working directory.',
+                    'discard': 'bool| Whether to throw away downloaded data instead of saving it, which avoids disk '
+                               'writes when only the network traffic is wanted. Defaults to False.',
+                    'block_size': 'int| Number of bytes to read from the server at a time. Defaults to 8192.'}}
         return params
 
     @classmethod
@@ -79,13 +128,25 @@ class FTP(task.Task):
         Returns:
             dict: The dict given as the config argument, updated with default values for missing optional keys.
         """
-        defaults = {'user': 'anonymous', 'password': ''}
+        defaults = {'user': 'anonymous',
+                    'password': '',
+                    'files': [],
+                    'parallel': 1,
+                    'download_dir': '',
+                    'discard': False,
+                    'block_size': 8192}
         config = api.check_config(config, cls.parameters(), defaults)
 
         if not config['site']:
             raise ValueError('site: {} Must be non-empty'.format(config['site']))
         if not config['file']:
             raise ValueError('file: {} Must be non-empty'.format(config['file']))
+        if not all(config['files']):
+            raise ValueError('files: {} Must not contain empty names'.format(config['files']))
+        if config['parallel'] < 1:
+            raise ValueError('parallel: {} Must be positive'.format(config['parallel']))
+        if config['block_size'] < 1:
+            raise ValueError('block_size: {} Must be positive'.format(config['block_size']))
 
         return config
 
@@ -100,10 +161,43 @@ class FTP(task.Task):
 
         Raises:
             RuntimeError: If the file download is unsuccessful
+            OSError: If the file can't be opened for writing
+        """
+        if self._config['discard']:
+            self._download(server, filename, user, password, self._count)
+            return
+
+        # Opened before downloading, so that local errors, such as a bad path, aren't reported as FTP errors.
+        path = os.path.join(self._config['download_dir'], os.path.basename(filename))
+        with open(path, 'wb') as f:
+            def write(block):
+                try:
+                    f.write(block)
+                except OSError as e:
+                    # E.g. a full disk. ftplib.all_errors includes OSError, so this is raised as another type.
+                    raise RuntimeError('Unable to write {}: {}'.format(path, e))
+                self._count(block)
+            self._download(server, filename, user, password, write)
+
+    def _download(self, server, filename, user, password, sink):
+        """ Downloads filename from server, passing each block of it to sink. See retrieve_file.
+
+        Raises:
+            RuntimeError: If the FTP transfer is unsuccessful
         """
         try:
-            ftp = ftplib.FTP(server, user, password)
-            ftp.retrbinary('RETR ' + filename, open(filename, 'wb').write)
-            ftp.quit()
-        except:
+            # A permanent error leaves the session itself fine, e.g. if the file doesn't exist.
+            with pool.session((server, user, broker.digest(password)),
+                              functools.partial(ftplib.FTP, server, user, password),
+                              (ftplib.error_perm,), self.cancel_token) as ftp:
+                ftp.retrbinary('RETR ' + filename, sink, self._config['block_size'])
+        except ftplib.all_errors:
             raise RuntimeError('Unable to read file from FTP server')
+
+    def _count(self, block):
+        """ Keeps track of the number of bytes downloaded. Also used as the sink for discarded data. Since it's called
+        for every block, it ends the download if the task is cancelled.
+        """
+        self.cancel_token.check()
+        with self._lock:
+            self._downloaded += len(block)
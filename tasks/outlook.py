@@ -2,7 +2,6 @@
 
 import os
 import platform
-import random
 import re
 import subprocess
 import time
@@ -222,7 +221,7 @@ class Outlook(task.Task):
                     '|(www|ftp)[-A-Za-z0-9]*\\.)[-A-Za-z0-9/\\.]+)(:[0-9]*)?'
         match = re.search(url_regex, body)
 
-        if match and random.randint(1, 100) <= self._config['open_links']:
+        if match and self.random.randint(1, 100) <= self._config['open_links']:
             # There was a link in the email and we chose to click it.
             link_config = {'type': 'firefox', 'config': {'sites': [match.group()]}}
             api.new_task(link_config)
@@ -230,7 +229,7 @@ class Outlook(task.Task):
     def _check_attachments(self, attachments):
         """ Check if we should open attachments, and if so, save and open all attachments.
         """
-        if random.randint(1, 100) <= self._config['open_attachments']:
+        if self.random.randint(1, 100) <= self._config['open_attachments']:
             for i in range(attachments.Count):
                 # Microsoft uses 1-indexed collections. Of course they do.
                 item = attachments.Item(i + 1)
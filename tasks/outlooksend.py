@@ -10,6 +10,7 @@ except ImportError:
 
 import api
 from tasks import outlook
+from tasks import payload
 
 
 class OutlookSend(outlook.Outlook):
@@ -61,8 +62,9 @@ class OutlookSend(outlook.Outlook):
             str, str: First return value is email subject and second value is email body.
         """
         if self._config['dynamic']:
-            subject = 'DYNAMIC OPTION NOT YET IMPLEMENTED'
-            body = 'DYNAMIC OPTION NOT YET IMPLEMENTED'
+            corpus = payload.get_corpus(self._config['text_sources'])
+            subject = ' '.join(corpus.lines(1)).strip()
+            body = '\n\n'.join(corpus.paragraph() for _ in range(self.random.randint(1, 4)))
         else:
             subject = self._config['subject']
             body = self._config['body']
@@ -85,7 +87,10 @@ class OutlookSend(outlook.Outlook):
                     'body': 'str| Message body. Specify empty string if optional parameter "dynamic" is used.'}
 
         optional = {'attachments': '[str]| A list of paths to files that should be attached.',
-                    'dynamic': 'bool| Generate subject and body. Default False.'}
+                    'dynamic': 'bool| Generate subject and body from random lines and paragraphs of the text sources. '
+                               'Default False.',
+                    'text_sources': '[str]| Text files to generate the subject and body from if "dynamic" is used. '
+                                    'Default ["aliceinwonderland.txt"].'}
 
 
         config['required'] = required
@@ -102,7 +107,11 @@ class OutlookSend(outlook.Outlook):
             ValueError: If a key's value is not valid.
         """
         defaults = {'attachments': [],
-                    'dynamic': False}
+                    'dynamic': False,
+                    'text_sources': [payload.CORPUS]}
         config = api.check_config(config, cls.parameters(), defaults)
 
+        if config['dynamic'] and not config['text_sources']:
+            raise ValueError('text_sources: {} Must be non-empty if "dynamic" is used.'.format(config['text_sources']))
+
         return config
@@ -0,0 +1,300 @@
+# Copyright 2017 Carnegie Mellon University. See LICENSE.md file for terms.
+
+""" Generates message text and file contents for tasks that need something to send. The expensive part, generating
+random data and reading and indexing text corpora, is done once into shared pools, and payloads are slices of those
+pools, so taking a payload costs next to nothing.
+"""
+import array
+import mmap
+import os
+import random
+import string
+import sys
+import threading
+
+
+CORPUS = 'aliceinwonderland.txt'
+# Size in bytes of the pools of random text and random binary data.
+POOL_SIZE = 1 << 20
+# Number of preceding words the next word of generated sentences depends on.
+MARKOV_ORDER = 2
+
+class SharedPayload(object):
+    """ Shared pools from which payloads are taken. Guaranteed thread-safe.
+    """
+    _text = None
+    _blob = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        """ Fills the random pools if they haven't been already. Tasks should do this when they are initialized, so
+        that the work isn't done while they run.
+        """
+        with cls._lock:
+            if cls._blob is None:
+                blob = os.urandom(POOL_SIZE)
+                # Map byte values to letters, which turns random bytes into random text in one pass. The values above
+                # the largest multiple of 26 are dropped, since mapping them as well would make some letters likelier.
+                letters = string.ascii_lowercase.encode()
+                table = bytes(letters[i % len(letters)] for i in range(256))
+                dropped = bytes(range(256 - 256 % len(letters), 256))
+                text = blob.translate(table, dropped)
+                while len(text) < POOL_SIZE:
+                    text += os.urandom(POOL_SIZE // 8).translate(table, dropped)
+                cls._text = memoryview(text[:POOL_SIZE])
+                cls._blob = memoryview(blob)
+
+        return cls
+
+    @classmethod
+    def random_text(cls, length):
+        """ Random lowercase letters.
+
+        Args:
+            length (int): Number of letters, at most POOL_SIZE.
+
+        Returns:
+            str: The letters.
+        """
+        start = random.randrange(POOL_SIZE - length + 1)
+        return cls._text[start:start + length].tobytes().decode('ascii')
+
+    @classmethod
+    def blob(cls, size):
+        """ Random binary data, without copying it out of the pool.
+
+        Args:
+            size (int): Number of bytes, at most POOL_SIZE.
+
+        Returns:
+            memoryview: The data.
+        """
+        start = random.randrange(POOL_SIZE - size + 1)
+        return cls._blob[start:start + size]
+
+    @classmethod
+    def open_blob(cls, size):
+        """ Random binary data of any size as a file-like object, for APIs that upload from files.
+
+        Args:
+            size (int): Number of bytes.
+
+        Returns:
+            BlobReader: The data.
+        """
+        return BlobReader(cls._blob, size, random.randrange(POOL_SIZE))
+
+    @classmethod
+    def sentences(cls, word_count, paths=(CORPUS,)):
+        """ Text in the style of a corpus, generated with a Markov chain over its words. Falls back to random text if
+        the corpus can't be found or has no text.
+
+        Args:
+            word_count (int): Approximate number of words. Generation continues to the end of the sentence.
+            paths (sequence of str): The text files making up the corpus. See get_corpus.
+
+        Returns:
+            str: The text.
+        """
+        try:
+            text = get_corpus(paths).sentences(word_count)
+        except OSError:
+            text = ''
+        return text or cls.random_text(word_count * 5)
+
+class BlobReader(object):
+    """ File-like object reading size bytes from a pool, wrapping around at its end.
+    """
+    def __init__(self, pool, size, start):
+        self._pool = pool
+        self._remaining = size
+        self._position = start
+
+    def read(self, size=-1):
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+
+        chunks = []
+        while size > 0:
+            chunk = self._pool[self._position:self._position + size]
+            chunks.append(chunk)
+            size -= len(chunk)
+            self._remaining -= len(chunk)
+            self._position = (self._position + len(chunk)) % len(self._pool)
+
+        return b''.join(chunks)
+
+class Corpus(object):
+    """ One or more text files, each memory-mapped once, with a compact index of where every non-blank line and every
+    paragraph starts and ends. Taking random lines or paragraphs costs constant time and never reads the files again.
+    Guaranteed thread-safe.
+    """
+    def __init__(self, paths):
+        """
+        Args:
+            paths (sequence of str): Paths of the text files.
+
+        Raises:
+            OSError: If a file can't be opened.
+        """
+        self._maps = []
+        # For each line and paragraph, the index of its file, and its start and end offsets within that file.
+        self._lines = (array.array('H'), array.array('Q'), array.array('Q'))
+        self._paragraphs = (array.array('H'), array.array('Q'), array.array('Q'))
+        self._chain = None
+        self._starts = None
+        self._lock = threading.Lock()
+
+        for path in paths:
+            with open(path, 'rb') as f:
+                if not os.fstat(f.fileno()).st_size:
+                    continue
+                self._maps.append(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            self._index(len(self._maps) - 1)
+
+    def _index(self, file_index):
+        """ Add the lines and paragraphs of a mapped file to the index.
+        """
+        data = self._maps[file_index]
+        position = 0
+        paragraph_start = None
+        paragraph_end = 0
+
+        while position < len(data):
+            end = data.find(b'\n', position)
+            if end < 0:
+                end = len(data)
+
+            if data[position:end].strip():
+                self._add(self._lines, file_index, position, end)
+                if paragraph_start is None:
+                    paragraph_start = position
+                paragraph_end = end
+            elif paragraph_start is not None:
+                self._add(self._paragraphs, file_index, paragraph_start, paragraph_end)
+                paragraph_start = None
+
+            position = end + 1
+
+        if paragraph_start is not None:
+            self._add(self._paragraphs, file_index, paragraph_start, paragraph_end)
+
+    @staticmethod
+    def _add(index, file_index, start, end):
+        files, starts, ends = index
+        files.append(file_index)
+        starts.append(start)
+        ends.append(end)
+
+    def _get(self, index, i):
+        files, starts, ends = index
+        return self._maps[files[i]][starts[i]:ends[i]].decode('utf-8', errors='replace').rstrip('\r')
+
+    def line_count(self):
+        return len(self._lines[0])
+
+    def lines(self, count):
+        """ Random lines, without their line endings.
+
+        Args:
+            count (int): Number of lines.
+
+        Returns:
+            list of str: The lines, or an empty list if the corpus has none.
+        """
+        if not self.line_count():
+            return []
+        return [self._get(self._lines, random.randrange(self.line_count())) for _ in range(count)]
+
+    def paragraph(self):
+        """ A random paragraph, with lines joined by line endings.
+
+        Returns:
+            str: The paragraph, or an empty string if the corpus has none.
+        """
+        if not self._paragraphs[0]:
+            return ''
+        return self._get(self._paragraphs, random.randrange(len(self._paragraphs[0])))
+
+    def sentences(self, word_count):
+        """ Text generated with a Markov chain over the words of the corpus, which is built on first use.
+
+        Args:
+            word_count (int): Approximate number of words. Generation continues to the end of the sentence.
+
+        Returns:
+            str: The text, or an empty string if the corpus has no words.
+        """
+        with self._lock:
+            if self._chain is None:
+                text = ' '.join(data[:].decode('utf-8', errors='replace') for data in self._maps)
+                self._chain, self._starts = build_chain(text)
+
+        if not self._starts:
+            return ''
+
+        key = random.choice(self._starts)
+        words = list(key)
+        while len(words) < word_count or not words[-1].endswith(('.', '!', '?')):
+            following = self._chain.get(key)
+            if not following or len(words) > word_count * 2:
+                break
+            words.append(random.choice(following))
+            key = tuple(words[-MARKOV_ORDER:])
+
+        return ' '.join(words)
+
+_corpora = {}
+_corpora_lock = threading.Lock()
+
+def get_corpus(paths=(CORPUS,)):
+    """ Get the shared Corpus of the given files, mapping and indexing them on first use. Relative paths are looked up
+    in the working directory, then in the directory usersim was started from.
+
+    Args:
+        paths (sequence of str): Paths of the text files.
+
+    Raises:
+        OSError: If a file can't be found.
+
+    Returns:
+        Corpus: The corpus.
+    """
+    key = tuple(paths)
+    with _corpora_lock:
+        if key not in _corpora:
+            _corpora[key] = Corpus([find_file(path) for path in paths])
+        return _corpora[key]
+
+def find_file(path):
+    """ Look for a file in the working directory, then in the directory usersim was started from.
+
+    Returns:
+        str: The path to the file if it exists, otherwise path unchanged.
+    """
+    if os.path.isabs(path) or os.path.exists(path):
+        return path
+    alternative = os.path.join(os.path.dirname(sys.argv[0]), path)
+    return alternative if os.path.exists(alternative) else path
+
+def build_chain(text):
+    """ Build a Markov chain over the words of text.
+
+    Args:
+        text (str): The corpus.
+
+    Returns:
+        tuple: A dict mapping each MARKOV_ORDER consecutive words to a list of the words that follow them, and a list
+            of the keys that start sentences.
+    """
+    words = text.split()
+    chain = {}
+    starts = []
+
+    for i in range(len(words) - MARKOV_ORDER):
+        key = tuple(words[i:i + MARKOV_ORDER])
+        chain.setdefault(key, []).append(words[i + MARKOV_ORDER])
+        if i == 0 or words[i - 1].endswith(('.', '!', '?')):
+            starts.append(key)
+
+    return chain, starts
@@ -0,0 +1,135 @@
+# Copyright 2017 Carnegie Mellon University. See LICENSE.md file for terms.
+
+import time
+
+import api
+from tasks import frequency
+
+
+DAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+class RateProfile(frequency.Frequency):
+    """ Spawns the nested task following a rate curve over the day or the week, such as a morning burst of e-mail, a
+    lunch lull and end-of-day uploads. The whole curve is precomputed once, so a single rateprofile task can replace
+    many nested attime and frequency tasks.
+    """
+    def __init__(self, config):
+        rates = config['rates']
+        period = frequency.WEEK if is_weekly(rates) else frequency.DAY
+
+        points = [(offset_of(key), rate / 3600) for key, rate in rates.items()]
+
+        self._curve = frequency.RateCurve(points, period, config['interpolate'])
+        self._reps = config['repetitions']
+        self._triggered = 0
+        self._task = config['task']
+        # Drawn on the first run, like Frequency's.
+        self._next_trigger = None
+
+    def status(self):
+        if self._next_trigger is None:
+            return 'Triggered {} times. Not run yet.'.format(self._triggered)
+        return 'Triggered {} times. Next trigger at {}.'.format(self._triggered, time.ctime(self._next_trigger))
+
+    @classmethod
+    def parameters(cls):
+        """ Returns a dictionary with the required and optional parameters of the class, with human-readable
+        descriptions for each.
+
+        Returns:
+            dict of dicts: A dictionary whose keys are 'required' and 'optional', and whose values are dictionaries
+                containing the required and optional parameters of the class as keys and human-readable (str)
+                descriptions and requirements for each key as values.
+        """
+        required = {'task': 'task| The task to be triggered.',
+                    'rates': '{any: number}| Maps a time of day in HHMM format, or a time of the week in "Day HHMM" '
+                             'format (e.g. "Mon 0830"), to a non-negative rate in triggers per hour. All keys must use '
+                             'the same format, and at least one rate must be positive.'}
+        optional = {'interpolate': 'bool| If True, the rate changes linearly between the given times. Otherwise, each '
+                                   'rate holds until the next given time. Default is False.',
+                    'repetitions': 'int| Number of times to trigger the nested task. 0 for unlimited. Default is 0.'}
+
+        return {'required': required, 'optional': optional}
+
+    @classmethod
+    def validate(cls, config):
+        """ Validates the given configuration dictionary.
+
+        Args:
+            config (dict): The dictionary to validate. See parameters() for required format.
+
+        Raises:
+            KeyError: If a required configuration option is missing. The error message is the missing key.
+            ValueError: If a configuration option's value is not valid. The error message is in the following format:
+                key: value requirement
+
+        Returns:
+            dict: The dict given as the config argument with missing optional parameters added with default values.
+        """
+        defaults = {'interpolate': False, 'repetitions': 0}
+        config = api.check_config(config, cls.parameters(), defaults)
+
+        rates = config['rates']
+        if not rates:
+            raise ValueError('rates: {} Must be non-empty.'.format(rates))
+
+        try:
+            is_weekly(rates)
+        except ValueError:
+            raise ValueError('rates: {} Must use either HHMM or "Day HHMM" for all keys.'.format(list(rates)))
+
+        offsets = set()
+        for key, rate in rates.items():
+            try:
+                offset = offset_of(key)
+            except ValueError:
+                raise ValueError('rates: {} Must be in HHMM or "Day HHMM" format.'.format(key))
+            if offset in offsets:
+                raise ValueError('rates: {} Lists the same time more than once.'.format(key))
+            offsets.add(offset)
+            if rate < 0:
+                raise ValueError('rates: {} Must not be negative.'.format(rate))
+
+        if not any(rates.values()):
+            raise ValueError('rates: {} Must contain at least one positive rate.'.format(rates))
+
+        if config['repetitions'] < 0:
+            raise ValueError('repetitions: {} Must not be negative.'.format(config['repetitions']))
+
+        return config
+
+def is_weekly(rates):
+    """ Check whether the keys of a rates dict describe a week or a single day.
+
+    Args:
+        rates (dict): See the 'rates' parameter.
+
+    Raises:
+        ValueError: If the keys mix both formats.
+
+    Returns:
+        bool: True if every key names a day of the week, False if none do.
+    """
+    weekly = {len(str(key).split()) == 2 for key in rates}
+    if len(weekly) > 1:
+        raise ValueError('Mixed time formats.')
+    return weekly.pop()
+
+def offset_of(key):
+    """ Convert a key of the 'rates' parameter to the number of seconds since the start of the day or week.
+
+    Args:
+        key (str or int): Either HHMM or "Day HHMM", where Day is an English day name or its first three letters.
+
+    Raises:
+        ValueError: If key is not in one of those formats.
+
+    Returns:
+        int: Seconds since midnight, or since midnight on Monday for weekly keys.
+    """
+    parts = str(key).split()
+    if len(parts) == 1:
+        return frequency.seconds_of_day(key)
+    if len(parts) == 2 and parts[0][:3].lower() in DAYS:
+        return DAYS.index(parts[0][:3].lower()) * frequency.DAY + frequency.seconds_of_day(parts[1])
+    raise ValueError(key)
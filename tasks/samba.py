@@ -3,32 +3,93 @@
 # Ali Kidwai
 # July 18, 2017
 # Adapted from code written by Rotem Guttman and Joe Vessella
+import concurrent.futures
+import functools
 import os
-import random
-import time
+import threading
 
 from smb.SMBConnection import SMBConnection
 from smb.smb_structs import OperationFailure
 
 import api
+from tasks import broker
+from tasks import payload
 from tasks import task
 
 
+# Maps (address, port) to whether the server uses direct TCP, so that later connections don't try both.
+_direct_tcp = {}
+_direct_tcp_lock = threading.Lock()
+
+def connect(address, port, username, password):
+    """ Connect to the Samba server at address. Unless it's known which works, tries direct TCP first, then NetBIOS.
+
+    Returns:
+        SMBConnection: An authenticated connection.
+    """
+    with _direct_tcp_lock:
+        direct_tcp = _direct_tcp.get((address, port))
+
+    if direct_tcp is not None:
+        return _try_connect(address, port, username, password, direct_tcp)
+
+    try:
+        con = _try_connect(address, port, username, password, True)
+        direct_tcp = True
+    except Exception:
+        con = _try_connect(address, port, username, password, False)
+        direct_tcp = False
+
+    with _direct_tcp_lock:
+        _direct_tcp[(address, port)] = direct_tcp
+
+    return con
+
+def _try_connect(address, port, username, password, direct_tcp):
+    # Need to provide *A* remote name it seems, but the share doesn't seem too particular about what it is.
+    # If the remote server is using direct TCP this flag must be set to True or we get an exception when we try
+    # to connect.
+    con = SMBConnection(username, password, '', 'usersim', is_direct_tcp=direct_tcp)
+    if not con.connect(address, port):
+        raise ConnectionError('Authentication with {}:{} failed.'.format(address, port))
+    return con
+
+def _check(con):
+    con.echo(b'usersim')
+    return True
+
+def _abort(con):
+    broker.shutdown_socket(con.sock)
+    con.close()
+
+# Authenticated connections kept open between transfers, keyed by (address, port, user, password digest).
+# Connections idle for a while are checked with an echo before being reused.
+pool = broker.register(broker.Pool('samba', lambda con: con.close(), _check, abort=_abort))
+
+class NullSink(object):
+    """ File-like object that throws away everything written to it, counting the bytes.
+    """
+    def __init__(self):
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+        return len(data)
+
 class Samba(task.Task):
     """ Connects to and authenticates with a Samba share. Upload or download must be chosen per task config. If your
     share does not require authentication, you MUST set the appropriate permission bits on the shared folder so that
     guests can upload files to it!
     """
+    parallel_init = True
+
     def __init__(self, config, debug=False):
         self._config = config
-        self._smb_con = None
+        self._payload = payload.SharedPayload()
         self._debug = debug
 
     def __call__(self):
-        self._smb_connect(self._config['address'], self._config['port'],
-                          self._config['user'], self._config['password'])
-
-        if not self._config['files']:
+        if not self._config['files'] and not (self._config['upload'] and self._config['blobs']):
             self._echo()
         elif self._config['upload']:
             self._upload()
@@ -56,6 +117,15 @@ class Samba(task.Task):
         """
         return ''
 
+    @classmethod
+    def prime(cls, config):
+        """ Fill the payload pools and connect ahead of time so that the first run finds a connection in the pool.
+        """
+        payload.SharedPayload()
+        address = (config['address'], config['port'], config['user'])
+        pool.prime(address + (broker.digest(config['password']),),
+                   functools.partial(connect, *address, config['password']))
+
     @classmethod
     def parameters(cls):
         """ Returns a dictionary with the required and optional parameters of the class, with human-readable
@@ -82,7 +152,11 @@ class Samba(task.Task):
                                             'path (including the share name) on the remote Samba server. If not '
                                             'specified, then downloads will not save downloaded files to the disk, and'
                                             'uploads will not be attempted. It is best to use forward slashes (/) even '
-                                            'for Windows paths.'}}
+                                            'for Windows paths.',
+                               'blobs': '[int]| sizes in bytes of files with random contents to generate and upload '
+                                        'to write_dir along with files, if upload is True. Default none',
+                               'connections': 'int| the number of files to transfer at once, each over its own '
+                                              'connection. Default 1'}}
         return params
 
     @classmethod
@@ -105,24 +179,26 @@ class Samba(task.Task):
                     'password': '',
                     'upload': False,
                     'files': [],
-                    'write_dir': ''}
+                    'write_dir': '',
+                    'blobs': [],
+                    'connections': 1}
         config = api.check_config(config, cls.parameters(), defaults)
 
         if config['port'] < 0 or config['port'] > 65535:
             raise ValueError('port: {} Must be in the range [0, 65535]'.format(str(config['port'])))
+        if any(size < 0 for size in config['blobs']):
+            raise ValueError('blobs: {} Sizes must not be negative'.format(str(config['blobs'])))
+        if config['connections'] < 1:
+            raise ValueError('connections: {} Must be positive'.format(str(config['connections'])))
 
         return config
 
     def _echo(self):
         """ Send an echo request to the server with a randomly-generated string.
         """
-        length = random.randint(1, 100)
-        data = ''
-
-        for _ in range(length):
-            data += random.choice('abcdefghijklmnopqrstuvwxyz')
+        data = self._payload.random_text(self.random.randint(1, 100))
 
-        self._smb_con.echo(data)
+        self._with_connection(lambda con: con.echo(data))
 
     def _download(self):
         """ Retrieves a list of files. Will make an attempt to retrieve all files. If any files fail to retrieve, raises
@@ -132,20 +208,15 @@ class Samba(task.Task):
             Exception: If any file retrieval fails, an exception will be raised whose message includes a list of all
                 failures.
         """
-        file_paths = self._config['files']
-        failures = []
-
-        for file_path in file_paths:
-            try:
-                self._retrieve_file(file_path)
-            except Exception as e:
-                failures.append(file_path + ': ' + str(e))
+        failures = self._transfer([(file_path, functools.partial(self._retrieve_file, remote_path=file_path))
+                                   for file_path in self._config['files']])
         if failures:
             raise Exception('Failed to retrieve the following files:\n%s' % '\n'.join(failures))
 
     def _upload(self):
-        """ Tries to upload a list of files to the server. Will make an attempt to upload all files in the list, using
-        the local path as the remote path. If any file fails to upload, raises an exception at the end.
+        """ Tries to upload a list of files to the server, along with generated files of the sizes in the 'blobs'
+        config. Will make an attempt to upload all files in the list, using the local path as the remote path. If any
+        file fails to upload, raises an exception at the end.
 
         Args:
             file_paths (list): A list of local files to upload to the server. Files will be uploaded in the order given.
@@ -155,44 +226,90 @@ class Samba(task.Task):
             Exception: If any file upload fails, an exception will be raised whose message includes a list of all
                 failures.
         """
-        file_paths = self._config['files']
+        transfers = [(file_path, functools.partial(self._write_file, local_path=file_path))
+                     for file_path in self._config['files']]
+        for size in self._config['blobs']:
+            name = 'usersim_{:08x}.bin'.format(self.random.getrandbits(32))
+            transfers.append((name, functools.partial(self._write_blob, name=name, size=size)))
+
+        failures = self._transfer(transfers)
+        if failures:
+            raise Exception('Failed to upload the following files:\n%s' % '\n'.join(failures))
+
+    def _transfer(self, transfers):
+        """ Runs file transfers, up to 'connections' at a time.
+
+        Args:
+            transfers (list of tuples): Each tuple is (name, transfer_file), where transfer_file takes a connection and
+                transfers one file, and name identifies the file in failure messages.
+
+        Returns:
+            list of str: A description of each failure.
+        """
         failures = []
 
-        for file_path in file_paths:
+        def transfer(name, transfer_file):
             try:
-                self._write_file(file_path)
+                self._with_connection(transfer_file)
             except Exception as e:
-                failures.append(file_path + ': ' + str(e))
-        if failures:
-            raise Exception('Failed to retrieve the following files:\n%s' % '\n'.join(failures))
+                failures.append(name + ': ' + str(e))
 
-    def _retrieve_file(self, remote_path):
+        if self._config['connections'] == 1:
+            for name, transfer_file in transfers:
+                transfer(name, transfer_file)
+        else:
+            with concurrent.futures.ThreadPoolExecutor(self._config['connections']) as executor:
+                # Exceptions are collected by transfer, so there is nothing to wait for but the executor itself.
+                for name, transfer_file in transfers:
+                    executor.submit(transfer, name, transfer_file)
+
+        return failures
+
+    def _with_connection(self, action):
+        """ Runs action with a pooled connection. The connection is only returned to the pool if it is still usable.
+
+        Args:
+            action (callable): Takes an SMBConnection.
+        """
+        address, port, user, password = (self._config['address'], self._config['port'], self._config['user'],
+                                          self._config['password'])
+
+        # OperationFailure and ValueError are about the file rather than the connection, e.g. a missing remote file or
+        # a bad path.
+        with pool.session((address, port, user, broker.digest(password)),
+                          functools.partial(connect, address, port, user, password),
+                          (OperationFailure, ValueError), self.cancel_token) as con:
+            action(con)
+
+    def _retrieve_file(self, con, remote_path):
         """ Retrieve remote_path and save it at the configured 'write_dir' folder if it is specified, otherwise black
-        hole the downloaded file data.
+        hole the downloaded file data without touching the disk.
 
         Args:
+            con (SMBConnection): The connection to use.
             remote_path (str): The path to the file to retrieve.
         """
-        write_dir = self._config['write_dir']
-        if os.path.isdir(write_dir):
-            out_file = os.path.join(write_dir, os.path.basename(remote_path))
-        else:
-            out_file = os.devnull
-
         try:
             share, path = remote_path.split('/', 1)
         except ValueError:
             raise ValueError('A path to a file must be specified along with the share name.')
 
-        with open(out_file, 'wb') as f:
-            if self._debug:
-                print('Attempting to retrieve file %s' % os.path.join(share, path))
-            self._smb_con.retrieveFile(share, path, f)
+        if self._debug:
+            print('Attempting to retrieve file %s' % os.path.join(share, path))
 
-    def _write_file(self, local_path):
+        write_dir = self._config['write_dir']
+        if os.path.isdir(write_dir):
+            # pysmb streams the file into f as it arrives, so it is never held in memory as a whole.
+            with open(os.path.join(write_dir, os.path.basename(remote_path)), 'wb') as f:
+                con.retrieveFile(share, path, f)
+        else:
+            con.retrieveFile(share, path, NullSink())
+
+    def _write_file(self, con, local_path):
         """ Write the file at local_path to the directory in the 'write_path' config dict.
 
         Args:
+            con (SMBConnection): The connection to use.
             local_path (str): A path to a local file to upload to the server.
         """
         write_dir = self._config['write_dir']
@@ -211,24 +328,26 @@ class Samba(task.Task):
         with open(local_path, 'rb') as f:
             if self._debug:
                 print('Attempting to upload file %s' % local_path)
-            self._smb_con.storeFile(share, path, f)
+            con.storeFile(share, path, f)
 
-    def _smb_connect(self, address, port, username, password):
-        """ Attempts to connect to the Samba server at address. Will try direct TCP first. If that fails, tries not
-        using direct TCP.
+    def _write_blob(self, con, name, size):
+        """ Upload size bytes of random data as name to the directory in the 'write_path' config dict. The data is
+        streamed from the payload pool, so nothing is written to the local disk.
 
         Args:
-            address (str): The address of the Samba server
-            port (int): Port for the Samba server
-            username (str): The username to log in with
-            password (str): The password for username
+            con (SMBConnection): The connection to use.
+            name (str): The name of the remote file.
+            size (int): The size of the file in bytes.
         """
+        write_dir = self._config['write_dir']
+        if not write_dir:
+            return
+
         try:
-            # Need to provide *A* remote name it seems, but the share doesn't seem too particular about what it is.
-            # If the remote server is using direct TCP this flag must be set to True or we get an exception when we try
-            # to connect.
-            self._smb_con = SMBConnection(username, password, '', 'usersim', is_direct_tcp=True)
-            self._smb_con.connect(address, port)
-        except Exception:
-            self._smb_con = SMBConnection(username, password, '', 'usersim')
-            self._smb_con.connect(address, port)
+            share, path = write_dir.split('/', 1)
+        except ValueError:
+            share, path = write_dir, ''
+
+        if self._debug:
+            print('Attempting to upload %d generated bytes as %s' % (size, name))
+        con.storeFile(share, os.path.join(path, name), self._payload.open_blob(size))
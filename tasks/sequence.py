@@ -14,12 +14,16 @@ class Sequence(task.Task):
 
     def __call__(self):
         if not self._waiting and self._index < len(self._tasks):
-            # Start the next task and wait for it.
-            self._current = api.new_task(self._tasks[self._index])
+            # Start the next task and wait to be notified that it has stopped.
             self._waiting = True
+            self._current = api.new_task(self._tasks[self._index])
             self._index += 1
-        if api.status_task(self._current)['state'] == api.States.STOPPED:
-            self._waiting = False
+            api.subscribe_task(self._current, self._task_stopped)
+
+    def _task_stopped(self, status):
+        """ Called with the final status of the current task once it has stopped.
+        """
+        self._waiting = False
 
     def stop(self):
         if not self._waiting and self._index >= len(self._tasks):
@@ -3,7 +3,6 @@
 # Ali Kidwai
 # June 16, 2017
 # Adapted from code written by Rotem Guttman and Joe Vessella
-import random
 import subprocess
 
 import api
@@ -24,7 +23,7 @@ class Shell(task.Task):
         the commandline if script was False or unspecified, otherwise sends the commands in sequence.
         """
         if not self._config['script']:
-            command = random.choice(self._config['commands'])
+            command = self.random.choice(self._config['commands'])
             self.run_command(command)
         else:
             for command in self._config['commands']:
@@ -5,37 +5,130 @@
 # Adapted from code written by Rotem Guttman
 import base64
 from email.mime.text import MIMEText
-import random
+import functools
 import smtplib
 
 import api
+from tasks import broker
+from tasks import payload
 from tasks import task
 
 
+def connect(server, port, encrypt):
+    """ Connect to a mail server.
+
+    Args:
+        server (str): Hostname of the mail server.
+        port (int): Port of the mail server.
+        encrypt (bool): Whether to use SSL.
+
+    Returns:
+        smtplib.SMTP: The connection.
+    """
+    if encrypt:
+        return smtplib.SMTP_SSL(server, port)
+    return smtplib.SMTP(server, port)
+
+def close(connection):
+    try:
+        connection.quit()
+    except (smtplib.SMTPException, OSError):
+        connection.close()
+
+def abort(connection):
+    broker.shutdown_socket(connection.sock)
+    connection.close()
+
+# Connections to mail servers shared by all SMTP tasks, keyed by (server, port, encrypt), so that sending an e-mail
+# does not cost a new connection and TLS handshake each time. Connections idle for a while are checked with NOOP.
+pool = broker.register(broker.Pool('smtp', close, lambda connection: connection.noop()[0] == 250, abort=abort))
+
 class SMTP(task.Task):
     """ Sends e-mails using SMTP. SSL encryption is available.
     """
+    parallel_init = True
+
     def __init__(self, config):
         self._config = config
+        self._payload = payload.SharedPayload()
 
     def __call__(self):
-        """ Generates a message and subject header if necessary, then sends an e-mail as specified in the config.
+        """ Generates messages and subject headers if necessary, then sends e-mails as specified in the config over one
+        connection.
+        """
+        self.send_mail([self._make_mail() for _ in range(self._config['batch'])])
+
+    def send_mail(self, messages):
+        """ Send messages over one pooled connection. If the server dropped a pooled connection, retries once with
+        another. Stops as soon as the task is cancelled.
+
+        Args:
+            messages (list of tuples): Each tuple is (from_addr, to_addr, message), with message a str.
+
+        Raises:
+            smtplib.SMTPException: If sending fails for any reason other than a dropped pooled connection.
+            OSError: If connecting fails.
+            usersim.Cancelled: If the task was cancelled before all messages were sent.
+        """
+        key = (self._config['mail_server'], self._config['port'], self._config['encrypt'])
+        connect_ = functools.partial(connect, *key)
+        self.cancel_token.check()
+        connection = pool.lease(key, connect_)
+        retried = False
+
+        try:
+            # Abort whichever connection is in use if the task is cancelled, so that a send in progress fails right
+            # away.
+            with self.cancel_token.closing(lambda: connection and abort(connection)):
+                for from_addr, to_addr, message in messages:
+                    self.cancel_token.check()
+                    try:
+                        connection.sendmail(from_addr, to_addr, message)
+                    except (smtplib.SMTPServerDisconnected, ConnectionError):
+                        if retried or self.cancel_token.cancelled:
+                            raise
+                        retried = True
+                        pool.release(key, connection, False)
+                        connection = None
+                        connection = pool.lease(key, connect_)
+                        connection.sendmail(from_addr, to_addr, message)
+        except Exception:
+            if connection:
+                pool.release(key, connection, False)
+            raise
+
+        # The connection may have been aborted after the last message was sent.
+        pool.release(key, connection, not self.cancel_token.cancelled)
+
+    def _make_mail(self):
+        """ Generates one e-mail.
+
+        Returns:
+            tuple: (from_addr, to_addr, message), as taken by send_mail.
         """
-        if not self._config['messages']:
-            body = ''
-            for _ in range(random.randint(1, 200)):
-                body += random.choice('abcdefghijklmnopqrstuvwxyz')
+        if self._config['messages']:
+            body = self.random.choice(self._config['messages'])
+        elif self._config['generate'] == 'corpus':
+            body = self._payload.sentences(self.random.randint(10, 200), self._config['text_sources'])
         else:
-            body = random.choice(self._config['messages'])
+            body = self._payload.random_text(self.random.randint(1, 200))
 
-        if not self._config['subjects']:
-            subject = ''
-            for _ in range(random.randint(1, 50)):
-                subject += random.choice('abcdefghijklmnopqrstuvwxyz')
+        if self._config['subjects']:
+            subject = self.random.choice(self._config['subjects'])
+        elif self._config['generate'] == 'corpus':
+            subject = self._payload.sentences(self.random.randint(2, 8), self._config['text_sources'])
         else:
-            subject = random.choice(self._config['subjects'])
+            subject = self._payload.random_text(self.random.randint(1, 50))
 
-        self.send_mail(body, subject)
+        from_addr = self._config['email_addr']
+        to_addr = self.random.choice(self._config['destinations'])
+
+        message = MIMEText(body + '\n')
+        message['Subject'] = subject
+        message['From'] = from_addr
+        message['To'] = to_addr
+
+        return from_addr, to_addr, message.as_string()
 
     def cleanup(self):
         """ Doesn't need to do anything.
@@ -58,6 +151,13 @@ class SMTP(task.Task):
         """
         return ''
 
+    @classmethod
+    def prime(cls, config):
+        """ Connect ahead of time so that the first run finds a connection in the pool.
+        """
+        key = (config['mail_server'], config['port'], config['encrypt'])
+        pool.prime(key, functools.partial(connect, *key))
+
     @classmethod
     def parameters(cls):
         """ Returns a dictionary with the required and optional parameters of the class, with human-readable
@@ -80,7 +180,14 @@ class SMTP(task.Task):
                                            'headers.',
                                'encrypt': 'bool| Whether to use SSL encryption when connecting to the e-mail server. '
                                           'Defaults to False.',
-                               'port': 'int| Mail server port. Default is 25.'}}
+                               'port': 'int| Mail server port. Default is 25.',
+                               'generate': 'str| How to generate messages and subjects if none are given: "random" '
+                                           'for random letters, or "corpus" for sentences in the style of the text '
+                                           'sources. Defaults to "random".',
+                               'text_sources': '[str]| Text files to generate sentences from if generate is "corpus". '
+                                               'Defaults to ["aliceinwonderland.txt"].',
+                               'batch': 'int| Number of e-mails to send over the same connection each time this task '
+                                        'runs. Default is 1.'}}
 
         return params
 
@@ -104,7 +211,10 @@ class SMTP(task.Task):
         defaults = {'messages': [],
                     'subjects': [],
                     'encrypt': False,
-                    'port': 25}
+                    'port': 25,
+                    'generate': 'random',
+                    'text_sources': [payload.CORPUS],
+                    'batch': 1}
         config = api.check_config(config, cls.parameters(), defaults)
 
         if not config['destinations']:
@@ -113,33 +223,16 @@ class SMTP(task.Task):
         if not config['mail_server']:
             raise ValueError('mail_server: {} Must be non-empty'.format(str(config['mail_server'])))
 
-        return config
+        if config['generate'] not in ['random', 'corpus']:
+            raise ValueError('generate: {} Must be "random" or "corpus"'.format(str(config['generate'])))
 
-    def _asbase64(self, message):
-        return str.replace(base64.encodestring(message), '\n', '')
+        if not config['text_sources']:
+            raise ValueError('text_sources: {} Must be non-empty'.format(str(config['text_sources'])))
 
-    def send_mail(self, body, subject):
-        """ Constructs an e-mail message (a MIMEText object) and sends it to toaddr. Connects to an exchange server if
-        desired.
+        if config['batch'] < 1:
+            raise ValueError('batch: {} Must be positive'.format(str(config['batch'])))
 
-        Args:
-            body (str): The body of the e-mail
-            subject (str): The subject header of the e-mail
-        """
-        server = self._config['mail_server']
-        port = self._config['port']
-        from_addr = self._config['email_addr']
-        to_addr = random.choice(self._config['destinations'])
-
-        message = MIMEText(body + '\n')
-        message['Subject'] = subject
-        message['From'] = from_addr
-        message['To'] = to_addr
-
-        if self._config['encrypt']:
-            s = smtplib.SMTP_SSL(server, port)
-        else:
-            s = smtplib.SMTP(server, port)
+        return config
 
-        s.sendmail(from_addr, to_addr, message.as_string())
-        s.quit()
+    def _asbase64(self, message):
+        return str.replace(base64.encodestring(message), '\n', '')
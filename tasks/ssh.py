@@ -4,25 +4,68 @@
 # June 16, 2017
 # Adapted from code written by Rotem Guttman and Joe Vessella
 
+import contextlib
+import functools
+import re
+import select
 import sys
 import time
 
 import paramiko
 
 import api
+from tasks import broker
 from tasks import task
 
 
 MAX_RECV = 4096
 BLOCKING = True
+# Seconds between keepalive packets on cached transports, so that idle connections are not dropped by firewalls.
+KEEPALIVE = 30
+
+def connect(host, port, user, password, policy):
+    """ Connect and authenticate to an SSH server.
+
+    Args:
+        host (str): Hostname of the SSH server.
+        port (int): Port of the SSH server.
+        user (str): Username to log in with.
+        password (str): Password to log in with.
+        policy (str): Missing host key policy, one of AutoAdd, Reject or Warning.
+
+    Returns:
+        paramiko.SSHClient: The connected client.
+    """
+    client = paramiko.SSHClient()
+    if policy == 'AutoAdd':
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    elif policy == 'Reject':
+        client.set_missing_host_key_policy(paramiko.RejectPolicy())
+    elif policy == 'Warning':
+        client.set_missing_host_key_policy(paramiko.WarningPolicy())
+    client.connect(host, port, user, password)
+    client.get_transport().set_keepalive(KEEPALIVE)
+    return client
+
+def is_active(client):
+    transport = client.get_transport()
+    return transport is not None and transport.is_active()
+
+# One authenticated transport per (host, port, user, password digest), shared by all SSH tasks. Each task run opens a
+# new channel on it, which skips the key exchange and authentication. Checking a transport is cheap, so it's done on
+# every reuse.
+pool = broker.register(broker.Pool('ssh', lambda client: client.close(), is_active, max_per_key=1, check_after=0))
 
 class SSH(task.Task):
     """ Connects to and authenticates with a host via SSH, then sends a sequence of shell commands.
     """
+    parallel_init = True
+
     def __init__(self, config):
         """ Validates config and stores it as an attribute
         """
         self._config = config
+        self._prompt = re.compile(config['prompt']) if config['prompt'] else None
 
     def __call__(self):
         """ Connects to the SSH server specified in config.
@@ -56,45 +99,90 @@ class SSH(task.Task):
         return ''
 
     def ssh_to(self, host, user, password, command_list, policy, port):
-        """ Connects to an SSH server at host:port with user as the username and password as the password. Proceeds to
-        execute all commands in command_list.
+        """ Opens a shell on the SSH server at host:port with user as the username and password as the password, reusing
+        a cached connection if there is one. Proceeds to execute all commands in command_list. If the task is cancelled,
+        the channel is closed and no more commands are sent.
         """
-        ssh = paramiko.SSHClient()
-        if policy == 'AutoAdd':
-            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        elif policy == 'Reject':
-            ssh.set_missing_host_key_policy(paramiko.RejectPolicy())
-        elif policy == 'Warning':
-            ssh.set_missing_host_key_policy(paramiko.WarningPolicy())
-        ssh.connect(host, port, user, password)
-        channel = ssh.invoke_shell()
+        self.cancel_token.check()
+        channel = self._open_shell(host, port, user, password, policy)
         channel.setblocking(int(BLOCKING))
-        channel.sendall('')
-        incoming = ''
 
-        # Receive the welcome message from the server and print it.  If any of this fails, something went wrong with
-        # the connection.
-        while channel.recv_ready():
-            incoming += channel.recv(MAX_RECV).decode()
-            time.sleep(.1)
-        sys.stdout.write(incoming)
-
-        for command in command_list:
-            channel.sendall(command + '\n')
-            time.sleep(.5)
-            incoming = ''
-            while channel.recv_ready():
-                incoming += channel.recv(MAX_RECV).decode()
-                time.sleep(.1)
-            sys.stdout.write(incoming)
+        # Only the channel is closed, so that the connection can be reused. Closing it also wakes up _read.
+        with contextlib.closing(channel), self.cancel_token.closing(channel.close):
+            # Receive the welcome message from the server and print it.
+            sys.stdout.write(self._read(channel))
+
+            for command in command_list:
+                self.cancel_token.check()
+                channel.sendall(command + '\n')
+                sys.stdout.write(self._read(channel))
 
-        try:
-            ssh.close()
-        except:
-            pass
         # So that the next output will be on a new line
         print()
 
+    def _open_shell(self, host, port, user, password, policy):
+        """ Open an interactive shell on the pooled transport, connecting first if there is no active one.
+
+        Returns:
+            paramiko.Channel: A new shell channel.
+        """
+        key = (host, port, user, broker.digest(password))
+        connect_ = functools.partial(connect, host, port, user, password, policy)
+
+        for attempt in range(2):
+            client = pool.lease(key, connect_)
+            try:
+                channel = client.invoke_shell()
+            except (paramiko.SSHException, OSError):
+                pool.release(key, client, False)
+                if attempt:
+                    raise
+                # The transport died after it was checked, so try once more with a new one.
+                continue
+            # Channels are independent of each other, so the transport can be shared right away.
+            pool.release(key, client)
+            return channel
+
+    def _read(self, channel):
+        """ Receive output until the prompt is seen, or until no output has arrived for a while if there is no prompt.
+        Waits on the channel rather than sleeping, so it returns as soon as the output is complete.
+
+        Args:
+            channel (paramiko.Channel): The shell to read from.
+
+        Returns:
+            str: The output received.
+        """
+        incoming = ''
+        deadline = time.time() + self._config['timeout']
+
+        while time.time() < deadline:
+            readable, _, _ = select.select([channel], [], [], max(0, min(self._config['idle'], deadline - time.time())))
+            if not readable:
+                # Idle for long enough without a prompt to wait for.
+                if not self._prompt:
+                    break
+                continue
+
+            data = channel.recv(MAX_RECV)
+            if not data:
+                # The server closed the channel, e.g. after an exit command.
+                break
+            incoming += data.decode(errors='replace')
+
+            if self._prompt and self._prompt.search(incoming.rstrip('\n').rsplit('\n', 1)[-1]):
+                break
+
+        return incoming
+
+    @classmethod
+    def prime(cls, config):
+        """ Connect ahead of time so that the first run finds an authenticated connection in the pool.
+        """
+        address = (config['host'], config['port'], config['user'])
+        pool.prime(address + (broker.digest(config['password']),),
+                   functools.partial(connect, *address, config['password'], config['policy']))
+
     @classmethod
     def parameters(cls):
         """ Returns a dictionary with the required and optional parameters of the class, with human-readable
@@ -111,7 +199,14 @@ class SSH(task.Task):
                                'command_list': '[str]| commands to send, ex. ["ls -la", "cat README"]'},
                   'optional': {'port': 'int| the port on which to connect to the SSH server, ex. 22.  Default is 22',
                                'policy': 'str| which policy to adopt in regards to missing host keys, should be one of '
-                                         'AutoAdd, Reject, or Warning. Default is Warning'}}
+                                         'AutoAdd, Reject, or Warning. Default is Warning',
+                               'prompt': 'str| regular expression matching the last line of the shell prompt, ex. '
+                                         '"\\$ $". Output of a command is complete once it is seen. Default is to '
+                                         'wait until no output arrives for idle seconds',
+                               'idle': 'number| seconds without output after which the output of a command is '
+                                       'considered complete, if no prompt is given. Default is 0.3',
+                               'timeout': 'number| maximum seconds to wait for the output of a command. Default is '
+                                          '30'}}
         return params
 
     @classmethod
@@ -130,7 +225,10 @@ class SSH(task.Task):
             dict: The dict given as the config argument with missing optional parameters added with default values.
         """
         defaults = {'port': 22,
-                    'policy': 'Warning'}
+                    'policy': 'Warning',
+                    'prompt': '',
+                    'idle': .3,
+                    'timeout': 30}
         config = api.check_config(config, cls.parameters(), defaults)
 
         if not config['host']:
@@ -144,4 +242,13 @@ class SSH(task.Task):
         if config['port'] < 1 or config['port'] > 65535:
             raise ValueError('port: {} Must be in the range [1, 65535]'.format(str(config['port'])))
 
+        try:
+            re.compile(config['prompt'])
+        except re.error:
+            raise ValueError('prompt: {} Must be a valid regular expression'.format(str(config['prompt'])))
+        if config['idle'] <= 0:
+            raise ValueError('idle: {} Must be positive'.format(str(config['idle'])))
+        if config['timeout'] <= 0:
+            raise ValueError('timeout: {} Must be positive'.format(str(config['timeout'])))
+
         return config
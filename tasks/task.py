@@ -1,8 +1,27 @@
 # Copyright 2017 Carnegie Mellon University. See LICENSE.md file for terms.
 
+import random
+
+import usersim
+
+
 class Task(object):
     """ The highest common ancestor for all other tasks.
     """
+    # Set to True in subclasses whose constructors are thread-safe and don't need to run on the main thread. Their tasks
+    # are then constructed in parallel in background threads, so that slow constructors don't hold up the simulation.
+    parallel_init = False
+    # Replaced by the scheduler with a usersim.CancelToken of the task's own, which is cancelled once the task is
+    # stopped or times out. Tasks constructed outside the scheduler, such as in tests, share one that is never
+    # cancelled.
+    cancel_token = usersim.CancelToken()
+    # Random number generator for the task's choices. Replaced by the scheduler with the generator of the virtual user
+    # the task acts for, so that each user's choices come from its own seeded generator. Defaults to the random module.
+    random = random
+    # Set to True in subclasses that fill in placeholders in the configurations of their nested tasks when they run,
+    # such as $user. Those configurations are incomplete until then, so their tasks are not primed.
+    substitutes = False
+
     def __init__(self, config):
         raise NotImplementedError('Not yet implemented.')
 
@@ -36,6 +55,18 @@ class Task(object):
         """
         raise NotImplementedError('Not yet implemented.')
 
+    @classmethod
+    def prime(cls, config):
+        """ Called in a background thread when a configuration for this task is loaded, before the task first runs. Use
+        this method to warm up anything slow that the task will need and that outlives the task, such as pooled network
+        sessions or a shared browser, so that the task's first run isn't delayed by it. It must be safe to call from any
+        thread, at the same time as the task runs. Errors are ignored. Overriding this method is optional.
+
+        Args:
+            config (dict): A validated configuration for this task. See validate.
+        """
+        pass
+
     @classmethod
     def parameters(cls):
         """ Returns a dictionary with the required and optional parameters of the class, with human-readable
@@ -1,24 +1,116 @@
 # Copyright 2017 Carnegie Mellon University. See LICENSE.md file for terms.
 
+import functools
+import re
 import telnetlib
-import time
+import threading
+import traceback
 
 import api
+from tasks import broker
 from tasks import task
+import usersim
 
 
+def close(session):
+    """ Log out and close a session.
+    """
+    try:
+        session.write(b'exit\n')
+    except OSError:
+        pass
+    session.close()
+
+def abort(session):
+    broker.shutdown_socket(session.get_socket())
+    session.close()
+
+# Logged in sessions kept open between runs of Telnet tasks, keyed by (host, port, username, password digest, prompt).
+# Since checking a session needs its task's prompt, tasks check idle sessions themselves.
+pool = broker.register(broker.Pool('telnet', close, abort=abort))
+
+def login(hostname, port, username, password, config):
+    """ Opens a new session and logs in.
+
+    Args:
+        hostname (str): Host to connect to.
+        port (int): Port to connect to.
+        username (str): Username to log in with.
+        password (str): Password to log in with. Not sent if empty.
+        config (dict): A validated Telnet config, for its prompts and timeout.
+
+    Returns:
+        telnetlib.Telnet: A session waiting at the shell prompt.
+    """
+    session = telnetlib.Telnet(hostname, port, config['timeout'])
+
+    try:
+        # telnetclient.write expects byte input so we have to encode it.
+        expect(session, config, 'login_prompt')
+        session.write((username + '\n').encode('ascii'))
+        if password:
+            expect(session, config, 'password_prompt')
+            session.write((password + '\n').encode('ascii'))
+        expect(session, config, 'prompt')
+    except Exception:
+        session.close()
+        raise
+
+    return session
+
+def expect(session, config, name):
+    """ Read until one of the prompts in config matches the output received so far.
+
+    Args:
+        session (telnetlib.Telnet): The session to read from.
+        config (dict): A validated Telnet config, for its prompts and timeout.
+        name (str): The configuration key of the prompt's regular expression.
+
+    Raises:
+        TimeoutError: If the prompt did not match within the timeout.
+        EOFError: If the connection was closed.
+
+    Returns:
+        str: The output received.
+    """
+    # re caches compiled patterns, so this doesn't compile them again on every call.
+    regex = re.compile(config[name].encode())
+    index, match, data = session.expect([regex], config['timeout'])
+    if index < 0:
+        raise TimeoutError('Timed out waiting for {} {}, received: {}'.format(name, regex.pattern, data))
+    return data.decode('ascii', errors='replace')
+
 class Telnet(task.Task):
-    """ Connect to the configured machine and send it a list of commands via Telnet.
+    """ Connect to the configured machine and send it a list of commands via Telnet. The session runs in its own thread
+    and waits for the configured prompts rather than for fixed delays, so it takes as long as the remote host takes to
+    reply. Logged in sessions are reused by later runs with the same host, port and username.
     """
+    parallel_init = True
+
     def __init__(self, config):
         self._config = config
+        self._thread = None
+        self._done = threading.Event()
 
     def __call__(self):
-        self.telnet_to(self._config['host'],
-                       self._config['port'],
-                       self._config['username'],
-                       self._config['password'],
-                       self._config['commandlist'])
+        if not self._thread:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        try:
+            self.telnet_to(self._config['host'],
+                           self._config['port'],
+                           self._config['username'],
+                           self._config['password'],
+                           self._config['commandlist'])
+        except Exception:
+            # Errors caused by cancelling the task, such as the session being aborted, aren't worth reporting.
+            if not self.cancel_token.cancelled:
+                api.add_feedback(self._task_id, traceback.format_exc())
+        finally:
+            self._done.set()
 
     def cleanup(self):
         """
@@ -28,28 +120,62 @@ class Telnet(task.Task):
 
     def stop(self):
         """
-        Task should stop after it is run once
+        Task should stop once its session has finished
         """
-        return True
+        return self._done.is_set()
 
     def status(self):
-        return ''
+        if self._done.is_set():
+            return 'Session finished.'
+        return 'Session running.' if self._thread else ''
 
     def telnet_to(self, hostname, port, username, password, commandlist):
-        telnetclient = telnetlib.Telnet(hostname, port, 10)
+        """ Runs commandlist on a logged in session, logging in first if there is no idle session to reuse. If the task
+        is cancelled, the session is aborted and no more commands are sent.
+        """
+        key = (hostname, port, username, broker.digest(password), self._config['prompt'])
 
-        # telnetclient.write expects byte input so we have to encode it.
-        telnetclient.write((username + '\n').encode('ascii'))
-        if password:
-            telnetclient.write((password + '\n').encode('ascii'))
-            time.sleep(4)
-        for command in commandlist:
-            telnetclient.write((command + '\n').encode('ascii'))
-            time.sleep(1)
-            print(telnetclient.read_very_eager())
-        time.sleep(2)
-        telnetclient.write(('exit\n').encode('ascii'))
-        telnetclient.close()
+        while True:
+            self.cancel_token.check()
+            created = []
+
+            def connect():
+                created.append(True)
+                return login(hostname, port, username, password, self._config)
+
+            session = pool.lease(key, connect)
+            if created:
+                break
+
+            try:
+                with self.cancel_token.closing(functools.partial(abort, session)):
+                    # Make sure the server hasn't closed the idle session.
+                    session.write(b'\n')
+                    expect(session, self._config, 'prompt')
+                break
+            except (EOFError, OSError, TimeoutError, usersim.Cancelled):
+                pool.release(key, session, False)
+
+        try:
+            with self.cancel_token.closing(functools.partial(abort, session)):
+                for command in commandlist:
+                    self.cancel_token.check()
+                    session.write((command + '\n').encode('ascii'))
+                    print(expect(session, self._config, 'prompt'))
+        except Exception:
+            pool.release(key, session, False)
+            raise
+
+        pool.release(key, session, not self.cancel_token.cancelled)
+
+    @classmethod
+    def prime(cls, config):
+        """ Log in ahead of time so that the first run finds a session waiting at the prompt in the pool.
+        """
+        key = (config['host'], config['port'], config['username'], broker.digest(config['password']),
+               config['prompt'])
+        pool.prime(key, functools.partial(login, config['host'], config['port'], config['username'], config['password'],
+                                          config))
 
     @classmethod
     def parameters(cls):
@@ -57,10 +183,33 @@ class Telnet(task.Task):
                                    'username': 'str| username to connect with',
                                    'password': 'str| password to connect with',
                                    'commandlist': '[str]| commands to send'},
-                      'optional': {'port': 'int| port to connect on, default 23'}}
+                      'optional': {'port': 'int| port to connect on, default 23',
+                                   'login_prompt': 'str| regular expression matching the end of the login prompt, '
+                                                   'default "(?i)login: ?$"',
+                                   'password_prompt': 'str| regular expression matching the end of the password '
+                                                      'prompt, default "(?i)password: ?$"',
+                                   'prompt': 'str| regular expression matching the end of the shell prompt, which '
+                                             'marks the output of a command as complete, default "[$#>] ?$"',
+                                   'timeout': 'number| seconds to wait for a prompt before giving up, default 10'}}
 
         return parameters
 
     @classmethod
     def validate(cls, config):
-        return api.check_config(config, cls.parameters(), {'port': 23})
+        defaults = {'port': 23,
+                    'login_prompt': '(?i)login: ?$',
+                    'password_prompt': '(?i)password: ?$',
+                    'prompt': '[$#>] ?$',
+                    'timeout': 10}
+        config = api.check_config(config, cls.parameters(), defaults)
+
+        for key in ['login_prompt', 'password_prompt', 'prompt']:
+            try:
+                re.compile(config[key])
+            except re.error:
+                raise ValueError('{}: {} Must be a valid regular expression'.format(key, config[key]))
+
+        if config['timeout'] <= 0:
+            raise ValueError('timeout: {} Must be positive'.format(config['timeout']))
+
+        return config
@@ -0,0 +1,114 @@
+# Copyright 2017 Carnegie Mellon University. See LICENSE.md file for terms.
+
+import string
+
+import api
+from tasks import all
+
+
+class User(all.All):
+    """ Simulates one or more virtual users, each running its own copy of the nested tasks. All virtual users share the
+    same simulator, so hundreds of them can run in a single process. Each user gets its own random number generator and
+    credentials, and its tasks are tagged with the user's name in status and feedback messages. This task is stopped
+    once all nested tasks of all its users have stopped.
+    """
+    substitutes = True
+
+    def __init__(self, config):
+        super().__init__(config)
+        self._name = config['name']
+        self._count = config['count']
+        self._seed = config['seed']
+        self._credentials = config['credentials']
+
+    def _start_tasks(self):
+        """ Create each virtual user and start its copy of the nested tasks.
+        """
+        for i in range(self._count):
+            name = self._name if self._count == 1 else '{}{}'.format(self._name, i + 1)
+            seed = None if self._seed < 0 else self._seed + i
+            credentials = {key: string.Template(var_name).safe_substitute(user=name)
+                           for key, var_name in self._credentials.items()}
+
+            user = api.new_user(name, seed, credentials)
+
+            values = dict(user.credentials)
+            values['user'] = name
+
+            for task in self._tasks:
+                self._track(api.new_task(substitute(task, values), user=user))
+
+    def status(self):
+        return 'Simulating {} virtual users. {}'.format(self._count, super().status())
+
+    @classmethod
+    def parameters(cls):
+        """ Returns a dictionary with the required and optional parameters of the class, with human-readable
+        descriptions for each.
+
+        Returns:
+            dict of dicts: A dictionary whose keys are 'required' and 'optional', and whose values are dictionaries
+                containing the required and optional parameters of the class as keys and human-readable (str)
+                descriptions and requirements for each key as values.
+        """
+        required = {'name': 'str| Name of the virtual user. If count is more than 1, the users are named by appending '
+                            '1, 2, 3 and so on to this name.',
+                    'tasks': '[task]| The tasks each virtual user runs. Any $user in their strings is replaced with '
+                             'the name of the user.'}
+        optional = {'count': 'int| Number of virtual users to simulate with these tasks. Default is 1.',
+                    'seed': 'int| Seed for the first user\'s random number generator. Each following user adds 1 to '
+                            'it. Negative for random seeding. Default is -1.',
+                    'credentials': '{str: str}| Maps a placeholder to the name of an external variable (environment '
+                                   'or VMWare guestinfo variable) holding a credential. Any $placeholder in the '
+                                   'strings of the nested tasks is replaced with the value of the variable. Variable '
+                                   'names may contain $user, which is replaced with the name of the user. Default is '
+                                   'no credentials.'}
+
+        return {'required': required, 'optional': optional}
+
+    @classmethod
+    def validate(cls, config):
+        """ Validates the given configuration dictionary.
+
+        Args:
+            config (dict): The dictionary to validate. See parameters() for required format.
+
+        Raises:
+            KeyError: If a required configuration option is missing. The error message is the missing key.
+            ValueError: If a configuration option's value is not valid. The error message is in the following format:
+                key: value requirement
+
+        Returns:
+            dict: The dict given as the config argument with missing optional parameters added with default values.
+        """
+        defaults = {'count': 1, 'seed': -1, 'credentials': {}}
+        config = api.check_config(config, cls.parameters(), defaults)
+
+        if not config['name']:
+            raise ValueError('name: {} Must be non-empty.'.format(config['name']))
+
+        if not config['tasks']:
+            raise ValueError('tasks: {} Must contain at least one task.'.format(config['tasks']))
+
+        if config['count'] < 1:
+            raise ValueError('count: {} Must be positive.'.format(config['count']))
+
+        return config
+
+def substitute(value, values):
+    """ Replace $placeholders in every string within a nested structure of lists and dicts.
+
+    Args:
+        value (any): A task configuration, or any part of one.
+        values (dict): Maps placeholder names to their replacements.
+
+    Returns:
+        any: A copy of value with placeholders replaced. Unknown placeholders are left as they are.
+    """
+    if isinstance(value, str):
+        return string.Template(value).safe_substitute(values)
+    elif isinstance(value, list):
+        return [substitute(item, values) for item in value]
+    elif isinstance(value, dict):
+        return {key: substitute(item, values) for key, item in value.items()}
+    return value
@@ -6,7 +6,6 @@
 
 import os
 import platform
-import random
 import time
 
 try:
@@ -17,6 +16,7 @@ except ImportError:
     pass
 
 import api
+from tasks import payload
 from tasks import task
 
 
@@ -39,7 +39,8 @@ class Word(task.Task):
         """ Launches word and creates/modifies a document as specified in the config dictionary.
         """
         self._word = self._start_word()
-        self.change_doc(self._config['new_doc'], self._config['text_source'], random.choice(self._config['file_types']))
+        self.change_doc(self._config['new_doc'], self._config['text_source'],
+                        self.random.choice(self._config['file_types']))
 
     def cleanup(self):
         """ Deletes the file that was created/modified by this instance of Word. Will only perform cleanup if
@@ -142,7 +143,8 @@ class Word(task.Task):
 
     @staticmethod
     def _get_text(text_source, line_count=5):
-        """ Get a random concatenation of lines from the specified file.
+        """ Get a random concatenation of lines from the specified file. The file is only read and indexed the first
+        time it is used.
 
         Args:
             text_source (str): Properly-escaped path to the text source.
@@ -152,12 +154,12 @@ class Word(task.Task):
             str: A concatenation of the lines pulled from the file.
         """
         try:
-            with open(text_source) as f:
-                lines = f.readlines()
+            lines = payload.get_corpus([text_source]).lines(line_count)
         except IOError:
-            lines = ['Text source invalid!']
-        text_list = [random.choice(lines) for i in range(line_count)]
-        return ' '.join(text_list)
+            lines = []
+        if not lines:
+            lines = ['Text source invalid!'] * line_count
+        return ' '.join(line + '\n' for line in lines)
 
     def _start_word(self):
         """ Launch Word through the COM system. Also populates the self._converter dictionary.
@@ -212,14 +214,14 @@ class Word(task.Task):
         if new_doc or not doc_list:
             doc = self._word.Documents.Add()
             # Generate a unique filename for the document
-            filename = random.choice(self._filename_bank) + str(random.randint(0, 100))
+            filename = self.random.choice(self._filename_bank) + str(self.random.randint(0, 100))
             # If filename is already taken, keep generating names until we get a unique one
             while filename in doc_list:
-                filename = random.choice(self._filename_bank) + str(random.randint(0, 100))
+                filename = self.random.choice(self._filename_bank) + str(self.random.randint(0, 100))
             # Only allow removal if the doc was new.
             self._filename = filename
         else:
-            filename = random.choice(doc_list)
+            filename = self.random.choice(doc_list)
             doc = self._word.Documents.Open(os.path.join(self._doc_path, filename))
 
         time.sleep(1) # Wait for the document to open
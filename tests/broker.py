@@ -0,0 +1,191 @@
+# Copyright 2017 Carnegie Mellon University. See LICENSE.md file for terms.
+
+import itertools
+import threading
+import time
+
+import api
+from tasks import broker
+import usersim
+
+
+class Session(object):
+    """ Stands in for a network session.
+    """
+    counter = itertools.count(1)
+
+    def __init__(self):
+        self.number = next(self.counter)
+        self.closed = False
+        self.healthy = True
+
+def close(session):
+    session.closed = True
+
+def test_reuse():
+    pool = broker.Pool('test_reuse', close)
+
+    first = pool.lease('a', Session)
+    pool.release('a', first)
+    assert pool.lease('a', Session) is first
+
+    # Different keys never share sessions.
+    other = pool.lease('b', Session)
+    assert other is not first
+
+    # Unusable sessions are closed instead of being reused.
+    pool.release('a', first, False)
+    assert first.closed
+    assert pool.lease('a', Session) is not first
+
+def test_session():
+    pool = broker.Pool('test_session', close)
+
+    try:
+        with pool.session('a', Session, (KeyError,)) as session:
+            raise KeyError('missing file')
+    except KeyError:
+        pass
+    assert not session.closed
+    assert pool.lease('a', Session) is session
+
+    try:
+        with pool.session('b', Session, (KeyError,)) as session:
+            raise ConnectionError('dropped')
+    except ConnectionError:
+        pass
+    assert session.closed
+
+def test_cancel():
+    aborted = []
+    pool = broker.Pool('test_cancel', close, abort=aborted.append)
+
+    token = usersim.CancelToken()
+    with pool.session('a', Session, cancel_token=token) as session:
+        # Cancelling aborts the session right away, from the cancelling thread.
+        token.cancel('Stopped.')
+        assert aborted == [session]
+    # A session that was aborted is not reused, even if the block finished.
+    assert session.closed
+    assert pool.metrics()['idle'] == 0
+
+    try:
+        with pool.session('a', Session, cancel_token=token):
+            raise AssertionError('Incorrectly leased a session for a cancelled token')
+    except usersim.Cancelled:
+        pass
+    assert pool.metrics()['leased'] == 0
+
+def test_health_check():
+    pool = broker.Pool('test_health_check', close, lambda session: session.healthy, check_after=0)
+
+    session = pool.lease('a', Session)
+    session.healthy = False
+    pool.release('a', session)
+
+    assert pool.lease('a', Session) is not session
+    assert session.closed
+    assert pool.metrics()['failed_checks'] == 1
+
+def test_eviction():
+    pool = broker.Pool('test_eviction', close, idle_timeout=0.1)
+
+    session = pool.lease('a', Session)
+    pool.release('a', session)
+    time.sleep(0.2)
+
+    assert pool.lease('b', Session) is not session
+    assert session.closed
+    assert pool.metrics()['evicted'] == 1
+
+def test_reaping():
+    pool = broker.Pool('test_reaping', close, idle_timeout=0.1)
+
+    first = pool.lease('a', Session)
+    second = pool.lease('b', Session)
+    pool.release('a', first)
+    time.sleep(0.2)
+
+    # Expired sessions are closed even if their key is never leased again.
+    pool.release('b', second)
+    assert first.closed
+    assert not second.closed
+
+    time.sleep(0.2)
+    assert pool.metrics()['idle'] == 0
+    assert second.closed
+
+def test_digest():
+    # Different passwords must lead to different keys, without the keys holding the passwords.
+    assert broker.digest('hunter2') != broker.digest('hunter3')
+    assert 'hunter2' not in broker.digest('hunter2')
+
+def test_limit():
+    pool = broker.Pool('test_limit', close, max_per_key=1, lease_timeout=0.2)
+
+    session = pool.lease('a', Session)
+    try:
+        pool.lease('a', Session)
+        raise AssertionError('Incorrectly exceeded the limit')
+    except TimeoutError:
+        print('Correctly waited for a session')
+
+    # A waiting lease gets the session as soon as it's returned.
+    timer = threading.Timer(0.05, pool.release, ('a', session))
+    timer.start()
+    assert pool.lease('a', Session) is session
+    timer.join()
+
+    pool.release('a', session)
+    pool.clear()
+    assert session.closed
+
+    metrics = pool.metrics()
+    assert metrics['created'] == 1
+    assert metrics['reused'] == 1
+    assert metrics['idle'] == 0
+    assert metrics['leased'] == 0
+
+def test_prime():
+    pool = broker.Pool('test_prime', close, max_per_key=1)
+
+    pool.prime('a', Session)
+    session = pool.lease('a', Session)
+    assert pool.metrics()['created'] == 1
+    assert pool.metrics()['reused'] == 1
+
+    # Priming a key at its limit must not wait for the leased session.
+    pool.prime('a', Session)
+    pool.release('a', session)
+    pool.prime('a', Session)
+    assert pool.metrics()['created'] == 1
+
+def test_metrics():
+    pool = broker.register(broker.Pool('test_metrics', close))
+    pool.lease('a', Session)
+
+    assert api.pool_metrics()['test_metrics']['leased'] == 1
+
+def run_test():
+    test_reuse()
+
+    test_session()
+
+    test_cancel()
+
+    test_health_check()
+
+    test_eviction()
+
+    test_reaping()
+
+    test_digest()
+
+    test_limit()
+
+    test_prime()
+
+    test_metrics()
+
+if __name__ == '__main__':
+    run_test()
@@ -0,0 +1,203 @@
+# Copyright 2017 Carnegie Mellon University. See LICENSE.md file for terms.
+
+import concurrent.futures
+import queue
+import time
+
+import rpyc
+
+import api
+from communication import controller
+from communication import rpc
+import usersim
+
+
+def test_fan_out(fleet):
+    for i in range(3):
+        rpc.RPCCommunication(queue.Queue(), '127.0.0.1', fleet.port, 'sim-{}'.format(i))
+    end = time.time() + 10
+    while fleet.names() != ['sim-0', 'sim-1', 'sim-2']:
+        assert time.time() < end, 'Timed out waiting for the usersims to register.'
+        time.sleep(.05)
+
+    # All usersims in this test share one simulator, so each of them adds a task to it.
+    task_ids = fleet.new_task({'type': 'testnostop', 'config': {}})
+    assert sorted(task_ids) == ['sim-0', 'sim-1', 'sim-2']
+    assert len(set(task_ids.values())) == 3
+
+    results = fleet.call('status_task', task_ids['sim-0'], names=['sim-0', 'unknown'])
+    assert list(results) == ['sim-0']
+    assert results['sim-0']['id'] == task_ids['sim-0']
+
+    # Commands are acknowledged right away, and applied at the next cycle.
+    assert fleet.pause_all() == {'sim-0': True, 'sim-1': True, 'sim-2': True}
+
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        results = executor.submit(fleet.call, 'stop_task', task_ids['sim-0'], names=['sim-0'], wait=True)
+        sim = usersim.UserSim()
+        end = time.time() + 10
+        while not results.done():
+            assert time.time() < end, 'Timed out waiting for the command to be applied.'
+            sim.cycle()
+            time.sleep(.05)
+        assert results.result() == {'sim-0': True}
+
+    # Errors on a usersim are returned rather than raised.
+    results = fleet.new_task({'type': 'nosuchtask', 'config': {}}, names=['sim-1'])
+    assert isinstance(results['sim-1'], Exception)
+
+def test_feedback(fleet):
+    connection = rpyc.connect('127.0.0.1', fleet.port)
+    try:
+        connection.root.register('reporter', 'Linux')
+        status = {'id': 4, 'type': 'ssh', 'state': api.States.STOPPED, 'status': '', 'user': ''}
+        connection.root.bulk_feedback([(status, 'Traceback'), (status, '')])
+
+        assert fleet.feedback.count() == 2
+        assert len(fleet.feedback.by_simulator('reporter')) == 2
+        assert len(fleet.feedback.by_type('ssh')) == 2
+        assert len(fleet.feedback.by_task('reporter', 4)) == 2
+        assert fleet.feedback.by_task('reporter', 5) == []
+        assert fleet.feedback.errors() == [('reporter', status, 'Traceback')]
+    finally:
+        connection.close()
+
+    end = time.time() + 10
+    while 'reporter' in fleet.names():
+        assert time.time() < end, 'Timed out waiting for the usersim to be dropped.'
+        time.sleep(.05)
+
+def test_partition():
+    shares = controller.partition([1, 5, 2, 2, 1, 3], {'a': 1, 'b': 1})
+    assert sorted(shares['a'] + shares['b']) == list(range(6))
+    assert sum([1, 5, 2, 2, 1, 3][index] for index in shares['a']) == 7
+
+    # A bin with twice the capacity gets twice the load, counting what it already has.
+    shares = controller.partition([1] * 6, {'a': 2, 'b': 1}, {'b': 1})
+    assert len(shares['a']) == 5
+    assert len(shares['b']) == 1
+
+    assert controller.estimate_cost({'type': 'sequence', 'config': {'tasks': [{'type': 'ssh', 'config': {}},
+                                                                              {'type': 'test', 'config': {}}]}}) == 4
+
+def test_scenario():
+    fleet = controller.Controller(grace=0)
+    fleet.start('127.0.0.1', 0)
+    connections = {}
+
+    try:
+        for name in ['a', 'b', 'c']:
+            connection = rpyc.connect('127.0.0.1', fleet.port, service=rpc.UserSimService)
+            connection.root.register(name, 'Linux')
+            # Serve the controller's calls.
+            connections[name] = (connection, rpyc.BgServingThread(connection))
+
+        results = fleet.load_scenario([{'type': 'testnostop', 'config': {}}] * 8, {'a': 2})
+        assert {name: len(ids) for name, ids in results.items()} == {'a': 4, 'b': 2, 'c': 2}
+        assert all(task_id > 0 for ids in results.values() for task_id in ids)
+
+        # Tasks of a usersim that disconnects are spread over the others.
+        close(*connections.pop('b'))
+        end = time.time() + 10
+        while 'b' in fleet.assignments() or sum(len(tasks) for tasks in fleet.assignments().values()) < 8:
+            assert time.time() < end, 'Timed out waiting for the tasks to be moved.'
+            time.sleep(.05)
+        assert sorted(fleet.assignments()) == ['a', 'c']
+    finally:
+        for connection, thread in connections.values():
+            close(connection, thread)
+        fleet.close()
+
+def test_reconnect():
+    fleet = controller.Controller(grace=1)
+    fleet.start('127.0.0.1', 0)
+    connections = {}
+
+    try:
+        for name in ['a', 'b']:
+            connection = rpyc.connect('127.0.0.1', fleet.port, service=rpc.UserSimService)
+            connection.root.register(name, 'Linux')
+            connections[name] = (connection, rpyc.BgServingThread(connection))
+
+        fleet.load_scenario([{'type': 'testnostop', 'config': {}}] * 4)
+        assignments = fleet.assignments()
+
+        # A usersim that reconnects within the grace period is still running its tasks, so it keeps them.
+        close(*connections.pop('b'))
+        end = time.time() + 10
+        while 'b' in fleet.names():
+            assert time.time() < end, 'Timed out waiting for the usersim to be dropped.'
+            time.sleep(.05)
+        connection = rpyc.connect('127.0.0.1', fleet.port, service=rpc.UserSimService)
+        connection.root.register('b', 'Linux')
+        connections['b'] = (connection, rpyc.BgServingThread(connection))
+
+        time.sleep(1.5)
+        assert fleet.assignments() == assignments
+    finally:
+        for connection, thread in connections.values():
+            close(connection, thread)
+        fleet.close()
+
+def test_unnamed():
+    sim = usersim.UserSim(True)
+    fleet = controller.Controller()
+    fleet.start('127.0.0.1', 0)
+
+    try:
+        assert fleet.load_scenario([{'type': 'testnostop', 'config': {}}] * 2) == {}
+
+        # A usersim is only given tasks once it registers under a name, so that it doesn't get them twice.
+        connection = rpyc.connect('127.0.0.1', fleet.port, service=rpc.UserSimService)
+        thread = rpyc.BgServingThread(connection)
+        try:
+            end = time.time() + 10
+            while not fleet.names():
+                assert time.time() < end, 'Timed out waiting for the usersim to connect.'
+                time.sleep(.05)
+            time.sleep(.2)
+            assert fleet.assignments() == {}
+
+            connection.root.register('a', 'Linux')
+            while len(api.status_all()) < 2:
+                assert time.time() < end, 'Timed out waiting for the tasks to be placed.'
+                sim.cycle()
+                time.sleep(.05)
+            time.sleep(.2)
+
+            sim.cycle()
+            assert len(api.status_all()) == 2
+        finally:
+            close(connection, thread)
+    finally:
+        fleet.close()
+
+def close(connection, thread):
+    thread.stop()
+    connection.close()
+
+def run_test():
+    usersim.UserSim(True)
+    fleet = controller.Controller(parallel=2)
+    fleet.start('127.0.0.1', 0)
+
+    try:
+        test_fan_out(fleet)
+
+        test_feedback(fleet)
+    finally:
+        fleet.close()
+
+    try:
+        test_partition()
+
+        test_scenario()
+
+        test_reconnect()
+
+        test_unnamed()
+    finally:
+        usersim.UserSim(True)
+
+if __name__ == '__main__':
+    run_test()
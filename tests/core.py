@@ -1,7 +1,11 @@
 # Copyright 2017 Carnegie Mellon University. See LICENSE.md file for terms.
 
+import threading
+import time
+
 import api
 import tasks
+from tasks import task
 import usersim
 
 
@@ -42,36 +46,299 @@ def test_scheduling():
     sim.cycle()
     assert api.status_task(1)['state'] == api.States.SCHEDULED
 
-    api.pause_all()
-    assert api.status_task(1)['state'] == api.States.TO_PAUSE
+    # Commands only take effect at the start of the next cycle.
+    future = api.pause_all()
+    assert not future.done()
+    assert api.status_task(1)['state'] == api.States.SCHEDULED
 
     # pauses should be idempotent
-    api.pause_task(1)
-    assert api.status_task(1)['state'] == api.States.TO_PAUSE
+    task_future = api.pause_task(1)
 
     sim.cycle()
+    assert future.result(0) is None
+    assert task_future.result(0)
     assert api.status_task(1)['state'] == api.States.PAUSED
 
-    api.unpause_all()
-    assert api.status_task(1)['state'] == api.States.TO_SCHEDULE
+    future = api.unpause_all()
+    assert api.status_task(1)['state'] == api.States.PAUSED
 
     # unpauses should be idempotent
-    api.unpause_task(1)
-    assert api.status_task(1)['state'] == api.States.TO_SCHEDULE
+    task_future = api.unpause_task(1)
 
     sim.cycle()
+    assert future.result(0) is None
+    assert task_future.result(0)
     assert api.status_task(1)['state'] == api.States.SCHEDULED
 
-    api.stop_all()
-    assert api.status_task(1)['state'] == api.States.TO_STOP
+    future = api.stop_all()
+    assert api.status_task(1)['state'] == api.States.SCHEDULED
 
     # stops should be idempotent
-    api.stop_task(1)
-    assert api.status_task(1)['state'] == api.States.TO_STOP
+    task_future = api.stop_task(1)
+
+    sim.cycle()
+    assert future.result(0) is None
+    assert task_future.result(0)
+    assert api.status_task(1)['state'] == api.States.STOPPED
+
+    # Commands for tasks that are gone fail once applied.
+    future = api.pause_task(1)
+    sim.cycle()
+    assert not future.result(0)
+
+def test_commands():
+    test_new_task_stop()
+    sim = usersim.UserSim()
+    sim.cycle()
+
+    # Commands are queued without waiting for the scheduler, and applied in order.
+    futures = []
+    with sim._operation_lock:
+        thread = threading.Thread(target=lambda: futures.extend([api.pause_task(1), api.unpause_all(),
+                                                                 api.stop_task(1)]))
+        thread.start()
+        thread.join(10)
+    assert len(futures) == 3, 'Commands waited for the operation lock.'
 
     sim.cycle()
+    assert [future.result(0) for future in futures] == [True, None, True]
     assert api.status_task(1)['state'] == api.States.STOPPED
 
+def test_completion():
+    test_new_task()
+    sim = usersim.UserSim()
+
+    stopped = []
+    assert api.subscribe_task(1, stopped.append)
+    future = api.future_task(1)
+
+    sim.cycle()
+    assert not stopped
+    assert not future.done()
+
+    sim.cycle()
+    assert len(stopped) == 1
+    assert stopped[0]['id'] == 1
+    assert future.result(0)['state'] == api.States.STOPPED
+
+    # Callbacks are only called once.
+    sim.cycle()
+    assert len(stopped) == 1
+
+    assert api.future_task(2) is None
+
+class SlowInit(task.Task):
+    """ Takes a while to construct, in parallel with other tasks.
+    """
+    parallel_init = True
+    started = threading.Event()
+    release = threading.Event()
+
+    def __init__(self, config):
+        self.started.set()
+        self.release.wait(10)
+
+    def __call__(self):
+        pass
+
+    def cleanup(self):
+        pass
+
+    def stop(self):
+        return False
+
+    def status(self):
+        return ''
+
+def test_parallel_init():
+    sim = usersim.UserSim(True)
+    task_id = sim.new_task(SlowInit, {})
+
+    # The cycle must neither wait for the constructor nor keep others from using the API in the meantime.
+    sim.cycle()
+    assert SlowInit.started.wait(10)
+    assert api.status_task(task_id)['state'] == api.States.PENDING
+    other_id = api.new_task({'type': 'testnostop', 'config': {}})
+    sim.cycle()
+    assert api.status_task(other_id)['state'] == api.States.SCHEDULED
+    assert api.status_task(task_id)['state'] == api.States.PENDING
+
+    SlowInit.release.set()
+    end = time.time() + 10
+    while api.status_task(task_id)['state'] != api.States.SCHEDULED:
+        assert time.time() < end, 'Timed out waiting for the task to be constructed.'
+        sim.cycle()
+        time.sleep(.01)
+
+class SlowCleanup(SlowInit):
+    """ Takes a while to clean up, then fails.
+    """
+    parallel_init = False
+    started = threading.Event()
+    release = threading.Event()
+
+    def __init__(self, config):
+        pass
+
+    def cleanup(self):
+        self.started.set()
+        self.release.wait(10)
+        raise Exception('Test exception raised.')
+
+    def status(self):
+        return 'cleaning'
+
+def test_cleanup():
+    sim = usersim.UserSim(True)
+    task_id = sim.new_task(SlowCleanup, {})
+    sim.cycle()
+    stopped = api.stop_task(task_id)
+
+    # Stopping must not wait for the cleanup.
+    start = time.time()
+    sim.cycle()
+    assert time.time() - start < 1
+    assert stopped.result(0)
+    assert SlowCleanup.started.wait(10)
+    assert api.status_task(task_id)['state'] == api.States.STOPPED
+
+    # The failure is reported at a later cycle.
+    SlowCleanup.release.set()
+    end = time.time() + 10
+    feedback = []
+    while not feedback:
+        assert time.time() < end, 'Timed out waiting for cleanup feedback.'
+        feedback = [(status, error) for status, error in sim.cycle() if status['id'] == task_id]
+        time.sleep(.01)
+    status, error = feedback[0]
+    assert status['state'] == api.States.STOPPED
+    assert status['status'] == 'cleaning'
+    assert 'Test exception raised.' in error
+
+    # A cleanup that takes too long is reported and left behind.
+    timeout = usersim.CLEANUP_TIMEOUT
+    usersim.CLEANUP_TIMEOUT = .1
+    try:
+        SlowCleanup.release.clear()
+        task_id = sim.new_task(SlowCleanup, {})
+        sim.cycle()
+        sim.stop_task(task_id)
+        sim.cycle()
+        end = time.time() + 10
+        feedback = []
+        while not feedback:
+            assert time.time() < end, 'Timed out waiting for cleanup feedback.'
+            feedback = [error for status, error in sim.cycle() if status['id'] == task_id]
+            time.sleep(.01)
+        assert 'did not finish' in feedback[0]
+    finally:
+        usersim.CLEANUP_TIMEOUT = timeout
+        SlowCleanup.release.set()
+
+class CountStatus(SlowInit):
+    """ Counts the calls to its status method.
+    """
+    parallel_init = False
+    calls = 0
+
+    def __init__(self, config):
+        pass
+
+    def status(self):
+        CountStatus.calls += 1
+        return str(CountStatus.calls)
+
+def test_snapshots():
+    sim = usersim.UserSim(True)
+    task_id = sim.new_task(CountStatus, {})
+    sim.cycle()
+    sim.cycle()
+    calls = CountStatus.calls
+    assert api.status_task(task_id)['status'] == str(calls)
+
+    # Queries only read the snapshot taken after the last run, even while the scheduler holds its lock.
+    results = []
+    with sim._operation_lock:
+        thread = threading.Thread(target=lambda: results.extend([api.status_task(task_id), api.status_all()]))
+        thread.start()
+        thread.join(10)
+    assert results, 'Status queries waited for the operation lock.'
+    assert results[0]['state'] == api.States.SCHEDULED
+    assert results[1] == [results[0]]
+    assert CountStatus.calls == calls
+
+    # State changes show up right away.
+    with sim._operation_lock:
+        assert sim._pause_single(task_id)
+    assert api.status_task(task_id)['state'] == api.States.TO_PAUSE
+    assert api.status_task(task_id)['status'] == str(calls)
+
+class WaitForCancel(SlowInit):
+    """ Runs until it is cancelled.
+    """
+    parallel_init = False
+
+    def __init__(self, config):
+        pass
+
+    def __call__(self):
+        self.cancel_token.wait(10)
+        self.cancel_token.check()
+
+def test_cancel():
+    sim = usersim.UserSim(True)
+    task_id = api.new_task({'type': 'testnostop', 'config': {}})
+    sim.cycle()
+    assert not sim._scheduled[task_id].cancel_token.cancelled
+
+    # Stopping a task cancels its token right away, while it's still running.
+    task_id = sim.new_task(WaitForCancel, {})
+
+    def stop():
+        while api.status_task(task_id)['state'] != api.States.SCHEDULED:
+            time.sleep(.01)
+        api.stop_task(task_id)
+
+    thread = threading.Thread(target=stop)
+    thread.start()
+    start = time.time()
+    feedback = sim.cycle()
+    thread.join()
+    assert time.time() - start < 5
+    # The Cancelled exception is not reported.
+    assert not [error for status, error in feedback if status['id'] == task_id and error]
+
+    sim.cycle()
+    assert api.status_task(task_id)['state'] == api.States.STOPPED
+
+def test_timeout():
+    for timeout in [0, -1, True, '1']:
+        try:
+            api.validate_config({'type': 'testnostop', 'config': {}, 'timeout': timeout})
+            raise AssertionError('Incorrectly accepted timeout {}'.format(timeout))
+        except ValueError:
+            pass
+
+    sim = usersim.UserSim(True)
+    task_id = api.new_task({'type': 'testnostop', 'config': {}, 'timeout': .2})
+    other_id = api.new_task({'type': 'testnostop', 'config': {}, 'timeout': 60})
+    end = time.time() + 10
+    feedback = []
+    while api.status_task(task_id)['state'] != api.States.STOPPED:
+        assert time.time() < end, 'Timed out waiting for the timeout.'
+        feedback.extend(sim.cycle())
+        time.sleep(.05)
+    assert any(status['id'] == task_id and 'timed out' in error for status, error in feedback)
+    assert api.status_task(other_id)['state'] == api.States.SCHEDULED
+
+    # A run in progress is cut short rather than stalling the cycle.
+    task_id = sim.new_task(WaitForCancel, {}, timeout=.2)
+    start = time.time()
+    sim.cycle()
+    assert time.time() - start < 5
+    sim.cycle()
+    assert api.status_task(task_id)['state'] == api.States.STOPPED
+
 def run_test():
     test_new_task()
 
@@ -81,5 +348,19 @@ def run_test():
 
     test_scheduling()
 
+    test_commands()
+
+    test_completion()
+
+    test_parallel_init()
+
+    test_cleanup()
+
+    test_snapshots()
+
+    test_cancel()
+
+    test_timeout()
+
 if __name__ == '__main__':
     run_test()
@@ -0,0 +1,116 @@
+# Copyright 2017 Carnegie Mellon University. See LICENSE.md file for terms.
+
+import threading
+
+import api
+from tasks import task
+import usersim
+
+
+class HeldCleanup(task.Task):
+    """ Holds up the cleanup of tasks stopped after it until released.
+    """
+    release = threading.Event()
+
+    def __init__(self, config):
+        pass
+
+    def __call__(self):
+        pass
+
+    def cleanup(self):
+        self.release.wait(10)
+
+    def stop(self):
+        return False
+
+    def status(self):
+        return ''
+
+
+def test_bad_value_cases():
+    test = {'type': 'test', 'config': {}}
+    bad_configs = [{'nodes': {}},
+                   {'nodes': {'a': test}, 'dependencies': {'b': ['a']}},
+                   {'nodes': {'a': test}, 'dependencies': {'a': ['b']}},
+                   {'nodes': {'a': test}, 'dependencies': {'a': ['a']}},
+                   {'nodes': {'a': test, 'b': test, 'c': test}, 'dependencies': {'a': ['c'], 'b': ['a'], 'c': ['b']}}]
+    for config in bad_configs:
+        try:
+            api.validate_config({'type': 'dag', 'config': config})
+            raise AssertionError('Incorrectly accepted {}'.format(config))
+        except ValueError:
+            print('Correctly rejected {}'.format(config))
+
+def test_diamond():
+    # b and c run in parallel once a stops, and d waits for both.
+    config = {'type': 'dag',
+              'config': {'nodes': {'a': {'type': 'test', 'config': {}},
+                                   'b': {'type': 'test', 'config': {}},
+                                   'c': {'type': 'testfeedback', 'config': {}},
+                                   'd': {'type': 'test', 'config': {}}},
+                         'dependencies': {'b': ['a'], 'c': ['a'], 'd': ['b', 'c']}}}
+
+    sim = usersim.UserSim(True)
+
+    task_id = api.new_task(config)
+
+    stopped = []
+    api.subscribe_task(task_id, stopped.append)
+
+    for i in range(20):
+        sim.cycle()
+        if stopped:
+            break
+
+    assert stopped, 'The DAG task never stopped.'
+    assert stopped[0]['id'] == task_id
+    assert stopped[0]['state'] == api.States.STOPPED
+
+    finished = stopped[0]['status'].split('.')[0].split(': ')[1].split(', ')
+    assert finished[0] == 'a'
+    assert set(finished[1:3]) == {'b', 'c'}
+    assert finished[3] == 'd'
+
+    # Subscribing to a task that has already stopped calls back right away.
+    late = []
+    assert api.subscribe_task(task_id, late.append)
+    assert late and late[0]['state'] == api.States.STOPPED
+
+    assert not api.subscribe_task(task_id + 100, late.append)
+
+def test_stop():
+    config = {'type': 'dag',
+              'config': {'nodes': {'a': {'type': 'testnostop', 'config': {}},
+                                   'b': {'type': 'test', 'config': {}}},
+                         'dependencies': {'b': ['a']}}}
+
+    sim = usersim.UserSim(True)
+
+    held_id = sim.new_task(HeldCleanup, {})
+    task_id = api.new_task(config)
+    while api.status_task(task_id + 1)['state'] != api.States.SCHEDULED:
+        sim.cycle()
+
+    # b must not start once the DAG has been stopped, even though the DAG's cleanup waits behind another one.
+    HeldCleanup.release.clear()
+    try:
+        api.stop_task(held_id)
+        sim.cycle()
+        api.stop_task(task_id)
+        api.stop_task(task_id + 1)
+        for i in range(5):
+            sim.cycle()
+        assert api.status_task(task_id + 2)['state'] == api.States.UNKNOWN
+    finally:
+        HeldCleanup.release.set()
+
+def run_test():
+    test_bad_value_cases()
+
+    test_diamond()
+
+    test_stop()
+
+if __name__ == '__main__':
+    run_test()
@@ -1,10 +1,13 @@
 # Copyright 2017 Carnegie Mellon University. See LICENSE.md file for terms.
 
+import time
+
 import api
+from tasks import frequency
 import usersim
 
 
-def run_test():
+def test_frequency():
     reps = 10
     config = {'type': 'frequency',
               'config': {'frequency': 2000,
@@ -26,5 +29,68 @@ def run_test():
         if api.status_task(task_id + reps)['state'] == api.States.STOPPED:
             break
 
+def test_profile():
+    bad_profiles = [{'2500': 1}, {'0900': -1}, {'0900': 0, '1700': 0}]
+    for profile in bad_profiles:
+        config = {'type': 'frequency',
+                  'config': {'frequency': 10,
+                             'repetitions': 1,
+                             'profile': profile,
+                             'task': {'type': 'test',
+                                      'config': {}}}}
+        try:
+            api.validate_config(config)
+            raise AssertionError('Incorrectly accepted profile {}'.format(profile))
+        except ValueError:
+            print('Correctly rejected profile {}'.format(profile))
+
+    # A high rate with a burst covering the whole day, so that several triggers land in the same cycle.
+    reps = 20
+    config = {'type': 'frequency',
+              'config': {'frequency': 36000,
+                         'repetitions': reps,
+                         'profile': {'0000': 4, 1200: 4},
+                         'task': {'type': 'test',
+                                  'config': {}}}}
+
+    sim = usersim.UserSim(True)
+
+    task_id = api.new_task(config)
+
+    while api.status_task(task_id + reps)['state'] != api.States.STOPPED:
+        sim.cycle()
+
+    # Repetitions must still be respected when several arrivals fall within one cycle.
+    assert api.status_task(task_id + reps + 1)['state'] == api.States.UNKNOWN
+
+def test_gap():
+    config = api.validate_config({'type': 'frequency',
+                                  'config': {'frequency': 3600,
+                                             'repetitions': 0,
+                                             'task': {'type': 'test',
+                                                      'config': {}}}})
+
+    sim = usersim.UserSim(True)
+
+    # An hour without runs, e.g. while the host was suspended, must not launch the arrivals it missed all at once.
+    task = frequency.Frequency(config)
+    task._next_trigger = time.time() - 3600
+    task()
+    sim.cycle()
+    assert len(api.status_all()) == frequency.MAX_CATCH_UP
+
+    # The arrivals that were dropped are not caught up on later either.
+    assert task._next_trigger > time.time() - 1
+    task()
+    sim.cycle()
+    assert len(api.status_all()) <= frequency.MAX_CATCH_UP + 1
+
+def run_test():
+    test_frequency()
+
+    test_profile()
+
+    test_gap()
+
 if __name__ == '__main__':
     run_test()
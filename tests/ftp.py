@@ -4,7 +4,10 @@
 # June 16, 2017
 # Tests for FTP module for UserSim. Makes sure that FTP rejects incorrect configs and accepts correct configs. Prints
 # output from correct configs.
+import os
+
 import api
+from tasks import ftp
 import usersim
 
 
@@ -60,6 +63,18 @@ def test_good_cases(task, good_cases):
         api.new_task(task)
         print('Correctly accepted %s' % config_name)
 
+def test_local_errors():
+    """ Errors writing the downloaded file are not reported as errors reading from the server.
+    """
+    config = api.validate_config({'type': 'ftp', 'config': {'site': '127.0.0.1', 'file': '1KB.zip',
+                                                            'download_dir': os.path.join('no', 'such', 'dir')}})
+    task = ftp.FTP(config)
+    try:
+        task.retrieve_file('127.0.0.1', '1KB.zip', 'anonymous', '')
+        raise AssertionError('Downloaded into a directory that does not exist.')
+    except FileNotFoundError:
+        print('Correctly reported the missing download directory')
+
 def run_test():
     task = {'type': 'ftp', 'config': None}
     empty = {}
@@ -72,14 +87,23 @@ def run_test():
     missing_password = {'site': 'speedtest.tele2.net', 'file': '100KB.zip', 'user': 'anonymous'}
     complete_config = {'site': 'speedtest.tele2.net', 'file': '512KB.zip',
                       'user': 'anonymous', 'password': 'anonymous@'}
+    blank_files = {'site': 'speedtest.tele2.net', 'file': '1KB.zip', 'files': ['']}
+    zero_parallel = {'site': 'speedtest.tele2.net', 'file': '1KB.zip', 'parallel': 0}
+    zero_block_size = {'site': 'speedtest.tele2.net', 'file': '1KB.zip', 'block_size': 0}
+    parallel_discard = {'site': 'speedtest.tele2.net', 'file': '1KB.zip', 'files': ['100KB.zip', '512KB.zip'],
+                        'parallel': 3, 'discard': True, 'block_size': 65536}
     bad_key_cases = [('empty', empty), ('missing_site', missing_site), ('missing_file', missing_file)]
-    bad_value_cases = [('none_args', none_args), ('blank_site', blank_site), ('blank_file', blank_file)]
+    bad_value_cases = [('none_args', none_args), ('blank_site', blank_site), ('blank_file', blank_file),
+                       ('blank_files', blank_files), ('zero_parallel', zero_parallel),
+                       ('zero_block_size', zero_block_size)]
     good_cases = [('missing_opts', missing_opts),
                   ('missing_password', missing_password),
-                  ('complete_config', complete_config)]
+                  ('complete_config', complete_config),
+                  ('parallel_discard', parallel_discard)]
     test_bad_key_cases(task, bad_key_cases)
     test_bad_value_cases(task, bad_value_cases)
     test_good_cases(task, good_cases)
+    test_local_errors()
 
 if __name__ == '__main__':
     run_test()
@@ -0,0 +1,83 @@
+# Copyright 2017 Carnegie Mellon University. See LICENSE.md file for terms.
+
+import collections
+import os
+import string
+import tempfile
+
+from tasks import payload
+
+
+def test_random_text():
+    shared = payload.SharedPayload()
+
+    for length in [1, 200, payload.POOL_SIZE]:
+        text = shared.random_text(length)
+        assert len(text) == length
+        assert set(text) <= set(string.ascii_lowercase)
+
+    # Every letter must be about equally likely. Mapping all byte values would make 22 letters 11% likelier than the
+    # other 4.
+    counts = collections.Counter(shared.random_text(payload.POOL_SIZE))
+    assert max(counts.values()) < min(counts.values()) * 1.05
+
+def test_blob():
+    shared = payload.SharedPayload()
+
+    assert len(shared.blob(1000)) == 1000
+
+    # Larger than the pool, read in pieces the way upload APIs do.
+    size = payload.POOL_SIZE * 2 + 10
+    reader = shared.open_blob(size)
+    total = 0
+    while True:
+        data = reader.read(65536)
+        if not data:
+            break
+        total += len(data)
+    assert total == size
+
+def test_sentences():
+    chain, starts = payload.build_chain('The cat sat. The cat ran. A dog sat down.')
+    assert chain[('The', 'cat')] == ['sat.', 'ran.']
+    assert ('The', 'cat') in starts and ('A', 'dog') in starts
+
+    text = payload.SharedPayload().sentences(50)
+    assert len(text.split()) >= 50
+    print(text)
+
+def test_corpus():
+    with tempfile.TemporaryDirectory() as directory:
+        first = os.path.join(directory, 'first.txt')
+        second = os.path.join(directory, 'second.txt')
+        empty = os.path.join(directory, 'empty.txt')
+        with open(first, 'w') as f:
+            f.write('one\ntwo\n\n\nthree\r\n')
+        with open(second, 'w') as f:
+            f.write('four')
+        open(empty, 'w').close()
+
+        corpus = payload.Corpus([first, second, empty])
+
+        # Blank lines are left out, and every file contributes its lines.
+        assert corpus.line_count() == 4
+        assert set(corpus.lines(200)) == {'one', 'two', 'three', 'four'}
+        assert corpus.paragraph() in {'one\ntwo', 'three', 'four'}
+
+        assert not payload.Corpus([empty]).lines(5)
+
+    # The default corpus is shared, so it's only indexed once.
+    assert payload.get_corpus() is payload.get_corpus()
+    assert len(payload.get_corpus().lines(5)) == 5
+
+def run_test():
+    test_random_text()
+
+    test_blob()
+
+    test_sentences()
+
+    test_corpus()
+
+if __name__ == '__main__':
+    run_test()
@@ -0,0 +1,83 @@
+# Copyright 2017 Carnegie Mellon University. See LICENSE.md file for terms.
+
+import random
+
+import api
+from tasks import rateprofile
+import usersim
+
+
+def test_bad_value_cases():
+    bad_rates = [{}, {'2500': 10}, {'0900': -1}, {'0900': 0}, {'Mon 0900': 10, '1700': 5}, {'Someday 0900': 10},
+                 {'0900': 10, 900: 5}]
+    for rates in bad_rates:
+        config = {'type': 'rateprofile',
+                  'config': {'rates': rates,
+                             'task': {'type': 'test',
+                                      'config': {}}}}
+        try:
+            api.validate_config(config)
+            raise AssertionError('Incorrectly accepted rates {}'.format(rates))
+        except ValueError:
+            print('Correctly rejected rates {}'.format(rates))
+
+def test_good_cases():
+    good_rates = [{'0800': 30, '0900': 5, 1200: 1, '1630': 20, '1800': 0},
+                  {'Mon 0900': 10, 'Friday 1700': 40, 'sat 0000': 0}]
+    for rates in good_rates:
+        for interpolate in [False, True]:
+            config = {'type': 'rateprofile',
+                      'config': {'rates': rates,
+                                 'interpolate': interpolate,
+                                 'task': {'type': 'test',
+                                          'config': {}}}}
+            api.validate_config(config)
+            print('Correctly accepted rates {} with interpolate {}'.format(rates, interpolate))
+
+def test_triggers():
+    # A flat, very high rate so that the test finishes quickly regardless of the time of day.
+    reps = 10
+    config = {'type': 'rateprofile',
+              'config': {'rates': {'0000': 36000, '1200': 72000},
+                         'interpolate': True,
+                         'repetitions': reps,
+                         'task': {'type': 'test',
+                                  'config': {}}}}
+
+    sim = usersim.UserSim(True)
+
+    task_id = api.new_task(config)
+
+    while api.status_task(task_id + reps)['state'] != api.States.STOPPED:
+        sim.cycle()
+
+    assert api.status_task(task_id + reps + 1)['state'] == api.States.UNKNOWN
+
+def test_lazy_draw():
+    config = api.validate_config({'type': 'rateprofile',
+                                  'config': {'rates': {'0000': 3600},
+                                             'task': {'type': 'test',
+                                                      'config': {}}}})
+
+    # The first arrival is drawn from the generator of the task's user once it runs, not from the global one.
+    state = random.getstate()
+    task = rateprofile.RateProfile(config)
+    assert random.getstate() == state
+    assert task.status() == 'Triggered 0 times. Not run yet.'
+
+    task.random = random.Random(5)
+    task()
+    assert random.getstate() == state
+    assert 'Next trigger at' in task.status()
+
+def run_test():
+    test_bad_value_cases()
+
+    test_good_cases()
+
+    test_triggers()
+
+    test_lazy_draw()
+
+if __name__ == '__main__':
+    run_test()
@@ -0,0 +1,108 @@
+# Copyright 2017 Carnegie Mellon University. See LICENSE.md file for terms.
+
+import json
+import queue
+import threading
+import time
+
+import rpyc
+from rpyc.utils.server import ThreadedServer
+
+from communication import rpc
+import usersim
+
+
+def test_by_value(connection):
+    config = {'type': 'dag', 'config': {'nodes': {'a': {'type': 'test', 'config': {}}}}}
+    task_id = connection.root.new_task(config)
+    assert task_id > 0
+
+    # The config was validated as a local copy, so the defaults were not added to the controller's dict.
+    assert 'dependencies' not in config['config']
+
+def test_call(connection):
+    task_id = json.loads(connection.root.call('new_task', json.dumps({'args': [{'type': 'testnostop', 'config': {}}]})))
+    status = json.loads(connection.root.call('status_task', json.dumps({'args': [task_id]})))
+    assert status['id'] == task_id
+
+    try:
+        connection.root.call('subscribe_task', json.dumps({'args': [task_id]}))
+        raise AssertionError('Incorrectly called a function that takes a callback')
+    except ValueError:
+        print('Correctly refused subscribe_task')
+
+class ControllerService(rpyc.Service):
+    """ Stands in for the server that usersims in rpc mode connect to.
+    """
+    connections = []
+
+    def on_connect(self, connection):
+        self.connections.append(connection)
+
+    def exposed_register(self, name, system):
+        pass
+
+    def exposed_bulk_feedback(self, feedback):
+        pass
+
+def test_client():
+    server = start_server(ControllerService)
+    try:
+        rpc.RPCCommunication(queue.Queue(), '127.0.0.1', server.port, 'test')
+
+        # The first connection must be made right away.
+        end = time.time() + 2
+        while not ControllerService.connections:
+            assert time.time() < end, 'Timed out waiting for the usersim to connect.'
+            time.sleep(.01)
+
+        # Requests are handled as soon as they arrive rather than at the next poll.
+        connection = ControllerService.connections[0]
+        start = time.time()
+        for i in range(10):
+            connection.root.status_all()
+        assert time.time() - start < .5
+    finally:
+        server.close()
+
+def start_server(service):
+    """ Start an RPC server on any free port.
+
+    Returns:
+        ThreadedServer: The server, already listening.
+    """
+    server = ThreadedServer(service, hostname='127.0.0.1', port=0)
+    thread = threading.Thread(target=server.start)
+    thread.daemon = True
+    thread.start()
+
+    # The server only starts listening once it has started.
+    end = time.time() + 10
+    while not server.active:
+        assert time.time() < end, 'Timed out waiting for the server.'
+        time.sleep(.01)
+
+    return server
+
+def test_service():
+    server = start_server(rpc.UserSimService)
+    connection = rpyc.connect('127.0.0.1', server.port)
+    try:
+        test_by_value(connection)
+
+        test_call(connection)
+    finally:
+        connection.close()
+        server.close()
+
+def run_test():
+    usersim.UserSim(True)
+    try:
+        test_service()
+
+        test_client()
+    finally:
+        usersim.UserSim(True)
+
+if __name__ == '__main__':
+    run_test()
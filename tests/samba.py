@@ -79,10 +79,17 @@ def run_test():
     authenticated = {'address': 'localhost', 'user': 'blah', 'password': 'blah'}
     complete = {'address': 'localhost', 'user': 'blah', 'password': 'blah',
             'files': ['Users/Win10/Documents/testshare/blah.txt'], 'write_dir': '.'}
+    bad_connections = {'address': 'localhost', 'files': ['share/a.txt', 'share/b.txt'], 'connections': 0}
+    parallel = {'address': 'localhost', 'user': 'blah', 'password': 'blah',
+            'files': ['share/a.txt', 'share/b.txt', 'share/c.txt'], 'connections': 3}
+    bad_blobs = {'address': 'localhost', 'upload': True, 'blobs': [1024, -1], 'write_dir': 'share'}
+    blobs = {'address': 'localhost', 'upload': True, 'blobs': [1024, 1048576], 'write_dir': 'share'}
     bad_key_cases = [('empty', empty)]
     bad_value_cases = [('none_address', none_address), ('none_port', none_port), ('bad_port', bad_port),
-                       ('bad_files', bad_files)]
-    good_cases = [('echo1', echo1), ('echo2', echo2), ('authenticated', authenticated), ('complete', complete)]
+                       ('bad_files', bad_files), ('bad_connections', bad_connections),
+                       ('bad_blobs', bad_blobs)]
+    good_cases = [('echo1', echo1), ('echo2', echo2), ('authenticated', authenticated), ('complete', complete),
+                  ('parallel', parallel), ('blobs', blobs)]
     test_bad_key_cases(task, bad_key_cases)
     test_bad_value_cases(task, bad_value_cases)
     test_good_cases(task, good_cases)
@@ -5,10 +5,61 @@
 # Tests for SMTP module in UserSim. Makes sure that SMTP rejects incorrect configs and accepts correct configs. Prints
 # output from correct configs. Be sure to update test cases with the relevant info for your e-mail server.
 
+import socketserver
+import threading
+import time
+
 import api
+from tasks import smtp
 import usersim
 
 
+class CountingServer(socketserver.ThreadingTCPServer):
+    """ Local mail server which counts connections and messages. Serves on a background thread from creation until
+    close is called.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SMTPHandler)
+        self.port = self.server_address[1]
+        self.connections = 0
+        self.messages = 0
+
+        thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.1})
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """ Speaks just enough SMTP for smtplib to send mail. Accepts every command, and counts each message once its data
+    has been received.
+    """
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 localhost')
+
+        for line in self.rfile:
+            command = line[:4].upper()
+            if command == b'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                for line in self.rfile:
+                    if line.rstrip(b'\r\n') == b'.':
+                        break
+                self.server.messages += 1
+                self.reply('250 OK')
+            elif command == b'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('250 OK')
+
+    def reply(self, text):
+        self.wfile.write(text.encode() + b'\r\n')
+
 def test_bad_key_cases(task, bad_key_cases):
     """ Used to test configs with missing keys. This function will raise an assertion error if validate incorrectly
     accepts a bad config dictionary.
@@ -65,6 +116,54 @@ def test_good_cases(task, good_cases):
         #    print('    Feedback from task:')
         #    print('    %s' % str(result))
 
+def test_pooling():
+    """ Checks that e-mails sent by several runs of the task share a single connection.
+    """
+    server = CountingServer()
+
+    try:
+        config = {'email_addr': 'akidwai@localhost',
+                  'destinations': ['testuser1@localhost'],
+                  'mail_server': '127.0.0.1',
+                  'port': server.port,
+                  'batch': 3}
+        task = smtp.SMTP(smtp.SMTP.validate(config))
+        task()
+        task()
+
+        smtp.pool.clear()
+        assert server.connections == 1
+        assert server.messages == 6
+    finally:
+        server.close()
+
+def test_priming():
+    """ Checks that priming a task nested in another one leaves a connection for the task's first run.
+    """
+    server = CountingServer()
+
+    try:
+        config = {'email_addr': 'akidwai@localhost',
+                  'destinations': ['testuser1@localhost'],
+                  'mail_server': '127.0.0.1',
+                  'port': server.port}
+        api.prime_task({'type': 'dag', 'config': {'nodes': {'mail': {'type': 'smtp', 'config': dict(config)}}}})
+
+        end = time.time() + 10
+        while not smtp.pool.metrics()['idle']:
+            assert time.time() < end, 'Timed out waiting for priming.'
+            time.sleep(.1)
+
+        task = smtp.SMTP(smtp.SMTP.validate(config))
+        task()
+
+        assert smtp.pool.metrics()['reused'] >= 1
+        smtp.pool.clear()
+        assert server.connections == 1
+        assert server.messages == 1
+    finally:
+        server.close()
+
 def run_test():
     task = {'type': 'smtp', 'config': None}
     empty = {}
@@ -109,13 +208,28 @@ def run_test():
                  'subjects': ['Test message subject 1', 'Test message subject 2'],
                  'encrypt': True}
     bad_key_cases = [('empty', empty), ('no_user', no_user), ('no_dest', no_dest), ('no_site', no_site)]
+    bad_batch = {'email_addr': 'akidwai@localhost',
+                 'destinations': ['testuser1@localhost'],
+                 'mail_server': 'ubuntu',
+                 'batch': 0}
+    bad_generate = {'email_addr': 'akidwai@localhost',
+                    'destinations': ['testuser1@localhost'],
+                    'mail_server': 'ubuntu',
+                    'generate': 'lorem'}
+    corpus = {'email_addr': 'akidwai@localhost',
+              'destinations': ['testuser1@localhost'],
+              'mail_server': 'ubuntu',
+              'generate': 'corpus'}
     bad_value_cases = [('bad_user', bad_user), ('bad_dest1', bad_dest1), ('bad_dest2', bad_dest2),
-                       ('bad_site', bad_site)]
+                       ('bad_site', bad_site), ('bad_batch', bad_batch), ('bad_generate', bad_generate)]
     good_cases = [('random_msg_and_subject', random_msg_and_subject), ('random_msg', random_msg),
-                  ('random_subject', random_subject), ('complete', complete), ('encrypted', encrypted)]
+                  ('random_subject', random_subject), ('complete', complete), ('encrypted', encrypted),
+                  ('corpus', corpus)]
     test_bad_key_cases(task, bad_key_cases)
     test_bad_value_cases(task, bad_value_cases)
     test_good_cases(task, good_cases)
+    test_pooling()
+    test_priming()
 
 if __name__ == '__main__':
     run_test()
@@ -115,10 +115,34 @@ def run_test():
             'port': 22,
             'policy': 'AutoAdd'
             }
+    bad_prompt = {
+            'host': 'me',
+            'user': 'admin',
+            'password': 'badpassword',
+            'command_list': ['echo hello'],
+            'prompt': '[$'
+            }
+    bad_idle = {
+            'host': 'me',
+            'user': 'admin',
+            'password': 'badpassword',
+            'command_list': ['echo hello'],
+            'idle': 0
+            }
+    prompt_config = {
+            'host': 'localhost',
+            'user': 'test',
+            'password': 'test',
+            'command_list': ['echo hello', 'ls', 'exit'],
+            'policy': 'AutoAdd',
+            'prompt': '[$#] $',
+            'timeout': 5
+            }
     bad_key_cases = [('empty', empty), ('missing_user', missing_user)]
     bad_value_cases = [('wrong_host', wrong_host), ('wrong_port', wrong_port), ('blank_port', blank_port),
-                     ('blank_host', blank_host), ('wrong_policy', wrong_policy)]
-    good_cases = [('missing_opts', missing_opts), ('good_config', good_config)]
+                     ('blank_host', blank_host), ('wrong_policy', wrong_policy), ('bad_prompt', bad_prompt),
+                     ('bad_idle', bad_idle)]
+    good_cases = [('missing_opts', missing_opts), ('good_config', good_config), ('prompt_config', prompt_config)]
     test_bad_key_cases(task, bad_key_cases)
     test_bad_value_cases(task, bad_value_cases)
     test_good_cases(task, good_cases)
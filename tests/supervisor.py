@@ -0,0 +1,126 @@
+# Copyright 2017 Carnegie Mellon University. See LICENSE.md file for terms.
+
+import time
+
+import api
+import supervisor
+import usersim
+
+
+def wait_for(condition, timeout=20):
+    """ Poll condition until it returns True, cycling the supervisor to collect feedback in the meantime.
+
+    Returns:
+        list: All feedback collected while waiting.
+    """
+    sim = usersim.UserSim()
+    feedback = []
+    end = time.time() + timeout
+    while not condition():
+        assert time.time() < end, 'Timed out waiting for the workers.'
+        feedback.extend(sim.cycle())
+        time.sleep(.1)
+    feedback.extend(sim.cycle())
+    return feedback
+
+def test_sharding(shard):
+    sim = supervisor.Supervisor.start(2, shard)
+    try:
+        task = {'type': 'testnostop', 'config': {}}
+        task_ids = [api.new_task(task) for i in range(4)]
+
+        # Global IDs must never collide, even though each worker counts on its own.
+        assert len(set(task_ids)) == 4
+
+        wait_for(lambda: all(api.status_task(task_id)['state'] == api.States.SCHEDULED for task_id in task_ids))
+        assert sorted(status['id'] for status in api.status_all()) == sorted(task_ids)
+
+        api.pause_all()
+        wait_for(lambda: all(api.status_task(task_id)['state'] == api.States.PAUSED for task_id in task_ids))
+
+        api.stop_all()
+        wait_for(lambda: not api.status_all())
+        for task_id in task_ids:
+            assert api.status_task(task_id)['state'] == api.States.STOPPED
+    finally:
+        sim.shutdown()
+        usersim.UserSim(True)
+
+def test_feedback():
+    sim = supervisor.Supervisor.start(2)
+    try:
+        task_id = api.new_task({'type': 'testfeedback', 'config': {}})
+
+        feedback = wait_for(lambda: api.status_task(task_id)['state'] == api.States.STOPPED)
+
+        # The worker's feedback must refer to the global task ID.
+        assert any(status['id'] == task_id and error for status, error in feedback)
+    finally:
+        sim.shutdown()
+        usersim.UserSim(True)
+
+def test_subscribe():
+    sim = supervisor.Supervisor.start(2)
+    try:
+        task_id = api.new_task({'type': 'test', 'config': {}})
+
+        stopped = []
+        assert api.subscribe_task(task_id, stopped.append)
+
+        wait_for(lambda: stopped)
+        assert stopped[0]['id'] == task_id
+        assert stopped[0]['state'] == api.States.STOPPED
+    finally:
+        sim.shutdown()
+        usersim.UserSim(True)
+
+def test_users():
+    sim = supervisor.Supervisor.start(2)
+    try:
+        alice = api.new_user('alice', 5)
+        bob = api.new_user('bob', 6)
+        alice_ids = [api.new_task({'type': task_type, 'config': {}}, user=alice)
+                     for task_type in ['test', 'testnostop', 'testfeedback']]
+        bob_ids = [api.new_task({'type': 'testnostop', 'config': {}}, user=bob)]
+
+        # All tasks of a user share one copy of it within one worker, whatever their types.
+        assert len({(task_id - 1) % 2 for task_id in alice_ids}) == 1
+        assert (bob_ids[0] - 1) % 2 != (alice_ids[0] - 1) % 2
+
+        wait_for(lambda: api.status_task(alice_ids[1])['state'] == api.States.SCHEDULED)
+        assert api.status_task(alice_ids[1])['user'] == 'alice'
+    finally:
+        sim.shutdown()
+        usersim.UserSim(True)
+
+def test_unpicklable():
+    sim = supervisor.Supervisor.start(1)
+    try:
+        # A context manager can't be pickled, so the worker must report that instead of leaving the call waiting.
+        try:
+            sim._workers[0].call('_acting_as', 1)
+            raise AssertionError('Incorrectly returned an unpicklable result')
+        except RuntimeError:
+            print('Correctly reported an unpicklable result')
+
+        # The worker keeps serving requests afterwards.
+        assert api.status_all() == []
+    finally:
+        sim.shutdown()
+        usersim.UserSim(True)
+
+def run_test():
+    test_sharding('type')
+
+    test_sharding('hash')
+
+    test_feedback()
+
+    test_subscribe()
+
+    test_users()
+
+    test_unpicklable()
+
+if __name__ == '__main__':
+    run_test()
@@ -0,0 +1,128 @@
+# Copyright 2017 Carnegie Mellon University. See LICENSE.md file for terms.
+
+import json
+import queue
+import socket
+import time
+
+import api
+from communication import tcp
+import usersim
+
+
+def receive(sock):
+    """ Read one frame from a blocking socket.
+    """
+    def exactly(size):
+        data = b''
+        while len(data) < size:
+            more = sock.recv(size - len(data))
+            assert more, 'Connection closed unexpectedly.'
+            data += more
+        return data
+
+    length, = tcp.HEADER.unpack(exactly(tcp.HEADER.size))
+    return json.loads(exactly(length).decode())
+
+def test_requests(port):
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.settimeout(10)
+    try:
+        # Send everything before reading any replies.
+        requests = [{'id': 1, 'method': 'new_task', 'args': [{'type': 'testnostop', 'config': {}}]},
+                    {'id': 2, 'method': 'validate_config', 'args': [{'type': 'test', 'config': {}}]},
+                    {'id': 3, 'method': 'exec'},
+                    {'id': 4, 'method': 'new_task', 'args': [{'type': 'nosuchtask', 'config': {}}]},
+                    {'id': 5, 'method': 'pause_all', 'args': [], 'kwargs': {}}]
+        sock.sendall(b''.join(tcp.encode(request) for request in requests))
+
+        replies = [receive(sock) for request in requests]
+        assert [reply['id'] for reply in replies] == [1, 2, 3, 4, 5]
+
+        assert replies[0]['result'] > 0
+        assert replies[1]['result'] == {}
+        assert replies[2]['error']['type'] == 'ValueError'
+        assert replies[3]['error']['type'] == 'KeyError'
+        assert replies[4]['result'] is True
+    finally:
+        sock.close()
+
+def test_wait(port):
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.settimeout(10)
+    try:
+        sock.sendall(tcp.encode({'id': 1, 'method': 'new_task', 'args': [{'type': 'testnostop', 'config': {}}]}))
+        task_id = receive(sock)['result']
+        sock.sendall(tcp.encode({'id': 2, 'method': 'stop_task', 'args': [task_id], 'wait': True}))
+        sock.sendall(tcp.encode({'id': 3, 'method': 'new_task', 'args': [{'type': 'testnostop', 'config': {}}]}))
+
+        # The request after the waiting one is carried out right away.
+        end = time.time() + 10
+        while api.status_task(task_id + 1)['state'] == api.States.UNKNOWN:
+            assert time.time() < end, 'Timed out waiting for the next request to be carried out.'
+            time.sleep(.05)
+
+        # The reply only comes once a cycle has applied the command, and the next reply after it.
+        sock.settimeout(.2)
+        try:
+            receive(sock)
+        except socket.timeout:
+            pass
+        else:
+            assert False, 'Replied before the command was applied.'
+
+        usersim.UserSim().cycle()
+        sock.settimeout(10)
+        assert receive(sock) == {'id': 2, 'result': True}
+        assert receive(sock) == {'id': 3, 'result': task_id + 1}
+    finally:
+        sock.close()
+
+def test_push(port, feedback_queue):
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.settimeout(10)
+    try:
+        sock.sendall(tcp.encode({'id': 1, 'method': 'new_task', 'args': [{'type': 'test', 'config': {}}]}))
+        task_id = receive(sock)['result']
+        sock.sendall(tcp.encode({'id': 2, 'method': 'subscribe_task', 'args': [task_id]}))
+
+        sim = usersim.UserSim()
+        stopped = None
+        feedback = None
+        end = time.time() + 10
+        while not (stopped and feedback):
+            assert time.time() < end, 'Timed out waiting for pushed messages.'
+            for message in sim.cycle():
+                feedback_queue.put(message)
+
+            message = receive(sock)
+            if message.get('id') == 2:
+                assert message['result']
+            elif 'stopped' in message:
+                stopped = message['stopped']
+            elif 'feedback' in message:
+                feedback = message['feedback']
+
+        assert stopped['id'] == task_id
+        assert stopped['state'] == api.States.STOPPED
+        assert any(status['id'] == task_id for status, error in feedback)
+    finally:
+        sock.close()
+
+def run_test():
+    usersim.UserSim(True)
+    feedback_queue = queue.Queue()
+    communication = tcp.TCPCommunication(feedback_queue, '127.0.0.1', 0)
+
+    try:
+        test_requests(communication.port)
+
+        test_wait(communication.port)
+
+        test_push(communication.port, feedback_queue)
+    finally:
+        communication.close()
+        usersim.UserSim(True)
+
+if __name__ == '__main__':
+    run_test()
@@ -2,15 +2,17 @@
 
 import socket
 import threading
+import time
 
 import api
+from tasks import telnet
 import usersim
 
 
 TCP_IP = 'localhost'
 TCP_PORT = 5005
 
-def run_test():
+def test_validate():
     telnet_config = {'type': 'telnet',
                      'config': {'host': TCP_IP,
                                 'username': 'admin',
@@ -18,23 +20,156 @@ def run_test():
                                 'commandlist': ['printstuff', 'do other stuff', 'do this thing'],
                                 'port': TCP_PORT}}
 
+    api.validate_config(telnet_config)
+
+    for key in ['login_prompt', 'password_prompt', 'prompt']:
+        bad_config = {'type': 'telnet', 'config': dict(telnet_config['config'])}
+        bad_config['config'][key] = '[$'
+        try:
+            api.validate_config(bad_config)
+            raise AssertionError('Incorrectly accepted {}'.format(key))
+        except ValueError:
+            print('Correctly rejected {}'.format(key))
+
+def test_session():
+    """ Runs the task twice against a local server, checking that the second run reuses the first run's session.
+    """
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind((TCP_IP, 0))
+    s.listen(1)
+    connections = []
+
+    thread = threading.Thread(target=start_server, args=(s, connections))
+    thread.daemon = True
+    thread.start()
+
+    telnet_config = {'type': 'telnet',
+                     'config': {'host': TCP_IP,
+                                'username': 'admin',
+                                'password': 'password',
+                                'commandlist': ['printstuff', 'do other stuff', 'do this thing'],
+                                'port': s.getsockname()[1],
+                                'timeout': 5}}
+
+    sim = usersim.UserSim(True)
+
+    for i in range(2):
+        task_id = api.new_task(telnet_config)
+        feedback = []
+        while api.status_task(task_id)['state'] != api.States.STOPPED:
+            feedback.extend(sim.cycle())
+        assert not any(error for status, error in feedback), feedback
+
+    assert len(connections) == 1
+
+    telnet.pool.clear()
+    s.close()
+
+def test_prime():
+    """ Priming logs in without constructing a task, and the task's first run reuses that session.
+    """
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind((TCP_IP, 0))
+    s.listen(1)
+    connections = []
+
+    thread = threading.Thread(target=start_server, args=(s, connections))
+    thread.daemon = True
+    thread.start()
+
+    config = telnet.Telnet.validate({'host': TCP_IP,
+                                     'username': 'admin',
+                                     'password': 'password',
+                                     'commandlist': ['printstuff'],
+                                     'port': s.getsockname()[1],
+                                     'timeout': 5})
+    telnet.Telnet.prime(config)
+    assert telnet.pool.metrics()['idle'] == 1
+
     sim = usersim.UserSim(True)
+    task_id = api.new_task({'type': 'telnet', 'config': config})
+    feedback = []
+    while api.status_task(task_id)['state'] != api.States.STOPPED:
+        feedback.extend(sim.cycle())
+    assert not any(error for status, error in feedback), feedback
 
-    task_id = api.validate_config(telnet_config)
+    assert len(connections) == 1
 
-def start_server():
+    telnet.pool.clear()
+    s.close()
+
+def test_timeout():
+    """ A command the server never answers holds up the task until the task's own timeout, not the prompt timeout.
+    """
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.bind((TCP_IP, TCP_PORT))
+    s.bind((TCP_IP, 0))
     s.listen(1)
 
-    conn, addr = s.accept()
-    print('Connection Address: ' + str(addr))
+    thread = threading.Thread(target=start_server, args=(s, []))
+    thread.daemon = True
+    thread.start()
+
+    telnet_config = {'type': 'telnet',
+                     'config': {'host': TCP_IP,
+                                'username': 'admin',
+                                'password': 'password',
+                                'commandlist': ['hang'],
+                                'port': s.getsockname()[1],
+                                'timeout': 60},
+                     'timeout': .5}
+
+    sim = usersim.UserSim(True)
+    task_id = api.new_task(telnet_config)
+    feedback = []
+    start = time.time()
+    while api.status_task(task_id)['state'] != api.States.STOPPED:
+        assert time.time() - start < 10, 'Timed out waiting for the task to be cancelled.'
+        feedback.extend(sim.cycle())
+        time.sleep(.05)
+
+    # Only the timeout itself is reported, not the aborted session.
+    errors = [error for status, error in feedback if error]
+    assert len(errors) == 1 and 'timed out' in errors[0], errors
+    # The aborted session isn't reused.
+    assert telnet.pool.metrics()['discarded'] >= 1
+
+    telnet.pool.clear()
+    s.close()
+
+def run_test():
+    test_validate()
+
+    test_session()
+
+    test_prime()
+
+    test_timeout()
+
+def start_server(s, connections):
+    """ Accepts connections and pretends to be a shell behind a login prompt.
+    """
     while True:
-        data = conn.recv(20)
-        if not data:
+        conn, addr = s.accept()
+        connections.append(addr)
+        print('Connection Address: ' + str(addr))
+        handler = threading.Thread(target=handle_connection, args=(conn,))
+        handler.daemon = True
+        handler.start()
+
+def handle_connection(conn):
+    reader = conn.makefile('rb')
+    conn.sendall(b'Welcome\r\nlogin: ')
+    reader.readline()
+    conn.sendall(b'Password: ')
+    reader.readline()
+    conn.sendall(b'$ ')
+    for line in reader:
+        print('received data: ' + str(line))
+        if line.strip() == b'exit':
             break
-        print('received data: ' + str(data))
-        conn.send(data)
+        if line.strip() == b'hang':
+            continue
+        conn.sendall(b'ok\r\n$ ')
 
     conn.close()
 
@@ -0,0 +1,146 @@
+# Copyright 2017 Carnegie Mellon University. See LICENSE.md file for terms.
+
+import os
+import random
+import socket
+
+import api
+from tasks import user
+import usersim
+
+
+def test_bad_value_cases():
+    bad_configs = [{'name': '', 'tasks': [{'type': 'test', 'config': {}}]},
+                   {'name': 'alice', 'tasks': []},
+                   {'name': 'alice', 'tasks': [{'type': 'test', 'config': {}}], 'count': 0}]
+    for config in bad_configs:
+        try:
+            api.validate_config({'type': 'user', 'config': config})
+            raise AssertionError('Incorrectly accepted {}'.format(config))
+        except ValueError:
+            print('Correctly rejected {}'.format(config))
+
+def test_new_user():
+    os.environ['USERSIM_TEST_PASSWORD'] = 'hunter2'
+
+    virtual_user = api.new_user('alice', 5, {'password': 'USERSIM_TEST_PASSWORD'})
+
+    assert virtual_user.name == 'alice'
+    assert virtual_user.credentials == {'password': 'hunter2'}
+    assert virtual_user.random.random() == random.Random(5).random()
+
+def test_substitute():
+    config = {'type': 'ssh',
+              'config': {'user': '$user', 'password': '$password', 'command_list': ['echo $HOME', 'ls'], 'port': 22}}
+    values = {'user': 'alice', 'password': 'hunter2'}
+
+    result = user.substitute(config, values)
+
+    assert result['config']['user'] == 'alice'
+    assert result['config']['password'] == 'hunter2'
+    # Placeholders that are not known must be left alone.
+    assert result['config']['command_list'] == ['echo $HOME', 'ls']
+    assert result['config']['port'] == 22
+    # The original must not be modified, since it is shared by all users.
+    assert config['config']['user'] == '$user'
+
+def test_users():
+    config = {'type': 'user',
+              'config': {'name': 'alice',
+                         'count': 3,
+                         'seed': 0,
+                         'tasks': [{'type': 'testnostop', 'config': {}},
+                                   {'type': 'frequency',
+                                    'config': {'frequency': 360000,
+                                               'repetitions': 1,
+                                               'task': {'type': 'test', 'config': {}}}}]}}
+
+    sim = usersim.UserSim(True)
+
+    task_id = api.new_task(config)
+
+    # Run until every user's frequency task has triggered, remembering which user each task was tagged with.
+    seen = set()
+    while True:
+        sim.cycle()
+        status_list = api.status_all()
+        seen.update((status['type'], status['user']) for status in status_list)
+        if len(seen) > 1 and not any(status['type'] == 'frequency' for status in status_list):
+            break
+
+    # The user task itself does not belong to a virtual user.
+    assert ('user', '') in seen
+    assert {name for task_type, name in seen} == {'', 'alice1', 'alice2', 'alice3'}
+    # Tasks created by a virtual user's tasks belong to the same user.
+    for name in ['alice1', 'alice2', 'alice3']:
+        assert ('testnostop', name) in seen
+        assert ('test', name) in seen
+
+    api.stop_all()
+    sim.cycle()
+    sim.cycle()
+    assert api.status_task(task_id)['state'] == api.States.STOPPED
+
+def test_random():
+    sim = usersim.UserSim(True)
+    alice = api.new_user('alice', 7)
+    bob = api.new_user('bob', 7)
+
+    alice_id = api.new_task({'type': 'testnostop', 'config': {}}, user=alice)
+    other_id = api.new_task({'type': 'testnostop', 'config': {}})
+    sim.cycle()
+
+    # Tasks draw from their user's own generator instead of sharing the global random state.
+    assert sim._scheduled[alice_id].random is alice.random
+    assert sim._scheduled[other_id].random is random
+
+    # Acting for a user only lasts for the block, and restores the user acted for before it.
+    with sim._acting_as(alice):
+        with sim._acting_as(bob):
+            assert sim._running.user is bob
+        assert sim._running.user is alice
+    assert sim._running.user is None
+
+    api.stop_all()
+    sim.cycle()
+
+def test_prime():
+    """ Nested tasks are not primed while they still contain placeholders, so no session logs in as a literal $user.
+    """
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    s.listen(1)
+    s.settimeout(1)
+
+    telnet = {'type': 'telnet', 'config': {'host': '127.0.0.1', 'port': s.getsockname()[1], 'username': '$user',
+                                           'password': '$password', 'commandlist': ['ls']}}
+    try:
+        usersim.UserSim(True)
+        api.prime_task({'type': 'user', 'config': {'name': 'alice', 'tasks': [telnet]}})
+        api.prime_task({'type': 'all', 'config': {'tasks': [telnet, telnet]}})
+
+        try:
+            connection, address = s.accept()
+        except socket.timeout:
+            pass
+        else:
+            connection.close()
+            raise AssertionError('Primed a session with unsubstituted credentials.')
+    finally:
+        s.close()
+
+def run_test():
+    test_bad_value_cases()
+
+    test_new_user()
+
+    test_substitute()
+
+    test_users()
+
+    test_random()
+
+    test_prime()
+
+if __name__ == '__main__':
+    run_test()
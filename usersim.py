@@ -1,10 +1,28 @@
 # Copyright 2017 Carnegie Mellon University. See LICENSE.md file for terms.
 
+import collections
+import concurrent.futures
+import contextlib
+import heapq
 import queue
+import random
 import threading
+import time
 import traceback
 
 
+# Number of threads constructing tasks whose classes set parallel_init.
+CONSTRUCT_THREADS = 8
+# Number of threads priming tasks. Priming usually waits on the network, so it gets threads of its own.
+PRIME_THREADS = 8
+# Seconds a task's cleanup may take before it is reported and abandoned.
+CLEANUP_TIMEOUT = 60
+# Number of threads running task cleanups. Cleanups run one at a time, so the other threads only take over while
+# cleanups that were abandoned are still running. If all of them are, further cleanups time out without running.
+CLEANUP_THREADS = 4
+# Seconds the cleanup worker waits for more work before exiting.
+CLEANUP_IDLE = 5
+
 class States(object):
     SCHEDULED = 'Scheduled'
     PAUSED = 'Paused'
@@ -16,6 +34,106 @@ class States(object):
     UNKNOWN = 'Unknown'
     PENDING = 'Pending'
 
+class VirtualUser(object):
+    """ One simulated user among many sharing the same simulator. Kept deliberately small, since a single process may
+    simulate hundreds of them.
+    """
+    # __weakref__ lets a supervisor.Supervisor remember which users it has sent to its workers.
+    __slots__ = ('name', 'random', 'credentials', '__weakref__')
+
+    def __init__(self, name, seed=None, credentials=None):
+        """
+        Args:
+            name (str): Used to tag the status and feedback of the user's tasks.
+            seed (int): Seed for the user's own random number generator. Seeded randomly if None.
+            credentials (dict): Arbitrary key:value pairs, such as a username and password.
+        """
+        self.name = name
+        self.random = random.Random(seed)
+        self.credentials = credentials or {}
+
+class Cancelled(Exception):
+    """ Raised by CancelToken.check once the token has been cancelled.
+    """
+    pass
+
+class CancelToken(object):
+    """ Tells a task that it has been stopped or has run out of time, so that work still in progress can give up early.
+    The scheduler gives each task its own token as the task's cancel_token attribute. Tasks that block for a while
+    should check it between steps, wait on it instead of sleeping, and close their sockets through closing so that
+    blocking calls return as soon as the token is cancelled.
+    """
+    __slots__ = ('reason', '_event', '_lock', '_callbacks')
+
+    def __init__(self):
+        self.reason = ''
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    @property
+    def cancelled(self):
+        """ bool: Whether the token has been cancelled.
+        """
+        return self._event.is_set()
+
+    def cancel(self, reason):
+        """ Cancel the token, calling the callbacks registered with closing. Only the first call has any effect.
+
+        Args:
+            reason (str): Why the token was cancelled, for Cancelled exceptions.
+        """
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                # Closing something that is already broken may fail, which is fine since it's being abandoned.
+                pass
+
+    def check(self):
+        """ Raise Cancelled if the token has been cancelled.
+        """
+        if self._event.is_set():
+            raise Cancelled(self.reason)
+
+    def wait(self, timeout):
+        """ Sleep for up to timeout seconds, waking up early if the token is cancelled.
+
+        Returns:
+            bool: True if the token has been cancelled.
+        """
+        return self._event.wait(timeout)
+
+    @contextlib.contextmanager
+    def closing(self, close):
+        """ Call close if the token is cancelled during the with block, e.g. to close a connection so that a blocking
+        read or write on it fails right away.
+
+        Args:
+            close (callable): Takes no arguments. It's called from the thread that cancels the token.
+
+        Raises:
+            Cancelled: If the token has already been cancelled when the block starts.
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(close)
+        self.check()
+
+        try:
+            yield
+        finally:
+            with self._lock:
+                if close in self._callbacks:
+                    self._callbacks.remove(close)
+
 class UserSim(object):
     """ Share one _UserSim object to act like a singleton.
     """
@@ -26,6 +144,13 @@ class UserSim(object):
             cls._instance = _UserSim()
         return cls._instance
 
+    @classmethod
+    def replace(cls, instance):
+        """ Share a different object from now on, such as a supervisor.Supervisor. It must offer the same public methods
+        as _UserSim.
+        """
+        cls._instance = instance
+
 class _UserSim(object):
     """ Manages Task objects internally. No Task should ever reference an object of this class, nor need to.
     """
@@ -48,11 +173,53 @@ class _UserSim(object):
         # Works around a bug where adding a task within a cycle, and then immediately checking the status of that task,
         # would return that the task is stopped. Since the task had not yet been actually constructed yet, our below
         # internal ID counter would increment because we returned a task ID, but _status_single would not see the task
-        # in any of the dictionaries and report that the task was stopped.
-        self._pending = []
+        # in any of the dictionaries and report that the task was stopped. Holds the IDs of all tasks that are queued or
+        # being constructed.
+        self._pending = set()
+
+        # Tasks are constructed without holding the operation lock, and these threads construct tasks whose classes set
+        # parallel_init. Constructed tasks, or the tracebacks of failed constructions, wait in _constructed until they
+        # are registered at the start of a cycle.
+        self._construct_pool = concurrent.futures.ThreadPoolExecutor(CONSTRUCT_THREADS)
+        self._constructed = queue.Queue()
+        self._prime_pool = concurrent.futures.ThreadPoolExecutor(PRIME_THREADS)
+
+        # Stopped tasks are cleaned up one at a time by a worker thread, so that slow cleanups don't hold up the cycle
+        # or API calls. The worker is started when needed and exits once it has been idle for a while.
+        self._cleanup_queue = queue.Queue()
+        self._cleanup_lock = threading.Lock()
+        self._cleanup_thread = None
+        self._cleanup_pool = concurrent.futures.ThreadPoolExecutor(CLEANUP_THREADS)
 
         self._operation_lock = threading.Lock()
 
+        # Pause, unpause and stop commands wait here until they are applied together at the start of the next cycle, so
+        # that callers never wait for the operation lock. Appending to and popping from a deque are atomic.
+        self._commands = collections.deque()
+
+        # Maps the IDs of all pending and managed tasks to their latest status dicts, which are replaced rather than
+        # modified. Each task's status string is captured after it runs and when it is registered, so that status
+        # queries never call task code and don't need the operation lock. Only changed while holding the operation lock.
+        self._snapshots = {}
+
+        # Maps task IDs to the VirtualUser they were created for. Tasks without a virtual user are not included.
+        self._users = {}
+        # Tracks which virtual user the main thread is currently acting for, so that tasks created from within a
+        # user's task belong to the same user.
+        self._running = threading.local()
+
+        # Maps task IDs to lists of callbacks waiting for that task to stop.
+        self._stop_callbacks = {}
+
+        # Maps the IDs of pending and managed tasks to their CancelTokens, which are cancelled as soon as the task is
+        # stopped, without waiting for the next cycle.
+        self._tokens = {}
+        # A heap of (deadline, task ID) tuples for tasks with timeouts. The watchdog thread cancels and stops tasks that
+        # are still running at their deadlines. It is started when needed and exits once the heap is empty.
+        self._deadlines = []
+        self._deadline_condition = threading.Condition()
+        self._watchdog_thread = None
+
         # Used to give status about stopped tasks. This variable must not be increased or decreased, only assigned.
         self._current_id = 0
         self._id_gen = self._new_id()
@@ -66,19 +233,32 @@ class _UserSim(object):
                 str: A traceback message if an exception occurred, empty string otherwise.
         """
         self._construct_tasks()
+        self._apply_commands()
         self._resolve_actions()
 
         for task_id, task in self._scheduled.items():
-            try:
-                task()
-            except Exception:
-                self.add_feedback(task_id, traceback.format_exc())
+            errors = []
+            with self._acting_as(self._users.get(task_id)):
+                try:
+                    task()
+                except Exception:
+                    # Errors caused by cancelling the task, e.g. an aborted connection, aren't worth reporting. A
+                    # timeout is reported by the watchdog.
+                    if not task.cancel_token.cancelled:
+                        errors.append(traceback.format_exc())
 
-            try:
-                stop = task.stop()
-            except Exception:
-                stop = True
-                self.add_feedback(task_id, 'Exception on calling stop method:\n\n' + traceback.format_exc())
+                try:
+                    stop = task.stop()
+                except Exception:
+                    stop = True
+                    errors.append('Exception on calling stop method:\n\n' + traceback.format_exc())
+
+                status = self._check_status(task)
+
+            with self._operation_lock:
+                self._publish(task_id, status)
+            for error in errors:
+                self.add_feedback(task_id, error)
 
             if stop:
                 # Get its status before it's actually stopped because stopping removes the task from memory.
@@ -87,39 +267,57 @@ class _UserSim(object):
                 final_status['state'] = States.STOPPED
                 self._add_feedback(final_status, '')
 
-                self.stop_task(task_id)
+                # Stopped right away rather than at the next cycle, since this thread applies the commands anyway.
+                with self._operation_lock:
+                    self._stop_single(task_id)
 
         feedback = []
         while not self._feedback_queue.empty():
             feedback.append(self._feedback_queue.get())
         return feedback
 
-    def new_task(self, task_class, task_config, start_paused=False):
+    def new_task(self, task_class, task_config, start_paused=False, user=None, timeout=None):
         """ Manage a task. Guaranteed thread-safe.
 
         Arguments:
             task (class): The CLASS of the task to construct.
             config (dict): A pre-validated task config.
             start_paused (bool): Whether the given task will start scheduled (True) or paused (False).
+            user (VirtualUser): The virtual user the task acts for. If None, and the task is created from within another
+                task's run, it inherits that task's virtual user, if any.
+            timeout (number): Seconds after which the task is cancelled and stopped if it is still running, or None to
+                let it run until it stops.
 
         Returns:
             int: A value uniquely associated with the given task.
         """
+        if user is None:
+            user = getattr(self._running, 'user', None)
+
         with self._operation_lock:
             task_id = next(self._id_gen)
+            self._pending.add(task_id)
+            if user:
+                self._users[task_id] = user
+            self._tokens[task_id] = CancelToken()
+            # Published before the ID counts as used, so that a status query never sees the new task as stopped.
+            self._publish(task_id)
             self._current_id = task_id
-            self._pending.append(task_id)
 
             self._new_tasks_queue.put((task_id, task_class, task_config, start_paused))
 
+        if timeout is not None:
+            self._watch(task_id, timeout)
+
         return task_id
 
     def pause_all(self):
         """ Pause all tasks that are currently scheduled. Guaranteed thread-safe.
+
+        Returns:
+            concurrent.futures.Future: Resolves to None once applied at the start of the next cycle.
         """
-        with self._operation_lock:
-            for key in self._scheduled:
-                self._pause_single(key)
+        return self._command(self._pause_all)
 
     def pause_task(self, task_id):
         """ Pause an individual task. Guaranteed thread-safe.
@@ -128,10 +326,10 @@ class _UserSim(object):
             task_id (int): The value returned by the new_task method when the task to be paused was added.
 
         Returns:
-            bool: True if the operation was successful, False otherwise.
+            concurrent.futures.Future: Resolves to True if the operation was successful, False otherwise, once applied
+                at the start of the next cycle.
         """
-        with self._operation_lock:
-            return self._pause_single(task_id)
+        return self._command(self._pause_single, task_id)
 
     def status_all(self):
         """ Get a list of the status of all managed tasks. Guaranteed thread-safe.
@@ -142,18 +340,11 @@ class _UserSim(object):
                 'type':str
                 'state':str
                 'status':str
+                'user':str
         """
-        status_list = []
-
-        with self._operation_lock:
-            for key in self._scheduled:
-                status_list.append(self._status_single(key))
-            for key in self._paused:
-                status_list.append(self._status_single(key))
-            for key in self._new:
-                status_list.append(self._status_single(key))
-
-        return status_list
+        # Copying a dict is atomic, unlike iterating over one that may change.
+        snapshots = self._snapshots.copy()
+        return [dict(snapshot) for snapshot in snapshots.values() if snapshot['state'] != States.PENDING]
 
     def status_task(self, task_id):
         """ Return the status of a particular task. Guaranteed thread-safe.
@@ -167,18 +358,20 @@ class _UserSim(object):
                 'type':str
                 'state':str
                 'status':str
+                'user':str
         """
-        with self._operation_lock:
-            return self._status_single(task_id)
+        return self._status_single(task_id)
 
     def stop_all(self):
         """ Stop all tasks that are currently scheduled or paused. Guaranteed thread-safe.
+
+        Returns:
+            concurrent.futures.Future: Resolves to None once applied at the start of the next cycle.
         """
-        with self._operation_lock:
-            for key in self._scheduled:
-                self._stop_single(key)
-            for key in self._paused:
-                self._stop_single(key)
+        for task_id in self._snapshots.copy():
+            self._cancel(task_id, 'Stopped.')
+
+        return self._command(self._stop_all)
 
     def stop_task(self, task_id):
         """ Stop a particular task. Guaranteed thread-safe.
@@ -187,17 +380,19 @@ class _UserSim(object):
             task_id (int): The value returned by the new_task method when the task to be paused was added.
 
         Returns:
-            bool: True if the operation was successful, False otherwise.
+            concurrent.futures.Future: Resolves to True if the operation was successful, False otherwise, once applied
+                at the start of the next cycle.
         """
-        with self._operation_lock:
-            return self._stop_single(task_id)
+        self._cancel(task_id, 'Stopped.')
+        return self._command(self._stop_single, task_id)
 
     def unpause_all(self):
         """ Unpause all tasks that are currently paused. Guaranteed thread-safe.
+
+        Returns:
+            concurrent.futures.Future: Resolves to None once applied at the start of the next cycle.
         """
-        with self._operation_lock:
-            for key in self._paused:
-                self._unpause_single(key)
+        return self._command(self._unpause_all)
 
     def unpause_task(self, task_id):
         """ Unpause a particular task. Guaranteed thread-safe.
@@ -206,10 +401,51 @@ class _UserSim(object):
             task_id (int): The value returned by the new_task method when the task to be paused was added.
 
         Returns:
-            bool: True if the operation was successful, False otherwise.
+            concurrent.futures.Future: Resolves to True if the operation was successful, False otherwise, once applied
+                at the start of the next cycle.
+        """
+        return self._command(self._unpause_single, task_id)
+
+    def subscribe_task(self, task_id, callback):
+        """ Call callback once a particular task has stopped. Guaranteed thread-safe.
+
+        Arguments:
+            task_id (int): The value returned by the new_task method when the task was added.
+            callback (callable): Called with the task's final status dict (see status_task) as its only argument. It is
+                called from the thread running cycles, or right away from the calling thread if the task has already
+                stopped, so it must not block.
+
+        Returns:
+            bool: True if callback was registered or called, False if the task ID is unknown.
         """
         with self._operation_lock:
-            return self._unpause_single(task_id)
+            status = self._status_single(task_id)
+            if status['state'] == States.UNKNOWN:
+                return False
+            if status['state'] != States.STOPPED:
+                self._stop_callbacks.setdefault(task_id, []).append(callback)
+                return True
+
+        self._notify([([callback], status)])
+        return True
+
+    def prime_task(self, primes):
+        """ Prime tasks in the background, up to PRIME_THREADS at a time, so that slow setup such as connecting doesn't
+        delay the caller or the tasks' first runs. Guaranteed thread-safe.
+
+        Arguments:
+            primes (list of tuples): For each task to prime, its class and its pre-validated config.
+        """
+        for task_class, task_config in primes:
+            self._prime_pool.submit(self._prime_single, task_class, task_config)
+
+    @staticmethod
+    def _prime_single(task_class, task_config):
+        try:
+            task_class.prime(task_config)
+        except Exception:
+            # Priming is only a head start. The task runs into the same problem on its first run and reports it then.
+            pass
 
     def add_feedback(self, task_id, error):
         """ Add a feedback message for the next cycle. Guaranteed thread-safe.
@@ -233,29 +469,71 @@ class _UserSim(object):
     def _add_feedback(self, status_dict, error):
         self._feedback_queue.put((status_dict, error))
 
-    def _new_task(self, task_id, task_class, task_config, start_paused):
-        """ Do task construction and add the constructed task to internal structures. NOT thread-safe, and should only
-        be called from the main thread due to the fragility of some of the interactions with external programs in some
-        tasks.
+    def _new_task(self, task_id, task_class, task_config, start_paused, user):
+        """ Do task construction and queue the result for _register_tasks. Runs without holding the operation lock.
+        Unless the task class sets parallel_init, it must only be called from the main thread due to the fragility of
+        some of the interactions with external programs in some tasks.
 
         Arguments:
             task_id (int): The new task's internal ID.
             task_class (class): The CLASS of the new task to be constructed.
             task_config (dict): A pre-validated task config.
             start_paused (bool): Whether the given task will start scheduled (True) or paused (False).
+            user (VirtualUser): The virtual user the task acts for, or None.
+        """
+        try:
+            with self._acting_as(user):
+                task = task_class(task_config)
+            task._task_id = task_id
+            task.cancel_token = self._tokens[task_id]
+            if user:
+                task.random = user.random
+        except Exception:
+            self._constructed.put((task_id, task_class, None, start_paused, traceback.format_exc()))
+        else:
+            self._constructed.put((task_id, task_class, task, start_paused, ''))
+
+    def _command(self, function, *args):
+        """ Queue a call to one of the NOT thread-safe operations for the start of the next cycle. Guaranteed
+        thread-safe.
+
+        Arguments:
+            function (callable): The operation, e.g. _pause_single.
+            args: The operation's arguments.
 
         Returns:
-            bool: True if the operation was successful, False otherwise.
+            concurrent.futures.Future: Resolves to what the operation returns, or to the exception it raises.
         """
-        task = task_class(task_config)
-        task._task_id = task_id
+        future = concurrent.futures.Future()
+        self._commands.append((function, args, future))
+        return future
 
-        if start_paused:
-            self._to_pause[task_id] = task
-        else:
-            self._to_schedule[task_id] = task
+    def _apply_commands(self):
+        """ Apply the commands queued since the last cycle, in order, while holding the operation lock only once.
+        """
+        results = []
 
-        self._new[task_id] = task
+        with self._operation_lock:
+            # Commands queued while these are applied wait for the next cycle.
+            for i in range(len(self._commands)):
+                function, args, future = self._commands.popleft()
+                try:
+                    results.append((future, function(*args), None))
+                except Exception as e:
+                    results.append((future, None, e))
+
+        # Resolved without holding the lock, since the futures' callbacks may use the API.
+        for future, result, error in results:
+            if error:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def _pause_all(self):
+        """ Pause all tasks that are currently scheduled. NOT guaranteed thread-safe.
+        """
+        for key in self._scheduled:
+            self._pause_single(key)
 
     def _pause_single(self, task_id):
         """ Pause an individual task. NOT guaranteed thread-safe.
@@ -268,11 +546,13 @@ class _UserSim(object):
         """
         if task_id in self._scheduled:
             self._to_pause[task_id] = self._scheduled[task_id]
+            self._publish(task_id)
             return True
         return False
 
     def _status_single(self, task_id):
-        """ Return the status of a particular task. NOT guaranteed thread-safe.
+        """ Return the status of a particular task from its latest snapshot. Guaranteed thread-safe, without needing the
+        operation lock.
 
         Arguments:
             task_id (int > 0): The value returned by the new_task method when the task to be paused was added.
@@ -283,11 +563,27 @@ class _UserSim(object):
                 'type':str
                 'state':str
                 'status':str
+                'user':str - The name of the task's virtual user, or an empty string if it has none.
         """
         assert task_id > 0
 
-        status_dict = {}
+        snapshot = self._snapshots.get(task_id)
+        if snapshot:
+            return dict(snapshot)
+
+        # Tasks stop being managed after their snapshots are removed, so a task without one is either gone or unknown.
+        if task_id <= self._current_id:
+            return {'id': task_id, 'state': States.STOPPED, 'type': 'unknown', 'status': 'dead', 'user': ''}
+        return {'id': task_id, 'state': States.UNKNOWN, 'type': 'unknown', 'status': 'unknown', 'user': ''}
 
+    def _publish(self, task_id, status=None):
+        """ Replace the snapshot of a task to match its current state, or remove it if the task is no longer pending or
+        managed. NOT guaranteed thread-safe.
+
+        Arguments:
+            task_id (int): The task whose state or status has changed.
+            status (str): The task's new status string. If None, the status in the previous snapshot is kept.
+        """
         if task_id in self._to_schedule:
             task = self._to_schedule[task_id]
             state = States.TO_SCHEDULE
@@ -307,35 +603,32 @@ class _UserSim(object):
             # Not ready yet, so we don't have any further information about the task.
             task = None
             state = States.PENDING
-        elif task_id <= self._current_id:
-            task = None
-            state = States.STOPPED
-        else:
-            task = None
-            state = States.UNKNOWN
-
-        if task:
-            task_type = self._get_task_type(task)
-            try:
-                status = task.status()
-            except Exception as e:
-                status = 'Exception while checking status:\n\n' + str(e)
-        elif state == States.STOPPED:
-            task_type = 'unknown'
-            status = 'dead'
-        elif state == States.PENDING:
-            task_type = 'unknown'
             status = 'pending'
         else:
-            task_type = 'unknown'
-            status = 'unknown'
+            self._snapshots.pop(task_id, None)
+            return
+
+        if status is None:
+            status = self._snapshots[task_id]['status']
 
-        status_dict['id'] = task_id
-        status_dict['state'] = state
-        status_dict['type'] = task_type
-        status_dict['status'] = status
+        user = self._users.get(task_id)
+        self._snapshots[task_id] = {'id': task_id,
+                                    'state': state,
+                                    'type': self._get_task_type(task) if task else 'unknown',
+                                    'status': status,
+                                    'user': user.name if user else ''}
 
-        return status_dict
+    @staticmethod
+    def _check_status(task):
+        """ Call a task's status method. Must be called without holding the operation lock, since it runs task code.
+
+        Returns:
+            str: The task's status, or a description of the exception it raised.
+        """
+        try:
+            return task.status()
+        except Exception as e:
+            return 'Exception while checking status:\n\n' + str(e)
 
     def _stop_single(self, task_id):
         """ Stop a particular task. NOT guaranteed thread-safe.
@@ -357,8 +650,23 @@ class _UserSim(object):
         else:
             # The task was either already stopped at the end of the last cycle, or it doesn't exist at all.
             return False
+        self._publish(task_id)
         return True
 
+    def _stop_all(self):
+        """ Stop all tasks that are currently scheduled or paused. NOT guaranteed thread-safe.
+        """
+        for key in self._scheduled:
+            self._stop_single(key)
+        for key in self._paused:
+            self._stop_single(key)
+
+    def _unpause_all(self):
+        """ Unpause all tasks that are currently paused. NOT guaranteed thread-safe.
+        """
+        for key in self._paused:
+            self._unpause_single(key)
+
     def _unpause_single(self, task_id):
         """ Unpause a particular task. NOT guaranteed thread-safe.
 
@@ -370,31 +678,95 @@ class _UserSim(object):
         """
         if task_id in self._paused:
             self._to_schedule[task_id] = self._paused[task_id]
+            self._publish(task_id)
             return True
         return False
 
+    def _notify(self, notifications):
+        """ Call stop callbacks. Must be called without holding the operation lock, since callbacks may use the API.
+
+        Arguments:
+            notifications (list of tuples): Pairs of a list of callbacks and the final status dict to call them with.
+        """
+        for callbacks, status in notifications:
+            for callback in callbacks:
+                try:
+                    callback(dict(status))
+                except Exception:
+                    self._add_feedback(status, 'Exception in a stop callback:\n\n' + traceback.format_exc())
+
     def _construct_tasks(self):
-        """ Handle task initialization while catching exceptions.
+        """ Start constructing newly queued tasks, and register the tasks that have been constructed since the last
+        cycle. Constructors run without holding the operation lock, in parallel if their classes set parallel_init, so
+        that slow constructors don't hold up API calls, and parallel ones don't hold up cycles either.
         """
         with self._operation_lock:
-            self._pending = []
+            new_tasks = []
             while not self._new_tasks_queue.empty():
-                # Here we do new task construction within the main thread.
                 task_id, task_class, task_config, start_paused = self._new_tasks_queue.get()
-                try:
-                    self._new_task(task_id, task_class, task_config, start_paused)
-                except Exception:
-                    status_dict = {'id': task_id,
-                                   'state': States.STOPPED,
-                                   'type': self._get_task_type(task_class),
-                                   'status': 'Failed to initialize task.'}
-                    self._feedback_queue.put((status_dict, traceback.format_exc()))
+                new_tasks.append((task_id, task_class, task_config, start_paused, self._users.get(task_id)))
+
+        for new_task in new_tasks:
+            if new_task[1].parallel_init:
+                self._construct_pool.submit(self._new_task, *new_task)
+            else:
+                # Here we do new task construction within the main thread.
+                self._new_task(*new_task)
+
+        self._register_tasks()
+
+    def _register_tasks(self):
+        """ Add constructed tasks to the internal structures, and report tasks that failed to construct.
+        """
+        notifications = []
+
+        constructed = []
+        while not self._constructed.empty():
+            task_id, task_class, task, start_paused, error = self._constructed.get()
+            # Capture the first status before taking the lock, since it runs task code.
+            status = self._check_status(task) if task else None
+            constructed.append((task_id, task_class, task, start_paused, error, status))
+
+        with self._operation_lock:
+            for task_id, task_class, task, start_paused, error, status in constructed:
+                self._pending.discard(task_id)
+
+                if task:
+                    if start_paused:
+                        self._to_pause[task_id] = task
+                    else:
+                        self._to_schedule[task_id] = task
+                    self._new[task_id] = task
+                    if self._tokens[task_id].cancelled:
+                        # The task timed out before it was even constructed.
+                        self._to_stop[task_id] = task
+                    self._publish(task_id, status)
+                    continue
+
+                self._publish(task_id)
+                self._tokens.pop(task_id, None)
+
+                user = self._users.pop(task_id, None)
+                status_dict = {'id': task_id,
+                               'state': States.STOPPED,
+                               'type': self._get_task_type(task_class),
+                               'status': 'Failed to initialize task.',
+                               'user': user.name if user else ''}
+                self._feedback_queue.put((status_dict, error))
+                if task_id in self._stop_callbacks:
+                    notifications.append((self._stop_callbacks.pop(task_id), status_dict))
+
+        self._notify(notifications)
 
     def _resolve_actions(self):
         """ Handle all changes in scheduling. Guaranteed thread-safe.
         """
+        notifications = []
+
         # Definitely want to lock to prevent any changes to these structures while resolving.
         with self._operation_lock:
+            changed = list(self._to_pause) + list(self._to_schedule) + list(self._to_stop)
+
             for task_id, task in self._to_pause.items():
                 # If these three lines raise, something has gone wrong and we should know about it.
                 try:
@@ -420,6 +792,12 @@ class _UserSim(object):
             self._to_schedule = {}
 
             for task_id, task in self._to_stop.items():
+                if task_id in self._stop_callbacks:
+                    # Capture the final status while the task can still report it.
+                    final_status = self._status_single(task_id)
+                    final_status['state'] = States.STOPPED
+                    notifications.append((self._stop_callbacks.pop(task_id), final_status))
+
                 task_ = self._scheduled.pop(task_id, None)
                 if task_ is None:
                     task_ = self._paused.pop(task_id, None)
@@ -430,14 +808,127 @@ class _UserSim(object):
 
                 # If this raises, how did this happen?
                 assert task_ is task
-                try:
-                    task.cleanup()
-                except Exception:
-                    status = self._status_single(task_id)
-                    self._add_feedback(status, 'Exception while calling task cleanup:\n\n' + traceback.format_exc())
+                # Work the task left running in the background is abandoned, even if the task stopped itself.
+                self._tokens.pop(task_id).cancel('Stopped.')
+                self._queue_cleanup(task_id, task, self._users.pop(task_id, None))
 
             self._to_stop = {}
 
+            for task_id in changed:
+                self._publish(task_id)
+
+        self._notify(notifications)
+
+    def _cancel(self, task_id, reason):
+        """ Cancel a task's token right away, rather than when the stop command is applied. Tasks that are still pending
+        can't be stopped, so their tokens are left alone. Guaranteed thread-safe.
+        """
+        token = self._tokens.get(task_id)
+        snapshot = self._snapshots.get(task_id)
+        if token and snapshot and snapshot['state'] != States.PENDING:
+            token.cancel(reason)
+
+    def _watch(self, task_id, timeout):
+        """ Have the watchdog stop a task once timeout seconds have passed, starting the watchdog if it isn't running.
+        """
+        with self._deadline_condition:
+            heapq.heappush(self._deadlines, (time.monotonic() + timeout, task_id, timeout))
+            if self._watchdog_thread is None:
+                self._watchdog_thread = threading.Thread(target=self._watchdog)
+                self._watchdog_thread.daemon = True
+                self._watchdog_thread.start()
+            else:
+                # The new deadline may be the earliest.
+                self._deadline_condition.notify()
+
+    def _watchdog(self):
+        """ Cancel and stop tasks that are still running at their deadlines. Runs in the watchdog thread.
+        """
+        while True:
+            with self._deadline_condition:
+                if not self._deadlines:
+                    self._watchdog_thread = None
+                    return
+                deadline, task_id, timeout = self._deadlines[0]
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    self._deadline_condition.wait(remaining)
+                    continue
+                heapq.heappop(self._deadlines)
+
+            token = self._tokens.get(task_id)
+            if token is None or token.cancelled:
+                # The task already stopped.
+                continue
+            reason = 'Task timed out after {} seconds.'.format(timeout)
+            token.cancel(reason)
+            self.add_feedback(task_id, reason)
+            self._command(self._stop_single, task_id)
+
+    def _queue_cleanup(self, task_id, task, user):
+        """ Queue a stopped task to be cleaned up by the cleanup worker, starting the worker if it isn't running.
+
+        Arguments:
+            task_id (int): The stopped task's ID.
+            task (Task): The stopped task.
+            user (VirtualUser): The virtual user the task acted for, or None.
+        """
+        self._cleanup_queue.put((task_id, task, user))
+        with self._cleanup_lock:
+            if self._cleanup_thread is None:
+                self._cleanup_thread = threading.Thread(target=self._clean_up)
+                self._cleanup_thread.daemon = True
+                self._cleanup_thread.start()
+
+    def _clean_up(self):
+        """ Call the cleanup method of each queued task in turn, reporting errors and cleanups that time out as
+        feedback. Runs in the cleanup worker thread.
+        """
+        while True:
+            try:
+                task_id, task, user = self._cleanup_queue.get(timeout=CLEANUP_IDLE)
+            except queue.Empty:
+                with self._cleanup_lock:
+                    # Checked under the lock so that _queue_cleanup either sees this thread still running or starts a
+                    # new one.
+                    if self._cleanup_queue.empty():
+                        self._cleanup_thread = None
+                        return
+                continue
+
+            # A cleanup can't be interrupted, so it runs in the cleanup pool, and is left running there if it takes
+            # too long.
+            future = self._cleanup_pool.submit(task.cleanup)
+            try:
+                future.result(timeout=CLEANUP_TIMEOUT)
+            except concurrent.futures.TimeoutError:
+                error = 'Task cleanup did not finish within {} seconds.'.format(CLEANUP_TIMEOUT)
+            except Exception:
+                error = 'Exception while calling task cleanup:\n\n' + traceback.format_exc()
+            else:
+                continue
+
+            self._add_feedback({'id': task_id,
+                                'state': States.STOPPED,
+                                'type': self._get_task_type(task),
+                                'status': self._check_status(task),
+                                'user': user.name if user else ''}, error)
+
+    @contextlib.contextmanager
+    def _acting_as(self, user):
+        """ Run the enclosed block on behalf of a virtual user. Tasks created within the block belong to the same user.
+        Only affects the calling thread, and the user acted for before the block is restored after it.
+
+        Arguments:
+            user (VirtualUser): The virtual user to act for, or None.
+        """
+        outer = getattr(self._running, 'user', None)
+        self._running.user = user
+        try:
+            yield
+        finally:
+            self._running.user = outer
+
     @staticmethod
     def _new_id():
         current_id = 0